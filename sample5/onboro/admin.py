@@ -1,13 +1,17 @@
 from distutils.command.register import register
 
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib import messages
 from django.urls import reverse
 from django.http import HttpResponseRedirect
+from django.db import transaction
+from django.db.models import Q
 
 # Register your models here.
-from .models import User, Category, Book, Chapter, TransactionRecord
+from .models import User, Category, Book, Chapter, TransactionRecord, ArchivedTransactionRecord, Ownership, Job
+from . import ledger, pagination, renditions
 
 
 class UserAdmin(BaseUserAdmin):
@@ -28,14 +32,79 @@ class BookAdmin(admin.ModelAdmin):
     list_display = ['title', 'published']
     inlines = [ChapterInline]
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if 'image' in form.changed_data:
+            # 縮小版は数秒かかることがあるので、保存を確定してから(DBのロックを離してから)作る
+            name = obj.image.name
+            transaction.on_commit(lambda: renditions.generate([name]))
+
 admin.site.register(Book, BookAdmin)
 
+# 検索で先に引くユーザー・書籍の最大数（これより多く当たる短い検索語は、サブクエリのまま絞り込む）
+PREFIX_SEARCH_ID_LIMIT = 1000
+
+def prefix_search(queryset, search_term):
+    """ユーザー名・書籍名が search_term で始まる取引記録に絞り込む
+
+    LIKEで取引記録とJOINしながら探すのではなく、先にユーザー名の一意インデックス・書籍名のインデックスを
+    範囲で引いてIDを集め、取引記録は user・book のインデックスで引く。
+    """
+    term = search_term.strip()
+    if not term:
+        return queryset
+    # 「termで始まる」は term 以上、term + 最大の文字 未満の範囲と同じ
+    upper = term + '\U0010ffff'
+    conditions = Q()
+    for field, model, column in [('user', User, 'username'), ('book', Book, 'title')]:
+        ids = model.objects.filter(**{f'{column}__gte': term, f'{column}__lt': upper}).values_list('pk', flat=True)
+        found = list(ids[:PREFIX_SEARCH_ID_LIMIT + 1])
+        if len(found) > PREFIX_SEARCH_ID_LIMIT:
+            conditions |= Q(**{f'{field}__in': ids})
+        elif found:
+            conditions |= Q(**{f'{field}__in': found})
+    if not conditions:
+        return queryset.none()
+    return queryset.filter(conditions)
+
+class TransactionRecordAdminForm(forms.ModelForm):
+    class Meta:
+        model = TransactionRecord
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # 残高の増減は保存時にledgerが行うので、残高が足りなくなる記録は先に入力エラーにする
+        user, kind, amount = (cleaned_data.get(name) for name in ('user', 'kind', 'amount'))
+        if user and kind and amount is not None:
+            record = TransactionRecord(pk=self.instance.pk, user=user, kind=kind, amount=amount)
+            changes = ledger.balance_changes(record)
+            balances = dict(User.objects.filter(pk__in=changes).values_list('pk', 'coin'))
+            if any(balances.get(user_id, 0) + delta < 0 for user_id, delta in changes.items()):
+                raise forms.ValidationError("残高が足りないため、この取引記録は保存できません。")
+        return cleaned_data
+
 class TransactionRecordAdmin(admin.ModelAdmin):
     model = TransactionRecord
+    form = TransactionRecordAdminForm
     list_display = ['kind', 'amount', 'user', 'book', 'datetime']
+    # ユーザーと書籍は一覧と同じクエリでJOINして取得する
+    list_select_related = ['user', 'book']
     list_filter = ['kind']
-    search_fields = ['user__username', 'book__title']
-    search_help_text = 'ユーザー名と書籍名で検索できます'
+    # 日付の選択肢は売上の日次集計から作る(templatetags/onboro_admin.py)
+    date_hierarchy = 'datetime'
+    # 種別で絞り込んだときも (kind, datetime) のインデックスで新しい順に読めるようにする
+    ordering = ['-datetime', '-pk']
+    # 件数はCOUNT(*)で全件を数えず、見積もりで済ませる
+    show_full_result_count = False
+    paginator = pagination.EstimatedCountPaginator
+    search_fields = ['^user__username', '^book__title']
+    search_help_text = 'ユーザー名と書籍名の先頭の文字で検索できます'
+    # 編集画面で全ユーザー・全書籍の選択肢を作らない
+    raw_id_fields = ['user', 'book']
+
+    def get_search_results(self, request, queryset, search_term):
+        return prefix_search(queryset, search_term), False
 
     def delete_model(self, request, obj):
         # 削除を無効化し、警告メッセージを表示
@@ -46,4 +115,46 @@ class TransactionRecordAdmin(admin.ModelAdmin):
         """削除権限を常に無効化する"""
         return False
 
-admin.site.register(TransactionRecord, TransactionRecordAdmin)
\ No newline at end of file
+admin.site.register(TransactionRecord, TransactionRecordAdmin)
+
+# アーカイブへ移した取引記録は締めた月のものなので、閲覧だけできるようにする
+class ArchivedTransactionRecordAdmin(admin.ModelAdmin):
+    model = ArchivedTransactionRecord
+    list_display = ['kind', 'amount', 'user', 'book', 'datetime']
+    list_select_related = ['user', 'book']
+    list_filter = ['kind']
+    show_full_result_count = False
+    paginator = pagination.EstimatedCountPaginator
+    search_fields = ['^user__username', '^book__title']
+    search_help_text = 'ユーザー名と書籍名の先頭の文字で検索できます'
+
+    def get_search_results(self, request, queryset, search_term):
+        return prefix_search(queryset, search_term), False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+admin.site.register(ArchivedTransactionRecord, ArchivedTransactionRecordAdmin)
+
+class OwnershipAdmin(admin.ModelAdmin):
+    model = Ownership
+    list_display = ['user', 'book', 'datetime']
+    list_select_related = ['user', 'book']
+    raw_id_fields = ['user', 'book']
+
+admin.site.register(Ownership, OwnershipAdmin)
+
+class JobAdmin(admin.ModelAdmin):
+    model = Job
+    list_display = ['pk', 'kind', 'status', 'processed', 'succeeded', 'error_count', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['status', 'kind']
+    list_select_related = ['created_by']
+    readonly_fields = ['started_at', 'heartbeat_at', 'finished_at', 'created_at', 'worker']
+
+admin.site.register(Job, JobAdmin)
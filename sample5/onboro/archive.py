@@ -0,0 +1,80 @@
+"""締めた月の取引記録のアーカイブ
+
+取引記録は削除できないので、そのままでは1つのテーブルが増え続け、
+条件の緩いクエリほど月を追うごとに遅くなる。締めた月の行はアーカイブのテーブルへ移し、
+取引記録のテーブルには最近の数か月分だけを残しておく（メモリのキャッシュに載る大きさに保つ）。
+
+移すときは行をそのまま写して元を消すだけで、残高(User.coin)・売上集計・チェックポイントは変わらない。
+取引履歴や残高の照合は user_records() などで両方のテーブルを合わせて読む。
+"""
+import datetime as dt
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+
+DEFAULT_KEEP_MONTHS = 6
+DEFAULT_BATCH_SIZE = 1000
+
+
+def month_start(value):
+    """日時(またはdate)を含む月の1日"""
+    if isinstance(value, dt.datetime):
+        value = timezone.localdate(value)
+    return value.replace(day=1)
+
+
+def cutoff(keep_months=DEFAULT_KEEP_MONTHS, today=None):
+    """今月を含めて keep_months か月より前が「締めた月」。その境目の日時を返す"""
+    month = month_start(today or timezone.localdate())
+    for _ in range(keep_months - 1):
+        month = month_start(month - dt.timedelta(days=1))
+    return timezone.make_aware(dt.datetime.combine(month, dt.time.min))
+
+
+def archive_batch(before, batch_size=DEFAULT_BATCH_SIZE):
+    """before より前の取引記録を古い順に batch_size 件までアーカイブへ移す
+
+    移した件数を月ごとに数えた Counter を返す（何も移さなければ空）。
+    """
+    from .models import TransactionRecord, ArchivedTransactionRecord, User
+
+    with transaction.atomic():
+        # 移している間に管理画面から編集されないよう、対象の行をロックする
+        records = list(TransactionRecord.objects.select_for_update()
+                       .filter(datetime__lt=before).order_by('pk')[:batch_size])
+        if not records:
+            return Counter()
+        # 残高の照合(reconcile_coins)はユーザー行をロックして2つのテーブルを別々に合計するので、
+        # その間に移すと同じ記録を2回数えてしまう。記録の持ち主のユーザー行もロックして、照合と順番にする
+        # （取引記録の編集と同じく、取引記録 → ユーザーの順にロックする）
+        list(User.objects.select_for_update()
+             .filter(pk__in={record.user_id for record in records}).order_by('pk').values_list('pk', flat=True))
+        ArchivedTransactionRecord.objects.bulk_create([
+            ArchivedTransactionRecord(
+                id=record.pk, user_id=record.user_id, book_id=record.book_id, datetime=record.datetime,
+                kind=record.kind, amount=record.amount, month=month_start(record.datetime),
+            )
+            for record in records
+        ])
+        # 取引記録は削除できないが、アーカイブへ写し終えた行だけはここで消す
+        TransactionRecord.objects.filter(pk__in=[record.pk for record in records]).delete()
+    return Counter(month_start(record.datetime) for record in records)
+
+
+def user_records(user):
+    """ユーザーの取引記録を [最近の分, アーカイブの分] の2つのquerysetで返す"""
+    from .models import TransactionRecord, ArchivedTransactionRecord
+
+    return [
+        TransactionRecord.objects.filter(user=user),
+        ArchivedTransactionRecord.objects.filter(user=user),
+    ]
+
+
+def sum_aggregates(querysets, **aggregates):
+    """複数のquerysetを同じ式で集計し、結果を足し合わせる"""
+    totals = Counter()
+    for queryset in querysets:
+        totals.update(queryset.aggregate(**aggregates))
+    return {name: totals[name] for name in aggregates}
@@ -0,0 +1,142 @@
+"""ユーザーのアイコン(UserProfile.icon)の縮小版と、画面上部に出すユーザーごとの表示設定
+
+アイコンはアップロードされたままだと数百KBあるので、中央を正方形に切り抜いて SIZES(px) の
+JPEG・WebPを作り、表紙の縮小版と同じディレクトリ(renditions/<元画像のパス>/avatar-<大きさ>.<拡張子>)に置く。
+
+base.html のナビゲーションバーに出すアイコン・文字の大きさ・背景色は、ページごとにUserProfileを
+引かないよう、ユーザーごとにキャッシュする(chrome())。マイページ設定などでUserProfileが保存されたら消す。
+"""
+import io
+import posixpath
+
+from PIL import Image, ImageOps
+
+from . import renditions
+
+# 作る大きさ(px)。ナビゲーションバーの32pxと、その2倍、マイページの表示用
+SIZES = (32, 64, 128)
+
+# 文字の大きさ(UserProfile.custom_setting)ごとの font-size
+FONT_SIZES = {
+    'small': '0.875rem',
+    'normal': '1rem',
+    'large': '1.25rem',
+}
+
+# 背景色(UserProfile.background_color)ごとの文字色
+TEXT_COLORS = {
+    'white': 'black',
+    'black': 'white',
+}
+
+
+def avatar_name(name, size, fmt):
+    directory = posixpath.dirname(renditions.rendition_name(name, size, fmt))
+    return f'{directory}/avatar-{size}.{renditions.FORMATS[fmt][1]}'
+
+
+def _render(data):
+    image = renditions.open_image(data)
+    rendered = {}
+    for size in SIZES:
+        # 中央を正方形に切り抜いて縮める（元画像より大きくはしない）
+        side = min(size, image.width, image.height)
+        square = ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+        for fmt, encoded in renditions.encode(square).items():
+            rendered[size, fmt] = encoded
+    return rendered
+
+
+def generate(name, source=None):
+    """アイコンの縮小版を作る。作れなければ(元画像がない・壊れている)Falseを返す"""
+    from django.core.files.storage import default_storage
+
+    from .storage import uploads
+
+    if not name:
+        return False
+    try:
+        with (source or uploads()).open(name, 'rb') as file:
+            rendered = _render(file.read())
+    except Exception:
+        return False
+    for (size, fmt), data in rendered.items():
+        path = avatar_name(name, size, fmt)
+        default_storage.delete(path)
+        default_storage.save(path, io.BytesIO(data))
+    return True
+
+
+def exists(name):
+    from django.core.files.storage import default_storage
+
+    return all(default_storage.exists(avatar_name(name, size, fmt)) for size in SIZES for fmt in renditions.FORMATS)
+
+
+def srcset(name, size, fmt):
+    """表示の大きさ size のアイコンの srcset (等倍と2倍)"""
+    from django.core.files.storage import default_storage
+
+    candidates = [candidate for candidate in SIZES if candidate >= size][:2]
+    return ', '.join(
+        f'{default_storage.url(avatar_name(name, candidate, fmt))} {candidate / size:g}x' for candidate in candidates
+    )
+
+
+def get_cache():
+    from django.conf import settings
+    from django.core.cache import caches
+    from django.core.cache.backends.base import InvalidCacheBackendError
+
+    try:
+        return caches[getattr(settings, 'PROFILE_CACHE_ALIAS', 'profiles')]
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def _cache_key(user_id):
+    return f'onboro:chrome:{user_id}'
+
+
+def chrome(user_id):
+    """ナビゲーションバーなどに出すユーザーごとの表示設定。キャッシュにあればDBを引かない"""
+    from django.conf import settings
+    from django.core.files.storage import default_storage
+
+    from .models import UserProfile
+    from .storage import uploads
+
+    cache = get_cache()
+    key = _cache_key(user_id)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    profile = UserProfile.objects.filter(user_id=user_id).values('custom_setting', 'background_color', 'icon').first()
+    profile = profile or {'custom_setting': 'normal', 'background_color': 'white', 'icon': None}
+    icon = profile['icon']
+    data = {
+        'font_size': FONT_SIZES.get(profile['custom_setting'], FONT_SIZES['normal']),
+        'background_color': profile['background_color'],
+        'text_color': TEXT_COLORS.get(profile['background_color'], 'black'),
+        'icon': None,
+    }
+    if icon:
+        # 以前にアップロードされたアイコンは、ここで縮小版を作る
+        if exists(icon) or generate(icon):
+            data['icon'] = {
+                'src': default_storage.url(avatar_name(icon, 32, 'jpeg')),
+                'srcset': srcset(icon, 32, 'jpeg'),
+                'webp_srcset': srcset(icon, 32, 'webp'),
+            }
+        else:
+            data['icon'] = {'src': uploads().url(icon), 'srcset': '', 'webp_srcset': ''}
+    cache.set(key, data, getattr(settings, 'PROFILE_CACHE_TIMEOUT', 3600))
+    return data
+
+
+def invalidate(user_id):
+    from django.db import transaction
+
+    # 保存が確定してから消す（確定前に他のリクエストが古い設定をキャッシュし直さないように）
+    transaction.on_commit(lambda: get_cache().delete(_cache_key(user_id)))
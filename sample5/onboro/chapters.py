@@ -0,0 +1,99 @@
+"""章の本文の表示用HTML（ページに分けたもの）
+
+数MBある章もあるので、章のページを開くたびに本文全体を読んで linebreaks フィルターをかけないよう、
+章を保存するときに本文を段落の切れ目でおよそ PAGE_SIZE 文字ずつに分け、ページごとのHTMLにしておく
+(ChapterPage)。章のページは ?page=N のページ1つだけを読み、?page=all のときはページを少しずつ読んで
+StreamingHttpResponse で送る(views.BookChapterView)。どちらも1リクエストで持つ本文は数ページ分までになる。
+
+ページのHTML全体のハッシュ(Chapter.body_hash)は章のページのETagに使う(conditional.py)。
+"""
+import hashlib
+import re
+
+from django.utils.html import linebreaks
+from django.utils.text import normalize_newlines
+
+# 1ページの本文のおよその文字数（段落の途中では切らないので、これより少し短くなる）
+PAGE_SIZE = 20000
+
+# 全文を送るときに一度に読むページ数
+STREAM_BATCH_SIZE = 5
+
+# linebreaks フィルターと同じ段落の区切り
+_PARAGRAPH_BREAK = re.compile(r'\n{2,}')
+
+
+def render_html(body):
+    """テンプレートの {{ body|linebreaks }} と同じHTMLを返す"""
+    return linebreaks(body, autoescape=True)
+
+
+def _pieces(paragraph, page_size):
+    # 1ページより長い段落は、段落の中の改行(なければ文字数)で切る
+    while len(paragraph) > page_size:
+        cut = paragraph.rfind('\n', 0, page_size)
+        if cut <= 0:
+            cut = page_size
+        yield paragraph[:cut]
+        paragraph = paragraph[cut:].lstrip('\n')
+    yield paragraph
+
+
+def split(body, page_size=PAGE_SIZE):
+    """本文を段落の切れ目でページの大きさに分ける（本文が空でも1ページは返す）"""
+    segment, length = [], 0
+    for paragraph in _PARAGRAPH_BREAK.split(normalize_newlines(body or '')):
+        for piece in _pieces(paragraph, page_size):
+            if segment and length + len(piece) > page_size:
+                yield '\n\n'.join(segment)
+                segment, length = [], 0
+            segment.append(piece)
+            length += len(piece) + 2
+    yield '\n\n'.join(segment)
+
+
+def render(chapter, page_size=PAGE_SIZE):
+    """章の本文からページごとのHTMLを作り、ハッシュとページ数を設定する（ページは返すだけで保存しない）"""
+    pages = [render_html(segment) for segment in split(chapter.body, page_size)]
+    digest = hashlib.sha256()
+    for html in pages:
+        digest.update(html.encode())
+    chapter.body_hash = digest.hexdigest()
+    chapter.page_count = len(pages)
+    return pages
+
+
+def save_pages(chapter, pages):
+    """render() で作ったページで章のページを置き換える"""
+    from .models import ChapterPage
+
+    ChapterPage.objects.filter(chapter_id=chapter.pk).delete()
+    ChapterPage.objects.bulk_create([
+        ChapterPage(chapter_id=chapter.pk, number=number, html=html) for number, html in enumerate(pages, start=1)
+    ])
+
+
+def page(chapter_id, number):
+    """章の number ページ目のHTML（なければNone）"""
+    from .models import ChapterPage
+
+    html = ChapterPage.objects.filter(chapter_id=chapter_id, number=number).values_list('html', flat=True).first()
+    # 圧縮したまま読まれるので展開する(fields.py)
+    return None if html is None else str(html)
+
+
+def stream(chapter_id, batch_size=STREAM_BATCH_SIZE):
+    """章のページのHTMLを順に返す（一度に読むのは batch_size ページまで）"""
+    from .models import ChapterPage
+
+    last = 0
+    while True:
+        batch = list(
+            ChapterPage.objects.filter(chapter_id=chapter_id, number__gt=last)
+            .order_by('number').values_list('number', 'html')[:batch_size]
+        )
+        if not batch:
+            return
+        for last, html in batch:
+            yield str(html)
+
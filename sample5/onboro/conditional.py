@@ -0,0 +1,48 @@
+"""書籍・章のページの条件付きGET(ETag・Last-Modified → 304 Not Modified)
+
+ページの中身を決める値(章のハッシュ・章名・前後の章・ログインユーザーの表示設定など)から
+弱いETagを作り、ブラウザが持っているものと同じならテンプレートを描かずに304を返す。
+CSRFトークンは表示するたびに違う値になる(マスクされる)ので、ETagは弱い(W/)ものにする。
+ただしトークンの元になるCSRFの秘密の値(クッキー)はETagに含める。ログインし直すなどで秘密の値が変わったら、
+古いトークンの入ったページ(購入フォーム・読書位置のビーコン)を304で使わせない。
+
+ページはユーザーごとに違うので、共有キャッシュには置かせない(Cache-Control: private)。
+"""
+import hashlib
+
+from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from . import avatars
+
+# テンプレートの見た目を変えたら上げる（古いETagのページを304で使い続けさせないため）
+RENDER_VERSION = 1
+
+
+def etag(request, *parts):
+    user = request.user
+    viewer = (user.pk, user.get_username(), avatars.chrome(user.pk)) if user.is_authenticated else None
+    csrf_secret = request.META.get('CSRF_COOKIE')
+    key = repr((RENDER_VERSION, viewer, csrf_secret, sorted(request.GET.lists()), parts))
+    return f'W/"{hashlib.sha256(key.encode()).hexdigest()[:32]}"'
+
+
+def not_modified(request, etag, last_modified):
+    """ブラウザのキャッシュがそのまま使えるなら304のレスポンスを返す（使えなければNone）"""
+    # 表示待ちのメッセージ(「購入しました」など)があるときは、ページを描いて表示する
+    if len(messages.get_messages(request)):
+        return None
+    # Last-Modified は秒単位なので、比べるときも秒に切り捨てる
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+    if response is not None:
+        set_headers(response, etag, last_modified)
+    return response
+
+
+def set_headers(response, etag, last_modified):
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified.timestamp())
+    # 毎回ETagで確認させる
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
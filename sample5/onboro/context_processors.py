@@ -0,0 +1,15 @@
+from django.utils.functional import SimpleLazyObject
+
+from . import avatars
+
+
+def user_chrome(request):
+    """base.html で使うログインユーザーの表示設定(アイコン・文字の大きさ・背景色)を chrome として渡す
+
+    テンプレートで使われたときだけキャッシュを読む（管理画面などでは読まない）。
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    user_id = user.pk
+    return {'chrome': SimpleLazyObject(lambda: avatars.chrome(user_id))}
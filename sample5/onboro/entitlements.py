@@ -0,0 +1,105 @@
+"""閲覧権限(購入済み書籍)のキャッシュ
+
+ユーザーごとに購入済み書籍IDの集合をキャッシュし、章を開くたびにDBへ問い合わせないようにする。
+キーにはユーザーごとのバージョン番号を含め、購入や取引記録の編集があったら
+バージョンを上げて古い集合を使わないようにする。
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# 何回の確認ごとにヒット率をログに出すか
+STATS_LOG_INTERVAL = 1000
+
+_stats = {'hits': 0, 'misses': 0}
+
+
+def get_cache():
+    try:
+        return caches[getattr(settings, 'ENTITLEMENT_CACHE_ALIAS', 'entitlements')]
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def _version_key(user_id):
+    return f'onboro:entitlements:{user_id}:version'
+
+
+def _new_version():
+    # バージョンのキーはキャッシュの上限で消されることがある。1からやり直すと、まだ残っている
+    # 古いバージョン(v1など)の集合を使ってしまうので、これまでのどの番号よりも大きい現在時刻(ns)から始める
+    return time.time_ns()
+
+
+def _user_version(cache, user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        version = _new_version()
+        cache.add(_version_key(user_id), version, timeout=None)
+        version = cache.get(_version_key(user_id), version)
+    return version
+
+
+def owned_book_ids(user):
+    """購入済み書籍IDの集合（キャッシュにあればDBは使わない）"""
+    from .models import Ownership
+
+    cache = get_cache()
+    key = f'onboro:entitlements:{user.pk}:v{_user_version(cache, user.pk)}'
+    book_ids = cache.get(key)
+    if book_ids is None:
+        _record(hit=False)
+        book_ids = frozenset(Ownership.objects.filter(user_id=user.pk).values_list('book_id', flat=True))
+        cache.set(key, book_ids, timeout=getattr(settings, 'ENTITLEMENT_CACHE_TIMEOUT', 3600))
+    else:
+        _record(hit=True)
+    return book_ids
+
+
+def owns(user, book_id):
+    return int(book_id) in owned_book_ids(user)
+
+
+def can_view(user, book_id):
+    if not user.is_authenticated:
+        return False
+    # スタッフはすべての書籍を閲覧できるのでキャッシュも見ない
+    if user.is_staff:
+        return True
+    return owns(user, book_id)
+
+
+def _bump(user_id):
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.add(_version_key(user_id), _new_version(), timeout=None)
+
+
+def invalidate(user_id):
+    # 購入などの変更が確定してからバージョンを上げる
+    transaction.on_commit(lambda: _bump(user_id))
+
+
+def _record(hit):
+    _stats['hits' if hit else 'misses'] += 1
+    total = _stats['hits'] + _stats['misses']
+    if total % STATS_LOG_INTERVAL == 0:
+        logger.info('entitlement cache: %(hits)d hits, %(misses)d misses, hit rate %(hit_rate).1f%%', stats())
+
+
+def stats():
+    """このプロセスでのヒット数・ミス数・ヒット率(%)"""
+    total = _stats['hits'] + _stats['misses']
+    return {
+        'hits': _stats['hits'],
+        'misses': _stats['misses'],
+        'hit_rate': _stats['hits'] * 100 / total if total else 0.0,
+    }
@@ -0,0 +1,108 @@
+"""zlibで圧縮して保存する文章のフィールド
+
+章の本文(Chapter.body)とページのHTML(ChapterPage.html)はDBのほとんどを占めるので、圧縮したバイト列(BLOB)で保存する。
+読み出したときは圧縮したまま(CompressedText)モデルに持たせ、属性を読んだときに初めて展開する。
+一覧や目次のように本文を使わないところでは展開しない。
+
+values()・values_list() で読んだときは CompressedText のままなので、str() で展開する。
+圧縮したバイト列には LIKE(__contains など)が効かないので、本文の検索は search.py の全文検索インデックスを使う。
+"""
+import zlib
+
+from django import forms
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+# zlibの圧縮レベル（6が既定。上げても本文ではほとんど小さくならず、保存が遅くなる）
+COMPRESSION_LEVEL = 6
+
+
+def compress(text):
+    return zlib.compress(text.encode(), COMPRESSION_LEVEL)
+
+
+def decompress(data):
+    return zlib.decompress(data).decode()
+
+
+class CompressedText:
+    """DBから読んだ、まだ展開していない文章（str() で展開する）"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = bytes(data)
+
+    def __str__(self):
+        return decompress(self.data)
+
+    def __repr__(self):
+        return f'<CompressedText: {len(self.data)} bytes>'
+
+    def __eq__(self, other):
+        return isinstance(other, CompressedText) and self.data == other.data
+
+    def __hash__(self):
+        return hash(self.data)
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    """属性を読んだときに展開し、展開した文章をインスタンスに持たせる"""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, CompressedText):
+            value = str(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # DeferredAttribute は __get__ だけなので、インスタンスの __dict__ に値があると呼ばれない。
+        # __set__ も持たせて(データディスクリプタにして)、読むたびに __get__ を通す
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.Field):
+    description = '圧縮して保存する文章'
+    descriptor_class = CompressedTextDescriptor
+
+    def get_internal_type(self):
+        return 'BinaryField'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return CompressedText(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return None
+        # 読んだまま展開していなければ、圧縮し直さずにそのまま保存する
+        if isinstance(value, CompressedText):
+            return value.data
+        return compress(str(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super().get_db_prep_value(value, connection, prepared)
+        if value is not None:
+            return connection.Database.Binary(value)
+        return value
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def formfield(self, **kwargs):
+        # 管理画面などでは TextField と同じように文字列で編集する
+        return super().formfield(**{
+            'form_class': forms.CharField,
+            'widget': forms.Textarea,
+            **kwargs,
+        })
+
@@ -8,6 +8,25 @@ class UserImportForm(forms.Form):
         widget=forms.FileInput(attrs={'accept': 'text/csv'})
     )
 
+class BulkChargeForm(forms.Form):
+    file = forms.FileField(
+        label='CSVファイル(username,amount)',
+        widget=forms.FileInput(attrs={'accept': 'text/csv'})
+    )
+    chunk_size = forms.IntegerField(label='一度に処理する行数', initial=1000, min_value=1, max_value=10000)
+    all_or_nothing = forms.BooleanField(label='1行でもエラーがあれば何もチャージしない', required=False)
+
+class SalesReportForm(forms.Form):
+    start = forms.DateField(label='開始日', required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(label='終了日', required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end and start > end:
+            raise forms.ValidationError('開始日は終了日より前にしてください。')
+        return cleaned_data
+
 class CustomSettingForm(forms.ModelForm):
     class Meta:
         model = UserProfile
@@ -0,0 +1,264 @@
+"""CSVからの一括処理（スタッフ用）
+
+ファイルは1行ずつ読みながら一定件数(チャンク)ごとにまとめてDBへ書き込むので、
+数万行のファイルでも1行ごとにクエリを発行しない。
+"""
+import codecs
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
+from . import ledger, passwords
+from .models import User, UserProfile
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class ImportResult:
+    def __init__(self):
+        self.succeeded = 0
+        # (行番号, メッセージ) のリスト
+        self.errors = []
+        # 処理にかかった秒数
+        self.elapsed = 0.0
+
+    def add_error(self, line, message):
+        self.errors.append((line, message))
+
+    @property
+    def rows_per_second(self):
+        rows = self.succeeded + len(self.errors)
+        return rows / self.elapsed if self.elapsed else 0.0
+
+
+def _chunks(reader, size):
+    # 見出し行が1行目なので、データは2行目から数える
+    rows = enumerate(reader, start=2)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def charge_coins_from_csv(file, chunk_size=DEFAULT_CHUNK_SIZE, all_or_nothing=False, progress=None):
+    """username,amount のCSVを読み、各ユーザーにコインをチャージする
+
+    all_or_nothing=Trueなら1行でもエラーがあれば何もチャージしない。
+    Falseならエラーの行だけを飛ばしてチャージする。
+    progressを渡すと、チャンクごとに途中経過のImportResultを渡して呼び出す。
+    """
+    reader = csv.DictReader(codecs.iterdecode(file, 'utf-8'))
+    result = ImportResult()
+    started = time.perf_counter()
+    if all_or_nothing:
+        _charge_all_or_nothing(reader, chunk_size, result, progress)
+    else:
+        for chunk in _chunks(reader, chunk_size):
+            charges = _parse_charge_chunk(chunk, result)
+            ledger.bulk_charge(charges)
+            result.succeeded += len(charges)
+            if progress:
+                progress(result)
+    result.errors.sort()
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def _charge_all_or_nothing(reader, chunk_size, result, progress):
+    # ファイル全体を1つのトランザクションにすると、途中経過を書き込んでも確定するまで他の接続
+    # (状態確認のエンドポイント)から見えない。先にファイル全体を確かめて途中経過を報告し、
+    # エラーがなければチャージだけを1つのトランザクションで行う。
+    # 確かめている間の「成功」は、エラーがなければチャージされる行の数
+    charges = []
+    for chunk in _chunks(reader, chunk_size):
+        parsed = _parse_charge_chunk(chunk, result)
+        charges.extend(parsed)
+        result.succeeded += len(parsed)
+        if progress:
+            progress(result)
+    if result.errors:
+        result.succeeded = 0
+        return
+    with transaction.atomic():
+        for start in range(0, len(charges), chunk_size):
+            ledger.bulk_charge(charges[start:start + chunk_size])
+
+
+def _parse_charge_chunk(chunk, result):
+    """チャンクの行を (user_id, amount) の並びにする（エラーの行は result に記録して飛ばす）"""
+    parsed = []
+    for line, row in chunk:
+        username = (row.get('username') or '').strip()
+        try:
+            amount = int(row.get('amount') or '')
+        except ValueError:
+            result.add_error(line, f'金額が数値ではありません: {row.get("amount")!r}')
+            continue
+        if amount <= 0:
+            result.add_error(line, f'金額は1以上にしてください: {amount}')
+            continue
+        parsed.append((line, username, amount))
+
+    # ユーザー名はチャンクごとにIN句1回で解決する
+    user_ids = dict(User.objects.filter(username__in={username for _, username, _ in parsed})
+                    .values_list('username', 'pk'))
+    charges = []
+    for line, username, amount in parsed:
+        if username not in user_ids:
+            result.add_error(line, f'ユーザーが見つかりません: {username!r}')
+            continue
+        charges.append((user_ids[username], amount))
+    return charges
+
+
+def run_coin_bulk_charge_job(job):
+    """ジョブキュー(jobs.py)から呼ばれる一括チャージ"""
+    from . import jobs
+
+    with job.file.open('rb') as file:
+        return charge_coins_from_csv(
+            file,
+            chunk_size=job.payload.get('chunk_size', DEFAULT_CHUNK_SIZE),
+            all_or_nothing=job.payload.get('all_or_nothing', False),
+            progress=lambda result: jobs.report_progress(job, result),
+        )
+
+
+@contextmanager
+def _password_hasher(workers):
+    """パスワードのリストをハッシュ化する関数を返す。workersが2以上ならプロセスプールで並列に計算する
+
+    PBKDF2は1件で数百ミリ秒かかるCPU処理なので、スレッドではなくプロセスに分ける。
+    子プロセスはforkではなくspawnで起動する。ジョブのワーカーではハートビートのスレッド(jobs.py)が動いていて、
+    forkした瞬間にそのスレッドが持っていたDB接続やログのロックを、使いかけのまま子プロセスが引き継ぐことがある。
+    """
+    if workers <= 1:
+        yield lambda values: [passwords.hash_password(value) for value in values]
+        return
+
+    pool = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn'), initializer=passwords.init_worker,
+    )
+    with pool:
+        def hash_passwords(values):
+            chunksize = max(1, len(values) // (workers * 4))
+            return list(pool.map(passwords.hash_password, values, chunksize=chunksize))
+        yield hash_passwords
+
+
+def import_users_from_csv(file, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, progress=None):
+    """username,password,is_active(,email,first_name,last_name) のCSVからユーザーを作る
+
+    チャンクごとに、ユーザー名の重複をIN句1回で確認し、パスワードをプロセスプールでハッシュ化し、
+    ユーザーとUserProfileをbulk_createで作る。エラーの行は飛ばして行番号とともに報告する。
+    progressを渡すと、チャンクごとに途中経過のImportResultを渡して呼び出す。
+    """
+    reader = csv.DictReader(codecs.iterdecode(file, 'utf-8'))
+    result = ImportResult()
+    started = time.perf_counter()
+    # ファイルの中での重複を見つけるため、チャンクをまたいで覚えておく
+    seen = set()
+    with _password_hasher(workers or os.cpu_count() or 1) as hash_passwords:
+        for chunk in _chunks(reader, chunk_size):
+            _import_user_chunk(chunk, result, seen, hash_passwords)
+            if progress:
+                progress(result)
+    result.errors.sort()
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def _parse_user_row(row):
+    """CSVの1行をUserのフィールドにする。不正な値ならValidationErrorを送出する"""
+    username = User.normalize_username((row.get('username') or '').strip())
+    if not username:
+        raise ValidationError('ユーザー名がありません')
+    User._meta.get_field('username').run_validators(username)
+
+    is_active = (row.get('is_active') or '1').strip()
+    if is_active not in ('0', '1'):
+        raise ValidationError(f'is_activeは0か1にしてください: {is_active!r}')
+
+    return {
+        'username': username,
+        'is_active': is_active == '1',
+        'email': User.objects.normalize_email((row.get('email') or '').strip()),
+        'first_name': (row.get('first_name') or '').strip(),
+        'last_name': (row.get('last_name') or '').strip(),
+    }
+
+
+def _import_user_chunk(chunk, result, seen, hash_passwords):
+    parsed = []
+    for line, row in chunk:
+        try:
+            fields = _parse_user_row(row)
+        except ValidationError as e:
+            result.add_error(line, ' '.join(e.messages))
+            continue
+        if fields['username'] in seen:
+            result.add_error(line, f'ファイルの中でユーザー名が重複しています: {fields["username"]!r}')
+            continue
+        seen.add(fields['username'])
+        parsed.append((line, fields, row.get('password')))
+
+    # すでにあるユーザー名はチャンクごとにIN句1回で確認する
+    existing = set(User.objects.filter(username__in=[fields['username'] for _, fields, _ in parsed])
+                   .values_list('username', flat=True))
+    rows = []
+    for line, fields, password in parsed:
+        if fields['username'] in existing:
+            result.add_error(line, f'ユーザー名はすでに使われています: {fields["username"]!r}')
+            continue
+        rows.append((line, fields, password))
+    if not rows:
+        return
+
+    hashes = hash_passwords([password for _, _, password in rows])
+    users = [(line, User(password=hashed, **fields)) for (line, fields, _), hashed in zip(rows, hashes)]
+    try:
+        with transaction.atomic():
+            _create_users([user for _, user in users])
+        result.succeeded += len(users)
+    except IntegrityError:
+        # 確認した後に同じユーザー名が作られた場合など。1行ずつ作り直して、失敗した行だけを報告する
+        for line, user in users:
+            user.pk = None
+            user._state.adding = True
+            try:
+                with transaction.atomic():
+                    _create_users([user])
+                result.succeeded += 1
+            except IntegrityError:
+                result.add_error(line, f'ユーザー名はすでに使われています: {user.username!r}')
+
+
+def _create_users(users):
+    # bulk_createではpost_saveが呼ばれないので、UserProfileもここで作る
+    User.objects.bulk_create(users)
+    if any(user.pk is None for user in users):
+        # 作ったIDを返せないDBでは、ユーザー名から引き直す
+        ids = dict(User.objects.filter(username__in=[user.username for user in users]).values_list('username', 'pk'))
+        for user in users:
+            user.pk = ids[user.username]
+    UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+
+
+def run_user_import_job(job):
+    """ジョブキュー(jobs.py)から呼ばれるユーザーのインポート"""
+    from . import jobs
+
+    with job.file.open('rb') as file:
+        return import_users_from_csv(
+            file,
+            chunk_size=job.payload.get('chunk_size', DEFAULT_CHUNK_SIZE),
+            progress=lambda result: jobs.report_progress(job, result),
+        )
@@ -0,0 +1,185 @@
+"""DBを使った簡単なジョブキュー
+
+重い処理はJobとして登録してすぐにレスポンスを返し、run_jobs コマンドのワーカーが実行する。
+外部のブローカー(Redisなど)はいらない。
+
+ワーカーは複数のプロセスで動かしてよい。待機中のジョブは行ロック(SELECT ... FOR UPDATE SKIP LOCKED)
+と「待機中なら実行中にする」条件付きUPDATEで取り出すので、同じジョブを2つのワーカーが実行することはない。
+
+実行中のジョブは HEARTBEAT_INTERVAL 秒ごとに heartbeat_at を更新する。ワーカーが強制終了される(OOM・SIGKILL・デプロイ)と
+更新が止まるので、STALE_AFTER 秒以上更新のない実行中のジョブは、次にジョブを取り出すときに失敗にする。
+インポートやチャージは途中まで反映されていることがあり、やり直すと二重に処理するので、待機中には戻さない。
+
+ジョブの種類ごとの処理は HANDLERS に「種類: 関数のパス」で登録する。
+関数は job を受け取り、途中経過は report_progress() で、結果は返り値のImportResultなどで返す。
+"""
+import datetime
+import logging
+import threading
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {
+    'user_import': 'onboro.imports.run_user_import_job',
+    'coin_bulk_charge': 'onboro.imports.run_coin_bulk_charge_job',
+}
+
+# ジョブに保存するエラーの最大件数（件数そのものは error_count に入る）
+MAX_STORED_ERRORS = 1000
+
+# 実行中のジョブの heartbeat_at を更新する間隔(秒)
+HEARTBEAT_INTERVAL = 30
+
+# これだけの秒数 heartbeat_at が更新されていない実行中のジョブは、ワーカーが止まったものとする
+STALE_AFTER = 300
+
+
+def enqueue(kind, payload=None, file=None, user=None):
+    """ジョブを登録する。実行はワーカーが行う"""
+    from .models import Job
+
+    if kind not in HANDLERS:
+        raise ValueError(f'unknown job kind: {kind}')
+    job = Job(kind=kind, payload=payload or {}, created_by=user)
+    if file is not None:
+        job.file.save(file.name, file, save=False)
+    job.save()
+    return job
+
+
+def claim(worker):
+    """待機中のジョブを1つ取り出して実行中にする（なければNone）"""
+    from .models import Job
+
+    fail_stale()
+    with transaction.atomic():
+        queued = Job.objects.filter(status=Job.Status.QUEUED).order_by('pk')
+        if connection.features.has_select_for_update_skip_locked:
+            # 他のワーカーがロックしている行は飛ばして次のジョブを取る
+            queued = queued.select_for_update(skip_locked=True)
+        job = queued.first()
+        if job is None:
+            return None
+        # 行ロックのないDBでも、待機中のままのときだけ実行中にできる
+        claimed = Job.objects.filter(pk=job.pk, status=Job.Status.QUEUED).update(
+            status=Job.Status.RUNNING, worker=worker, started_at=timezone.now(), heartbeat_at=timezone.now(),
+        )
+    if not claimed:
+        return None
+    job.refresh_from_db()
+    return job
+
+
+def fail_stale(stale_after=STALE_AFTER):
+    """ワーカーが止まって heartbeat_at が更新されなくなった実行中のジョブを失敗にし、その件数を返す"""
+    from .models import Job
+
+    now = timezone.now()
+    limit = now - datetime.timedelta(seconds=stale_after)
+    stale = Job.objects.filter(status=Job.Status.RUNNING).filter(
+        Q(heartbeat_at__lt=limit) | Q(heartbeat_at__isnull=True, started_at__lt=limit)
+    )
+    failed = 0
+    for job in stale.only('pk', 'file', 'worker'):
+        # 確かめてから更新するまでの間に応答のあったジョブは失敗にしない
+        if not stale.filter(pk=job.pk).update(
+            status=Job.Status.FAILED, finished_at=now,
+            message=f'ワーカー {job.worker} からの応答が{stale_after}秒以上なかったため中断しました',
+        ):
+            continue
+        logger.warning('job %s failed: worker %s stopped responding', job.pk, job.worker)
+        failed += 1
+        if job.file:
+            job.file.delete(save=False)
+    return failed
+
+
+class _Heartbeat(threading.Thread):
+    """ジョブの実行中、一定の間隔で heartbeat_at を更新する"""
+
+    def __init__(self, job_id, interval=HEARTBEAT_INTERVAL):
+        super().__init__(daemon=True)
+        self.job_id = job_id
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        from .models import Job
+
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    Job.objects.filter(pk=self.job_id, status=Job.Status.RUNNING).update(heartbeat_at=timezone.now())
+                except DatabaseError:
+                    # SQLiteでジョブが書き込み中でロックを待ちきれなかったときなど。次の回にまた更新する
+                    logger.warning('could not update heartbeat of job %s', self.job_id, exc_info=True)
+        finally:
+            # このスレッドのDB接続は使い回さないので閉じる
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def report_progress(job, result):
+    """途中経過(ImportResult)をジョブに書き込む。状態確認のエンドポイントから読める"""
+    from .models import Job
+
+    job.processed = result.succeeded + len(result.errors)
+    job.succeeded = result.succeeded
+    job.error_count = len(result.errors)
+    job.errors = [list(error) for error in sorted(result.errors)[:MAX_STORED_ERRORS]]
+    Job.objects.filter(pk=job.pk).update(
+        processed=job.processed, succeeded=job.succeeded, error_count=job.error_count, errors=job.errors,
+        heartbeat_at=timezone.now(),
+    )
+
+
+def run(job):
+    """取り出したジョブを実行し、終わったら完了か失敗にする"""
+    from .models import Job
+
+    heartbeat = _Heartbeat(job.pk)
+    heartbeat.start()
+    try:
+        handler = import_string(HANDLERS[job.kind])
+        result = handler(job)
+        if result is not None:
+            report_progress(job, result)
+        job.status = Job.Status.SUCCEEDED
+    except Exception as e:
+        logger.exception('job %s failed', job.pk)
+        job.status = Job.Status.FAILED
+        job.message = f'{type(e).__name__}: {e}'
+    finally:
+        heartbeat.stop()
+        # アップロードされたファイル(パスワードを含むことがある)は実行後に残さない
+        if job.file:
+            job.file.delete(save=False)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'message', 'file', 'finished_at'])
+    return job
+
+
+def status(job):
+    """状態確認のエンドポイントで返す内容"""
+    return {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'processed': job.processed,
+        'succeeded': job.succeeded,
+        'error_count': job.error_count,
+        'errors': job.errors,
+        'message': job.message,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
@@ -0,0 +1,187 @@
+"""コイン残高の増減をまとめたモジュール
+
+残高(User.coin)の変更はすべてここを通す。Pythonで読んで書き戻すのではなく
+UPDATE ... SET coin = coin - n WHERE coin >= n の1文で行うので、
+同じユーザーの同時リクエスト(複数タブ・再送・複数ワーカー)でも更新が失われず、
+残高がマイナスになることもない。
+
+TransactionRecord.save() から apply_record() が呼ばれるので、
+ビューからでも管理画面からでも、1件の取引記録につき残高は1回だけ反映される。
+売上の日次集計(rollups)も同じトランザクションの中で更新する。
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import BigIntegerField, Case, F, Value, When
+from django.utils import timezone
+
+from . import rollups
+
+
+class InsufficientCoins(Exception):
+    pass
+
+
+class AlreadyOwned(Exception):
+    pass
+
+
+def signed_amount(kind, amount):
+    """取引種別に応じて残高に足す量(マイナスなら減らす量)"""
+    from .models import TransactionRecord
+
+    if kind in (TransactionRecord.Kind.CHARGE, TransactionRecord.Kind.CHANGE_PLUS):
+        return amount
+    if kind in (TransactionRecord.Kind.USE, TransactionRecord.Kind.CHANGE_MINUS):
+        return -amount
+    return 0
+
+
+def signed_amount_expression():
+    """signed_amount をSQLで計算する式（集計に使う）"""
+    from .models import TransactionRecord
+
+    Kind = TransactionRecord.Kind
+    return Case(
+        When(kind__in=[Kind.CHARGE, Kind.CHANGE_PLUS], then=F('amount')),
+        When(kind__in=[Kind.USE, Kind.CHANGE_MINUS], then=-F('amount')),
+        default=Value(0),
+        output_field=BigIntegerField(),
+    )
+
+
+def _change_balance(user_id, delta):
+    from .models import User
+
+    if delta == 0:
+        return
+    users = User.objects.filter(pk=user_id)
+    if delta < 0:
+        # 残高が足りるときだけ減らす（足りなければ1行も更新されない）
+        users = users.filter(coin__gte=-delta)
+    if users.update(coin=F('coin') + delta) == 0:
+        raise InsufficientCoins()
+
+
+def _original(record, for_update=False):
+    """編集前の取引記録（新規ならNone）"""
+    from .models import TransactionRecord
+
+    if record.pk is None:
+        return None
+    originals = TransactionRecord.objects.all()
+    if for_update:
+        originals = originals.select_for_update()
+    return originals.get(pk=record.pk)
+
+
+def _balance_changes(original, record):
+    changes = {}
+    if original is not None:
+        changes[original.user_id] = -signed_amount(original.kind, original.amount)
+    changes[record.user_id] = changes.get(record.user_id, 0) + signed_amount(record.kind, record.amount)
+    return changes
+
+
+def balance_changes(record, for_update=False):
+    """取引記録を保存したときの、ユーザーごとの残高の増減 {user_id: 増減} を返す
+
+    新規なら記録の分だけ、編集なら元の記録の分を取り消してから新しい記録の分を反映する。
+    """
+    return _balance_changes(_original(record, for_update), record)
+
+
+def apply_record(record):
+    """取引記録の保存に合わせて残高と売上集計を増減する（TransactionRecord.save()の中から呼ばれる）"""
+    from .models import TransactionRecord
+
+    original = _original(record, for_update=True)
+    changes = _balance_changes(original, record)
+    # 増やす方を先に反映し、減らす方で残高が足りなければトランザクションごと取り消す
+    for user_id, delta in sorted(changes.items(), key=lambda item: -item[1]):
+        _change_balance(user_id, delta)
+
+    if record.pk is not None:
+        _shift_checkpoints(record, changes)
+    rollups.apply(original, record)
+
+    # メモリ上のユーザーも最新の残高にしておく（古い値で上書き保存されないように）
+    if TransactionRecord.user.is_cached(record):
+        record.user.refresh_from_db(fields=['coin'])
+
+
+def _shift_checkpoints(record, changes):
+    """チェックポイントに含まれている記録を編集したら、チェックポイントの残高も同じだけずらす"""
+    from .models import BalanceCheckpoint
+
+    for user_id, delta in changes.items():
+        if delta:
+            (BalanceCheckpoint.objects
+             .filter(user_id=user_id, last_record_id__gte=record.pk)
+             .update(balance=F('balance') + delta))
+
+
+def charge(user, amount, kind=None):
+    """コインをチャージする（修正補填・修正除去もkindを指定してここから行う）"""
+    from .models import TransactionRecord
+
+    record = TransactionRecord(
+        user=user,
+        kind=kind or TransactionRecord.Kind.CHARGE,
+        amount=amount,
+        datetime=timezone.now(),
+    )
+    record.save()
+    return record
+
+
+def purchase(user, book):
+    """書籍を購入する。残高不足ならInsufficientCoins、購入済みならAlreadyOwnedを送出する"""
+    from .models import TransactionRecord, Ownership
+
+    now = timezone.now()
+    with transaction.atomic():
+        # 先に所有を登録しておくと、同じ書籍の同時購入は一意制約で片方だけが通る
+        try:
+            with transaction.atomic():
+                Ownership.objects.create(user=user, book=book, datetime=now)
+        except IntegrityError:
+            raise AlreadyOwned()
+
+        record = TransactionRecord(
+            user=user,
+            book=book,
+            kind=TransactionRecord.Kind.USE,
+            amount=book.price,
+            datetime=now,
+        )
+        record.save()
+    return record
+
+
+def bulk_charge(charges, now=None):
+    """(user_id, amount) の並びをまとめてチャージする
+
+    取引記録はbulk_createで作り、残高はユーザーごとの合計をCASE式のUPDATE 1文で加算する。
+    apply_record() と同じく、残高を更新して(ユーザーの行をロックして)から取引記録を作る。
+    先に取引記録を作ると、確定前のその記録より大きいIDまでを照合済みとするチェックポイントが
+    作られることがあり(reconcile_coins)、その記録が照合から漏れる。
+    """
+    from .models import User, TransactionRecord
+
+    now = now or timezone.now()
+    totals = {}
+    for user_id, amount in charges:
+        totals[user_id] = totals.get(user_id, 0) + amount
+    if not totals:
+        return []
+
+    with transaction.atomic():
+        User.objects.filter(pk__in=totals).update(coin=F('coin') + Case(
+            *(When(pk=user_id, then=Value(total)) for user_id, total in totals.items()),
+            default=Value(0),
+        ))
+        records = TransactionRecord.objects.bulk_create([
+            TransactionRecord(user_id=user_id, kind=TransactionRecord.Kind.CHARGE, amount=amount, datetime=now)
+            for user_id, amount in charges
+        ])
+        rollups.apply_bulk(records)
+    return records
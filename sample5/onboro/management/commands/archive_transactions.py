@@ -0,0 +1,36 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from onboro import archive
+
+
+class Command(BaseCommand):
+    help = ('締めた月の取引記録をアーカイブのテーブルへ移します。'
+            '1バッチごとにトランザクションを分けるので、実行中も購入・チャージは止まりません')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=archive.DEFAULT_KEEP_MONTHS,
+                            help='今月を含めて何か月分を取引記録のテーブルに残すか')
+        parser.add_argument('--batch-size', type=int, default=archive.DEFAULT_BATCH_SIZE)
+        parser.add_argument('--sleep', type=float, default=0.0, help='バッチの間に待つ秒数')
+
+    def handle(self, *args, **options):
+        if options['keep_months'] < 1:
+            raise CommandError('--keep-months は1以上にしてください。')
+
+        before = archive.cutoff(options['keep_months'])
+        self.stdout.write(f'{before:%Y-%m-%d} より前の取引記録を移します。')
+        moved = Counter()
+        while True:
+            batch = archive.archive_batch(before, options['batch_size'])
+            if not batch:
+                break
+            moved.update(batch)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        for month in sorted(moved):
+            self.stdout.write(f'  {month:%Y-%m}: {moved[month]}件')
+        self.stdout.write(self.style.SUCCESS(f'{sum(moved.values())}件の取引記録をアーカイブへ移しました。'))
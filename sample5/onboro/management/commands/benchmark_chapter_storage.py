@@ -0,0 +1,88 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from onboro.fields import compress, decompress
+from onboro.models import Chapter
+
+# DBに章がないときに使う架空の本文の部品
+SENTENCES = [
+    'Pythonはプログラミング言語のひとつです。',
+    'Djangoのビューはリクエストを受け取ってレスポンスを返します。',
+    'テンプレートには変数とタグとフィルターが書けます。',
+    'モデルのフィールドはデータベースの列に対応します。',
+    'この章では、前の章で作ったアプリケーションに機能を追加していきます。',
+    'for文を使うと、リストの要素を順に取り出して処理できます。',
+]
+
+
+class Command(BaseCommand):
+    help = '章の本文をそのまま保存した場合と圧縮して保存した場合の、DBの大きさと読み書きの時間を比べます（一時的なSQLiteファイルを使います）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000, help='書き込む章の数（DBの章を繰り返して使う）')
+        parser.add_argument('--reads', type=int, default=2000)
+        parser.add_argument('--synthetic-chars', type=int, default=30000, help='DBに章がないときの架空の本文の文字数')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        bodies = [str(body) for body in Chapter.objects.order_by('pk').values_list('body', flat=True)[:options['rows']]]
+        if not bodies:
+            bodies = [self.synthetic_body(rng, options['synthetic_chars']) for _ in range(20)]
+        bodies = [bodies[i % len(bodies)] for i in range(options['rows'])]
+        ids = [rng.randint(1, len(bodies)) for _ in range(options['reads'])]
+
+        with tempfile.TemporaryDirectory() as directory:
+            for label, encode, decode in [
+                ('plain', lambda text: text, lambda value: value),
+                ('zlib', compress, decompress),
+            ]:
+                path = os.path.join(directory, f'{label}.sqlite3')
+                write_seconds = self.write(path, bodies, encode)
+                timings = self.read(path, ids, decode)
+                p50 = statistics.median(timings)
+                p99 = timings[int(len(timings) * 0.99) - 1]
+                self.stdout.write(
+                    f'{label:5}  size: {os.path.getsize(path) / 1024 / 1024:.1f}MB  '
+                    f'write: {write_seconds:.2f}s ({write_seconds / len(bodies) * 1e3:.2f}ms/row)  '
+                    f'read p50: {p50:.0f}us  p99: {p99:.0f}us'
+                )
+
+    def synthetic_body(self, rng, chars):
+        paragraphs, length = [], 0
+        while length < chars:
+            paragraph = ''.join(rng.choice(SENTENCES) for _ in range(rng.randint(2, 6)))
+            paragraphs.append(paragraph)
+            length += len(paragraph)
+        return '\n\n'.join(paragraphs)
+
+    def write(self, path, bodies, encode):
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE chapter (id INTEGER PRIMARY KEY, body)')
+        started = time.perf_counter()
+        with connection:
+            connection.executemany('INSERT INTO chapter (id, body) VALUES (?, ?)', (
+                (i, encode(body)) for i, body in enumerate(bodies, start=1)
+            ))
+        seconds = time.perf_counter() - started
+        connection.execute('VACUUM')
+        connection.close()
+        return seconds
+
+    def read(self, path, ids, decode):
+        connection = sqlite3.connect(path)
+        timings = []
+        for pk in ids:
+            started = time.perf_counter()
+            body, = connection.execute('SELECT body FROM chapter WHERE id = ?', [pk]).fetchone()
+            decode(body)
+            timings.append((time.perf_counter() - started) * 1e6)
+        connection.close()
+        timings.sort()
+        return timings
@@ -0,0 +1,49 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from onboro.suggest import PrefixIndex
+
+# 架空のタイトルを作るための部品
+WORDS = [
+    'パイソン', 'ジャンゴ', 'プログラミング', 'ウェブ', 'データ', '入門', '実践', '基礎',
+    'アルゴリズム', '設計', 'python', 'django', 'sql', 'はじめての', 'やさしい', '図解',
+    '機械学習', '統計', '開発', 'テスト', 'クラウド', 'セキュリティ', 'ネットワーク', '完全ガイド',
+]
+
+
+class Command(BaseCommand):
+    help = 'サジェスト用インデックスの検索時間を計測します（DBは使いません）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=int, default=500000)
+        parser.add_argument('--queries', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        titles = [
+            ''.join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))) + f' {i}'
+            for i in range(options['titles'])
+        ]
+
+        started = time.perf_counter()
+        index = PrefixIndex()
+        index.build(enumerate(titles, start=1))
+        build_seconds = time.perf_counter() - started
+
+        # 入力途中を想定して、既存タイトルの先頭1〜4文字を問い合わせる
+        prefixes = [rng.choice(titles)[:rng.randint(1, 4)] for _ in range(options['queries'])]
+        timings = []
+        for prefix in prefixes:
+            started = time.perf_counter()
+            index.lookup(prefix)
+            timings.append((time.perf_counter() - started) * 1e6)
+
+        timings.sort()
+        p50 = statistics.median(timings)
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        self.stdout.write(f'titles: {len(index)}  build: {build_seconds:.2f}s')
+        self.stdout.write(f'lookup p50: {p50:.1f}us  p99: {p99:.1f}us  max: {timings[-1]:.1f}us')
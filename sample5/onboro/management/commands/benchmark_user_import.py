@@ -0,0 +1,64 @@
+import csv
+import io
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from onboro import imports
+from onboro.management.testdb import throwaway_database
+from onboro.models import User, UserProfile
+
+
+def _csv_file(prefix, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['username', 'password', 'is_active'])
+    for i in range(rows):
+        writer.writerow([f'{prefix}-{i}', f'p@s$w0rD-{i}', i % 2])
+    return io.BytesIO(buffer.getvalue().encode())
+
+
+class Command(BaseCommand):
+    help = ('ユーザーCSVのインポートの速さ(行/秒)を、1行ずつcreate_userする従来の方法と比べます'
+            '（テスト用DBを作って実行します）')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200)
+        parser.add_argument('--chunk-size', type=int, default=imports.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--workers', type=int, default=None, help='パスワードをハッシュ化するプロセス数（既定はCPU数）')
+        parser.add_argument('--fast-hasher', action='store_true',
+                            help='MD5でハッシュ化して、ハッシュ化以外の処理(DBへの書き込みなど)だけを比べます')
+        parser.add_argument('--skip-legacy', action='store_true', help='従来の方法を計測しません')
+
+    def handle(self, *args, **options):
+        settings = {}
+        if options['fast_hasher']:
+            settings['PASSWORD_HASHERS'] = ['django.contrib.auth.hashers.MD5PasswordHasher']
+        with throwaway_database(), override_settings(**settings):
+            if not options['skip_legacy']:
+                self._report('従来(1行ずつcreate_user)', options['rows'], self._legacy(options['rows']))
+            result = imports.import_users_from_csv(
+                _csv_file('new', options['rows']),
+                chunk_size=options['chunk_size'],
+                workers=options['workers'],
+            )
+            self._report('一括インポート', options['rows'], result.elapsed)
+            if result.errors:
+                self.stdout.write(self.style.WARNING(f'エラー {len(result.errors)}件: {result.errors[:5]}'))
+            profiles = UserProfile.objects.filter(user__username__startswith='new-').count()
+            self.stdout.write(f'作成したユーザー: {result.succeeded}  UserProfile: {profiles}')
+
+    def _legacy(self, rows):
+        # 以前のuser_importビューと同じ処理
+        reader = csv.DictReader(io.StringIO(_csv_file('legacy', rows).getvalue().decode()))
+        started = time.perf_counter()
+        with transaction.atomic():
+            for row in reader:
+                row['is_active'] = bool(int(row['is_active']))
+                User.objects.create_user(**row)
+        return time.perf_counter() - started
+
+    def _report(self, label, rows, elapsed):
+        self.stdout.write(f'{label}: {rows}行 {elapsed:.2f}s ({rows / elapsed:.1f}行/秒)')
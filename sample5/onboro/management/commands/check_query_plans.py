@@ -0,0 +1,163 @@
+import random
+import re
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from onboro import archive, pagination
+from onboro.management.testdb import throwaway_database
+from onboro.models import Category, Book, Chapter, TransactionRecord, Ownership
+
+# 全件走査になっていないかを確認するテーブル
+WATCHED_TABLES = ['onboro_transactionrecord', 'onboro_archivedtransactionrecord', 'onboro_ownership']
+
+# どの環境でもプロセス内だけで完結するキャッシュにする（本番のキャッシュを使わない）
+LOCAL_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'query-plans-{alias}'}
+    for alias in ('default', 'search', 'entitlements')
+}
+
+
+class Command(BaseCommand):
+    help = ('テスト用DBにデータを入れ、views.pyと管理画面のよく使う処理で発行されるクエリをEXPLAINして、'
+            '取引記録・購入済み書籍のテーブルを全件走査しているクエリや、ORDER BY ... LIMIT を並べ替えで処理している'
+            'クエリがあれば失敗します')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=20000)
+        parser.add_argument('--verbose-plans', action='store_true')
+
+    def handle(self, *args, **options):
+        with throwaway_database(), override_settings(CACHES=LOCAL_CACHES, ALLOWED_HOSTS=['*']):
+            self._seed(options['records'])
+            failures = []
+            for name, scenario in self._scenarios():
+                with CaptureQueriesContext(connection) as queries:
+                    scenario()
+                failures += self._check(name, [q['sql'] for q in queries], options['verbose_plans'])
+
+        if failures:
+            raise CommandError('インデックスを使っていないクエリがあります:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('すべてのクエリがインデックスを使っています。'))
+
+    def _seed(self, records):
+        rng = random.Random(0)
+        User = get_user_model()
+        category = Category.objects.create(display_order=0, name='plan')
+        books = Book.objects.bulk_create(
+            Book(category=category, title=f'book-{i}', abstract='', price=100, published=True) for i in range(200)
+        )
+        Chapter.objects.create(book=books[0], number=1, title='1', body='body')
+        users = User.objects.bulk_create(User(username=f'user-{i}', coin=0) for i in range(50))
+        self.staff = User.objects.create(username='staff', is_staff=True, is_superuser=True)
+        self.reader = users[0]
+
+        now = timezone.now()
+        kinds = list(TransactionRecord.Kind)
+        batch = []
+        for i in range(records):
+            kind = rng.choice(kinds)
+            batch.append(TransactionRecord(
+                user=rng.choice(users),
+                book=rng.choice(books) if kind == TransactionRecord.Kind.USE else None,
+                kind=kind,
+                amount=rng.randint(1, 100),
+                datetime=now - timedelta(minutes=i),
+            ))
+        TransactionRecord.objects.bulk_create(batch, batch_size=2000)
+        # 古い半分はアーカイブへ移しておき、両方のテーブルを読むクエリも確認する
+        archive.archive_batch(now - timedelta(minutes=records // 2), batch_size=records)
+        Ownership.objects.bulk_create(
+            (Ownership(user=user, book=book, datetime=now) for user in users for book in rng.sample(books, 5)),
+            ignore_conflicts=True,
+        )
+        Ownership.objects.get_or_create(user=self.reader, book=books[0], defaults={'datetime': now})
+        self.book = books[0]
+        self.unowned_book = next(b for b in books if not Ownership.objects.filter(user=self.reader, book=b).exists())
+
+        # 統計情報を更新して、本番に近い実行計画にする
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _scenarios(self):
+        reader, staff = Client(), Client()
+        reader.force_login(self.reader)
+        staff.force_login(self.staff)
+        record = TransactionRecord.objects.filter(user=self.reader).order_by('-datetime', '-pk')[50]
+        history_cursor = pagination.encode_cursor([str(record.datetime), record.pk], 'n')
+        shelf_cursor = pagination.encode_cursor([self.book.pk], 'n')
+
+        return [
+            ('ホーム(本棚・取引履歴・集計)', lambda: reader.get('/')),
+            ('ホーム(取引履歴の深いページ)', lambda: reader.get('/', {'history_cursor': history_cursor})),
+            ('ホーム(本棚の次のページ)', lambda: reader.get('/', {'shelf_cursor': shelf_cursor})),
+            ('書籍詳細', lambda: reader.get(f'/books/{self.book.pk}')),
+            ('章の閲覧', lambda: reader.get(f'/books/{self.book.pk}/chapters/1')),
+            ('購入', lambda: reader.post(f'/users/{self.reader.pk}/transactions/use',
+                                        {'user': self.reader.pk, 'book': self.unowned_book.pk})),
+            ('チャージ', lambda: staff.post(f'/users/{self.reader.pk}/transactions/charge',
+                                          {'user': self.reader.pk, 'amount': 100})),
+            ('ユーザー詳細', lambda: staff.get(f'/users/{self.reader.pk}')),
+            ('管理画面: 取引記録一覧', lambda: staff.get('/admin/onboro/transactionrecord/')),
+            ('管理画面: 種別で絞り込み', lambda: staff.get('/admin/onboro/transactionrecord/', {'kind__exact': 'USE'})),
+            ('管理画面: 検索', lambda: staff.get('/admin/onboro/transactionrecord/', {'q': self.reader.username})),
+            ('管理画面: 日付で絞り込み', lambda: staff.get('/admin/onboro/transactionrecord/', {
+                'datetime__year': record.datetime.year, 'datetime__month': record.datetime.month})),
+            ('管理画面: アーカイブの検索', lambda: staff.get('/admin/onboro/archivedtransactionrecord/', {'q': 'book-199'})),
+            ('管理画面: 取引記録の編集', lambda: staff.get(f'/admin/onboro/transactionrecord/{record.pk}/change/')),
+            ('残高の照合', lambda: call_command('reconcile_coins', stdout=open('/dev/null', 'w'))),
+        ]
+
+    def _check(self, name, statements, verbose):
+        failures = []
+        for sql in statements:
+            if not re.match(r'\s*(SELECT|UPDATE|DELETE)\b', sql, re.IGNORECASE):
+                continue
+            if not any(table in sql for table in WATCHED_TABLES):
+                continue
+            # 絞り込みのないクエリも確認する（管理画面の一覧の ORDER BY ... LIMIT や、件数の見積もりの MIN・MAX は
+            # インデックスの順に読んで LIMIT で止まるはずで、インデックスがなくなると全件を読んで並べ替える）
+            plan = self._explain(sql)
+            if verbose:
+                self.stdout.write(f'[{name}] {sql}\n{plan}\n')
+            problems = [f'{table} を全件走査' for table in WATCHED_TABLES if self._is_full_scan(sql, plan, table)]
+            if self._sorts_for_limit(sql, plan):
+                problems.append('ORDER BY ... LIMIT を並べ替えで処理')
+            if problems:
+                failures.append(f'[{name}] {", ".join(problems)}: {sql}\n{plan}')
+        return failures
+
+    def _explain(self, sql):
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # データが少ないと順次走査が選ばれやすいので、インデックスが使えるかだけを見る
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+            else:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+
+    def _is_full_scan(self, sql, plan, table):
+        if connection.vendor == 'postgresql':
+            return re.search(rf'Seq Scan on {table}\b', plan) is not None
+        # SQLiteは「SEARCH テーブル」か「SCAN テーブル USING [COVERING] INDEX」ならインデックスを使っている。
+        # 「SCAN テーブル」だけなら全件走査だが、主キーの順に並べて LIMIT を付けたクエリは
+        # 主キー(rowid)の順に端から読んで止まるので全件は読まない
+        if not re.search(rf'\bSCAN {table}(?! USING (COVERING )?INDEX)\b', plan):
+            return False
+        return not (re.search(rf'\bORDER BY "{table}"\."id" (ASC|DESC) LIMIT\b', sql)
+                    and not self._sorts_for_limit(sql, plan))
+
+    def _sorts_for_limit(self, sql, plan):
+        """ORDER BY ... LIMIT をインデックスの順に読まずに、全件を並べ替えて処理しているか"""
+        if not re.search(r'\bORDER BY\b.*\bLIMIT\b', sql, re.DOTALL):
+            return False
+        if connection.vendor == 'postgresql':
+            return re.search(r'\bSort\b', plan) is not None
+        return re.search(r'USE TEMP B-TREE FOR (RIGHT PART OF |LAST TERM OF )?ORDER BY', plan) is not None
@@ -0,0 +1,53 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from onboro import storage
+
+
+class Command(BaseCommand):
+    help = ('ハッシュの名前にする前にアップロードされたファイルを、ハッシュの名前で保存し直して'
+            'フィールドの値を書き換えます。同じ中身のファイルは1つにまとまります')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-originals', action='store_true',
+                            help='書き換えたあと、どこからも参照されなくなった元のファイルを消します')
+
+    def handle(self, *args, **options):
+        uploads = storage.uploads()
+        adopted = {}
+        missing = set()
+        rows = Counter()
+        for model, field in storage.tracked_fields():
+            # ハッシュの名前でなく、空でもない値だけを対象にする
+            queryset = (model._default_manager.exclude(**{f'{field.name}__startswith': storage.PREFIX})
+                        .exclude(**{field.name: ''}).exclude(**{f'{field.name}__isnull': True}))
+            for name in queryset.order_by().values_list(field.name, flat=True).distinct():
+                if name not in adopted and name not in missing:
+                    if not uploads.exists(name):
+                        missing.add(name)
+                        continue
+                    adopted[name] = storage.adopt(name, uploads)
+                if name in adopted:
+                    with transaction.atomic():
+                        # 1行ずつ保存すると参照数はシグナルで数えられる
+                        for instance in queryset.filter(**{field.name: name}):
+                            setattr(instance, field.name, adopted[name])
+                            instance.save(update_fields=[field.name])
+                            rows[model._meta.label] += 1
+
+        for label, count in sorted(rows.items()):
+            self.stdout.write(f'  {label}: {count}行')
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(adopted)}件のファイルを{len(set(adopted.values()))}件にまとめました。'
+        ))
+        if missing:
+            self.stdout.write(self.style.WARNING(f'見つからないファイル(そのままにしました): {sorted(missing)}'))
+
+        if options['delete_originals']:
+            still_used = storage.referenced_names(list(adopted))
+            for name in adopted:
+                if name not in still_used:
+                    uploads.purge(name)
+            self.stdout.write(f'元のファイルを{len(set(adopted) - set(still_used))}件消しました。')
@@ -0,0 +1,31 @@
+import datetime as dt
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from onboro import storage
+from onboro.models import StoredFile
+
+
+class Command(BaseCommand):
+    help = ('どのフィールドからも参照されなくなったアップロードファイル(ハッシュの名前で保存したもの)と、'
+            'その縮小版を消します')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24.0,
+                            help='最後に保存されてからこの時間が経っていないファイルは、参照がなくても残します')
+        parser.add_argument('--recount', action='store_true',
+                            help='先に参照数をモデルの実際の値で数え直します（update()などで変えた場合）')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            fixed = storage.recount()
+            self.stdout.write(f'参照数を数え直しました（{fixed}件を修正）。')
+
+        older_than = timezone.now() - dt.timedelta(hours=options['grace_hours'])
+        deleted, size = storage.collect_garbage(older_than)
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件 ({size:,}バイト) のファイルを消しました。'))
+
+        remaining = StoredFile.objects.aggregate(files=Count('pk'), size=Sum('size'))
+        self.stdout.write(f'保存中のファイル: {remaining["files"]}件 ({remaining["size"] or 0:,}バイト)')
@@ -0,0 +1,24 @@
+import datetime as dt
+
+from django.core.management.base import BaseCommand
+
+from onboro import rollups
+
+
+def _date(value):
+    return dt.date.fromisoformat(value)
+
+
+class Command(BaseCommand):
+    help = ('取引記録から売上の日次集計(全体・書籍別・カテゴリ別)を作り直します。'
+            '期間を指定しなければすべての日を作り直します')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=_date, help='この日から作り直します (YYYY-MM-DD)')
+        parser.add_argument('--end', type=_date, help='この日まで作り直します (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        counts = rollups.rebuild(options['start'], options['end'])
+        for name, count in counts.items():
+            self.stdout.write(f'{name}: {count}行')
+        self.stdout.write(self.style.SUCCESS('売上の集計を作り直しました。'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from onboro import search
+from onboro.models import Book, Chapter
+
+
+class Command(BaseCommand):
+    help = '書籍の全文検索インデックスを作り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('全文検索インデックスがありません。migrateを実行してください。')
+
+        search.rebuild_index(Book, Chapter, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{Book.objects.count()}件の書籍を登録しました。'))
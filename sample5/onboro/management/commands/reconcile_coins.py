@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from onboro import ledger
+from onboro.models import User, TransactionRecord, ArchivedTransactionRecord, BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    help = ('ユーザーのコイン残高を取引記録と照合します。'
+            '前回のチェックポイント以降の取引記録だけを合計するので、毎晩実行しても短時間で終わります')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--repair', action='store_true', help='ずれていた残高を取引記録の合計に合わせて修正します')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = 0
+        drifts = []
+        last_pk = 0
+        while True:
+            user_ids = list(User.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not user_ids:
+                break
+            drifts += self._reconcile(user_ids, options['repair'])
+            checked += len(user_ids)
+            last_pk = user_ids[-1]
+
+        for user_id, coin, expected, repaired in drifts:
+            action = '修正しました' if repaired else '未修正'
+            self.stdout.write(self.style.WARNING(
+                f'user {user_id}: 残高 {coin} / 取引記録の合計 {expected} (差 {coin - expected}) {action}'
+            ))
+        self.stdout.write(f'{checked}人を照合し、{len(drifts)}人の残高にずれがありました。')
+
+    def _reconcile(self, user_ids, repair):
+        drifts = []
+        # ユーザー行をロックしておくと、照合中の購入・チャージは照合が終わるまで待つので
+        # 残高と取引記録の合計を同じ時点で比べられる（チェックポイント以降のIDの取りこぼしもない）
+        with transaction.atomic():
+            coins = dict(User.objects.select_for_update().filter(pk__in=user_ids).values_list('pk', 'coin'))
+            checkpoints = {cp.user_id: cp for cp in BalanceCheckpoint.objects.filter(user_id__in=user_ids)}
+
+            # チェックポイントより後の記録だけを、ユーザーごとに1回のクエリで合計する
+            # （アーカイブへ移した記録もIDはそのままなので、同じ条件で合計して足す）
+            last_record_id = BalanceCheckpoint.objects.filter(user=OuterRef('user_id')).values('last_record_id')
+            sums = {}
+            for model in (TransactionRecord, ArchivedTransactionRecord):
+                new_records = model.objects.filter(
+                    user_id__in=user_ids,
+                    pk__gt=Coalesce(Subquery(last_record_id), 0),
+                )
+                for row in new_records.order_by().values('user_id').annotate(
+                    delta=Sum(ledger.signed_amount_expression()), last_record_id=Max('pk')
+                ):
+                    total = sums.setdefault(row['user_id'], {'delta': 0, 'last_record_id': 0})
+                    total['delta'] += row['delta']
+                    total['last_record_id'] = max(total['last_record_id'], row['last_record_id'])
+
+            now = timezone.now()
+            updated = []
+            for user_id in user_ids:
+                checkpoint = checkpoints.get(user_id) or BalanceCheckpoint(user_id=user_id, balance=0, last_record_id=0)
+                row = sums.get(user_id)
+                if row:
+                    checkpoint.balance += row['delta']
+                    checkpoint.last_record_id = row['last_record_id']
+                checkpoint.datetime = now
+                updated.append(checkpoint)
+
+                if coins[user_id] != checkpoint.balance:
+                    # 取引記録の合計がマイナスの場合は残高に入れられないので修正しない
+                    repaired = repair and checkpoint.balance >= 0
+                    if repaired:
+                        User.objects.filter(pk=user_id).update(coin=checkpoint.balance)
+                    drifts.append((user_id, coins[user_id], checkpoint.balance, repaired))
+
+            BalanceCheckpoint.objects.bulk_create(
+                updated,
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=['balance', 'last_record_id', 'datetime'],
+            )
+        return drifts
@@ -0,0 +1,48 @@
+import os
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from onboro import jobs
+
+
+class Command(BaseCommand):
+    help = ('登録されたジョブ(CSVのインポートなど)を順に実行するワーカーです。'
+            '複数のプロセスで同時に動かしても、同じジョブを二重に実行しません')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='待機中のジョブがなくなったら終了します')
+        parser.add_argument('--sleep', type=float, default=1.0, help='ジョブがないときに待つ秒数')
+        parser.add_argument('--worker', default=f'{socket.gethostname()}:{os.getpid()}', help='ワーカーの名前')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        # 停止の合図を受けたら、実行中のジョブを最後まで終えてから止まる
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        worker = options['worker']
+        self.stdout.write(f'ワーカー {worker} を開始しました。')
+        while not self.stopping:
+            # 長く動かすので、切れた接続を使い続けないようにする
+            close_old_connections()
+            job = jobs.claim(worker)
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            self.stdout.write(f'ジョブ#{job.pk} ({job.kind}) を実行します。')
+            job = jobs.run(job)
+            self.stdout.write(
+                f'ジョブ#{job.pk}: {job.get_status_display()} '
+                f'(処理 {job.processed}行 / 成功 {job.succeeded}行 / エラー {job.error_count}行) {job.message}'
+            )
+        self.stdout.write(f'ワーカー {worker} を終了しました。')
+
+    def _stop(self, signum, frame):
+        self.stopping = True
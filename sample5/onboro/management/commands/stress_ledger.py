@@ -0,0 +1,111 @@
+import multiprocessing
+import random
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, OperationalError
+from django.db.models import Count
+
+from onboro import ledger
+from onboro.management.testdb import throwaway_database
+from onboro.models import User, Category, Book, TransactionRecord, Ownership
+
+
+def _worker(seed, operations, user_ids, book_ids):
+    # fork元の接続を使い回さないよう、子プロセスでは接続を作り直す
+    connections.close_all()
+    rng = random.Random(seed)
+    users = list(User.objects.filter(pk__in=user_ids))
+    books = list(Book.objects.filter(pk__in=book_ids))
+    results = Counter()
+    for _ in range(operations):
+        user = rng.choice(users)
+        op = rng.choice(['charge', 'purchase', 'purchase', 'correct'])
+        try:
+            if op == 'charge':
+                ledger.charge(user, rng.randint(1, 100))
+            elif op == 'purchase':
+                ledger.purchase(user, rng.choice(books))
+            else:
+                ledger.charge(user, rng.randint(1, 100), kind=TransactionRecord.Kind.CHANGE_MINUS)
+            results[f'{op}:ok'] += 1
+        except ledger.InsufficientCoins:
+            results[f'{op}:insufficient'] += 1
+        except ledger.AlreadyOwned:
+            results[f'{op}:owned'] += 1
+        except OperationalError:
+            results[f'{op}:db_error'] += 1
+    connections.close_all()
+    return results
+
+
+class Command(BaseCommand):
+    help = '複数プロセスから同時にチャージ・購入を行い、残高と取引記録の合計が一致するかを確かめます（テスト用DBを作って実行します）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=500, help='1プロセスあたりの操作回数')
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--books', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # 本番のDBを汚さないよう、テスト用DBで実行する
+        with throwaway_database():
+            self._run(options)
+
+    def _run(self, options):
+        rng = random.Random(options['seed'])
+        category = Category.objects.create(display_order=0, name='stress')
+        users = User.objects.bulk_create(
+            User(username=f'stress-{i}', coin=0) for i in range(options['users'])
+        )
+        books = Book.objects.bulk_create(
+            Book(category=category, title=f'stress-{i}', abstract='', price=rng.randint(10, 200), published=True)
+            for i in range(options['books'])
+        )
+        user_ids = [user.pk for user in users]
+        book_ids = [book.pk for book in books]
+
+        # fork前に接続を閉じておく
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        started = time.perf_counter()
+        with context.Pool(options['workers']) as pool:
+            jobs = [
+                pool.apply_async(_worker, (options['seed'] + i, options['operations'], user_ids, book_ids))
+                for i in range(options['workers'])
+            ]
+            results = sum((job.get() for job in jobs), Counter())
+        elapsed = time.perf_counter() - started
+
+        total = sum(results.values())
+        self.stdout.write(f'{total} operations in {elapsed:.1f}s ({total / elapsed:.0f} ops/s)')
+        for key in sorted(results):
+            self.stdout.write(f'  {key}: {results[key]}')
+
+        errors = []
+        for user in User.objects.filter(pk__in=user_ids).order_by('pk'):
+            ledger_sum = sum(
+                ledger.signed_amount(kind, amount)
+                for kind, amount in TransactionRecord.objects.filter(user=user).values_list('kind', 'amount')
+            )
+            self.stdout.write(f'{user.username}: coin={user.coin} ledger={ledger_sum}')
+            if user.coin != ledger_sum:
+                errors.append(f'{user.username}: 残高 {user.coin} が取引記録の合計 {ledger_sum} と一致しません')
+
+        uses = TransactionRecord.objects.filter(user_id__in=user_ids, kind=TransactionRecord.Kind.USE).count()
+        owned = Ownership.objects.filter(user_id__in=user_ids).count()
+        if uses != owned:
+            errors.append(f'購入記録 {uses} 件と購入済み書籍 {owned} 件が一致しません')
+        duplicated = (TransactionRecord.objects.filter(user_id__in=user_ids, kind=TransactionRecord.Kind.USE)
+                      .values('user', 'book').annotate(n=Count('id')).filter(n__gt=1).count())
+        if duplicated:
+            errors.append(f'同じ書籍を{duplicated}件重複して購入しています')
+        if results.get('charge:db_error') or results.get('purchase:db_error') or results.get('correct:db_error'):
+            errors.append('DBエラーになった操作があります')
+
+        if errors:
+            raise CommandError('\n'.join(errors))
+        self.stdout.write(self.style.SUCCESS('残高はすべて取引記録の合計と一致しました。'))
@@ -0,0 +1,26 @@
+"""管理コマンドから使う使い捨てのテスト用DB"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+@contextmanager
+def throwaway_database():
+    """マイグレーション済みの空のDBを作って接続を切り替え、終わったら削除する
+
+    本番のDBには一切書き込まない。SQLiteは複数プロセスから使えるようファイルに作る。
+    """
+    tmpdir = None
+    if connection.vendor == 'sqlite':
+        tmpdir = tempfile.mkdtemp()
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'test.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
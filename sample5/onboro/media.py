@@ -0,0 +1,156 @@
+"""アップロードされたファイル(MEDIA_ROOT)の配信
+
+以前は django.conf.urls.static.static() で配信していたが、あれは開発用で、
+ワーカーが4KBずつファイルを読んで送り、キャッシュのヘッダーも範囲リクエストもない。ここでは
+
+- 設定 MEDIA_SENDFILE_HEADER があれば、ファイルの場所だけをヘッダーで返し、送信は前段のWebサーバーに任せる
+  （nginxなら 'X-Accel-Redirect'、Apache・lighttpdなら 'X-Sendfile'）
+- なければ FileResponse でファイルそのものを返す。WSGIサーバーの wsgi.file_wrapper (gunicornならsendfile)
+  でカーネルから直接送られるので、ワーカーはバイト列をコピーしない
+- Range ヘッダー(1つの範囲)には 206 で答える。末尾までの範囲なら sendfile のまま送れる
+- 中身のハッシュの名前(storage.py)のファイルとその縮小版は中身が変わらないので、1年間キャッシュさせる
+- ジョブのCSV(パスワードを含む)など、公開しないディレクトリは 404 にする
+"""
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.views.static import was_modified_since
+
+from . import storage
+
+# 公開しないディレクトリ（MEDIA_ROOTからの相対パス）
+PRIVATE_PREFIXES = ('jobs/', storage.PREFIX + 'tmp/')
+
+# 中身が変わらないファイル
+IMMUTABLE_PREFIXES = (storage.PREFIX, 'renditions/' + storage.PREFIX)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+def cache_control(path):
+    if path.startswith(IMMUTABLE_PREFIXES):
+        return IMMUTABLE_CACHE_CONTROL
+    return f'public, max-age={getattr(settings, "MEDIA_MAX_AGE", 3600)}'
+
+
+def parse_range(header, size):
+    """Range ヘッダーから (開始, 終了) を返す。範囲が1つでないか読めなければNone、満たせなければ ValueError"""
+    match = _RANGE.fullmatch((header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # bytes=-500 は最後の500バイト
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+class _BoundedFile:
+    """ファイルの一部分だけを読ませる（FileResponseに渡すため、readだけを持つ）"""
+
+    def __init__(self, file, length):
+        self._file = file
+        self._remaining = length
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b''
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def serve(request, path):
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith(PRIVATE_PREFIXES):
+        raise Http404
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(fullpath)
+    except (OSError, SuspiciousFileOperation):
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    etag = quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+    headers = {
+        'Cache-Control': cache_control(path),
+        'Last-Modified': http_date(stat.st_mtime),
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+    }
+    if_none_match = request.headers.get('If-None-Match')
+    if (if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(',')]) or (
+            if_none_match is None and not was_modified_since(request.headers.get('If-Modified-Since'), stat.st_mtime)):
+        response = HttpResponseNotModified()
+        for name, value in headers.items():
+            response.headers[name] = value
+        return response
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+
+    sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+    if sendfile_header:
+        # 前段のWebサーバーがファイルを送る（範囲リクエストや304もWebサーバーが扱う）
+        response = HttpResponse(content_type=content_type)
+        if sendfile_header == 'X-Accel-Redirect':
+            response.headers[sendfile_header] = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/') + path
+        else:
+            response.headers[sendfile_header] = fullpath
+    else:
+        response = _file_response(request, fullpath, stat.st_size, content_type, etag, stat.st_mtime)
+
+    for name, value in headers.items():
+        response.headers[name] = value
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _file_response(request, fullpath, size, content_type, etag, mtime):
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    # If-Range が今のファイルと違えば、範囲でなく全体を返す
+    if if_range is None or if_range == etag or parse_http_date_safe(if_range) == int(mtime):
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+
+    file = open(fullpath, 'rb')
+    if byte_range is None:
+        return FileResponse(file, content_type=content_type)
+
+    start, end = byte_range
+    file.seek(start)
+    if end == size - 1:
+        # 末尾までならファイルのまま渡し、sendfileで送らせる（位置はseekした所から）
+        response = FileResponse(file, content_type=content_type)
+    else:
+        response = FileResponse(_BoundedFile(file, end - start + 1), content_type=content_type)
+        response.headers['Content-Length'] = end - start + 1
+    response.status_code = 206
+    response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
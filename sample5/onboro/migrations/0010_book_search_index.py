@@ -0,0 +1,93 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+# このマイグレーションを作ったときの onboro.search の処理をそのまま写したもの。
+# 後で onboro.search を変えても、このマイグレーションの結果は変わらない
+
+INDEX_TABLE = 'onboro_book_fts'
+
+BATCH_SIZE = 500
+
+_RUN_PATTERN = re.compile(r'[^\W_]+')
+
+
+def _tokenize(text):
+    # 文字の連続(ラン)ごとにバイグラムへ分割し、末尾の1文字も登録する
+    terms = []
+    for run in _RUN_PATTERN.findall(unicodedata.normalize('NFKC', text or '').lower()):
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        terms.append(run[-1])
+    return ' '.join(terms)
+
+
+def _write_batch(cursor, connection, Chapter, books):
+    bodies = {}
+    chapters = (Chapter.objects.using(connection.alias)
+                .filter(book_id__in=[pk for pk, _, _ in books])
+                .order_by('book_id', 'number')
+                .values_list('book_id', 'body'))
+    for book_id, body in chapters:
+        bodies.setdefault(book_id, []).append(body)
+    for pk, title, abstract in books:
+        params = [pk, _tokenize(title), _tokenize(abstract), _tokenize('\n'.join(bodies.get(pk, [])))]
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                f'INSERT INTO {INDEX_TABLE} (rowid, title, abstract, body) VALUES (%s, %s, %s, %s)', params,
+            )
+        else:
+            cursor.execute(
+                f"INSERT INTO {INDEX_TABLE} (book_id, document) VALUES (%s, "
+                f"setweight(to_tsvector('simple', %s), 'A') || "
+                f"setweight(to_tsvector('simple', %s), 'B') || "
+                f"setweight(to_tsvector('simple', %s), 'C'))",
+                params,
+            )
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {INDEX_TABLE} USING fts5(title, abstract, body, tokenize='ascii')"
+        )
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f'CREATE TABLE {INDEX_TABLE} (book_id bigint PRIMARY KEY, document tsvector NOT NULL)'
+        )
+        schema_editor.execute(
+            f'CREATE INDEX {INDEX_TABLE}_document ON {INDEX_TABLE} USING gin (document)'
+        )
+    else:
+        return
+
+    # 既存の書籍をインデックスに登録する
+    Book = apps.get_model('onboro', 'Book')
+    Chapter = apps.get_model('onboro', 'Chapter')
+    books = Book.objects.using(connection.alias).order_by('pk').values_list('pk', 'title', 'abstract')
+    with connection.cursor() as cursor:
+        batch = []
+        for book in books.iterator(chunk_size=BATCH_SIZE):
+            batch.append(book)
+            if len(batch) >= BATCH_SIZE:
+                _write_batch(cursor, connection, Chapter, batch)
+                batch = []
+        if batch:
+            _write_batch(cursor, connection, Chapter, batch)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute(f'DROP TABLE IF EXISTS {INDEX_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0009_userprofile_background_color_userprofile_icon_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
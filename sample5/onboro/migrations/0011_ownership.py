@@ -0,0 +1,48 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:29
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def backfill_ownership(apps, schema_editor):
+    # 既存の「使用」記録から購入済み書籍を作る（同じ本を複数回購入していても1行にする）
+    TransactionRecord = apps.get_model('onboro', 'TransactionRecord')
+    Ownership = apps.get_model('onboro', 'Ownership')
+    purchases = (TransactionRecord.objects
+                 .filter(kind='USE', book__isnull=False)
+                 .values('user_id', 'book_id')
+                 .annotate(first_datetime=Min('datetime'))
+                 .order_by('user_id', 'book_id'))
+    Ownership.objects.bulk_create(
+        (Ownership(user_id=row['user_id'], book_id=row['book_id'], datetime=row['first_datetime'])
+         for row in purchases.iterator()),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0010_book_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ownership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datetime', models.DateTimeField(verbose_name='購入日時')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='onboro.book', verbose_name='書籍')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '購入済み書籍',
+                'verbose_name_plural': '購入済み書籍',
+                'constraints': [models.UniqueConstraint(fields=('user', 'book'), name='unique_ownership_user_book')],
+            },
+        ),
+        migrations.RunPython(backfill_ownership, migrations.RunPython.noop),
+    ]
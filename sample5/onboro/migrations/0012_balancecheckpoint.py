@@ -0,0 +1,28 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0011_ownership'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+                ('balance', models.BigIntegerField(verbose_name='残高')),
+                ('last_record_id', models.BigIntegerField(verbose_name='最終取引記録ID')),
+                ('datetime', models.DateTimeField(verbose_name='作成日時')),
+            ],
+            options={
+                'verbose_name': '残高チェックポイント',
+                'verbose_name_plural': '残高チェックポイント',
+            },
+        ),
+    ]
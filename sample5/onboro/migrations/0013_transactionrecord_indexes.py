@@ -0,0 +1,42 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0012_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['user', 'datetime'], name='txn_user_datetime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['user', 'book', 'kind'], name='txn_user_book_kind_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['book', 'kind'], name='txn_book_kind_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['kind', 'datetime'], name='txn_kind_datetime_idx'),
+        ),
+        # 複合インデックスを作ってから、代用できるようになった単独のインデックスを削除する
+        migrations.AlterField(
+            model_name='transactionrecord',
+            name='book',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='onboro.book', verbose_name='書籍'),
+        ),
+        migrations.AlterField(
+            model_name='transactionrecord',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー'),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+
+# このマイグレーションを作ったときの onboro.rollups.rebuild の処理をそのまま写したもの。
+# 後で onboro.rollups を変えても、このマイグレーションの結果は変わらない
+
+COUNTERS = ['units', 'coins_used', 'coins_charged', 'corrected_plus', 'corrected_minus']
+
+BATCH_SIZE = 1000
+
+
+def backfill_rollups(apps, schema_editor):
+    # 既存の取引記録から日次集計を作る
+    TransactionRecord = apps.get_model('onboro', 'TransactionRecord')
+    sums = {
+        'units': Count('pk', filter=Q(kind='USE')),
+        'coins_used': Coalesce(Sum('amount', filter=Q(kind='USE')), 0),
+        'coins_charged': Coalesce(Sum('amount', filter=Q(kind='CHARGE')), 0),
+        'corrected_plus': Coalesce(Sum('amount', filter=Q(kind='CHANGE_PLUS')), 0),
+        'corrected_minus': Coalesce(Sum('amount', filter=Q(kind='CHANGE_MINUS')), 0),
+    }
+    groups = [
+        ('DailySales', Q(), ['date'], {}),
+        ('DailyBookSales', Q(book__isnull=False), ['date', 'book_id'], {}),
+        ('DailyCategorySales', Q(book__isnull=False), ['date', 'book__category_id'],
+         {'book__category_id': 'category_id'}),
+    ]
+    for model_name, group_filter, fields, renames in groups:
+        model = apps.get_model('onboro', model_name)
+        rows = (TransactionRecord.objects.filter(group_filter)
+                .annotate(date=TruncDate('datetime'))
+                .values(*fields).annotate(**sums).order_by())
+        model.objects.bulk_create(
+            (model(**{renames.get(name, name): row[name] for name in fields}, **{name: row[name] for name in COUNTERS})
+             for row in rows.iterator(chunk_size=BATCH_SIZE)),
+            batch_size=BATCH_SIZE,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0013_transactionrecord_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('units', models.BigIntegerField(default=0, verbose_name='販売数')),
+                ('coins_used', models.BigIntegerField(default=0, verbose_name='使用コイン')),
+                ('coins_charged', models.BigIntegerField(default=0, verbose_name='チャージコイン')),
+                ('corrected_plus', models.BigIntegerField(default=0, verbose_name='修正補填')),
+                ('corrected_minus', models.BigIntegerField(default=0, verbose_name='修正除去')),
+            ],
+            options={
+                'verbose_name': '日次売上',
+                'verbose_name_plural': '日次売上',
+                'constraints': [models.UniqueConstraint(fields=('date',), name='unique_daily_sales_date')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyBookSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('units', models.BigIntegerField(default=0, verbose_name='販売数')),
+                ('coins_used', models.BigIntegerField(default=0, verbose_name='使用コイン')),
+                ('coins_charged', models.BigIntegerField(default=0, verbose_name='チャージコイン')),
+                ('corrected_plus', models.BigIntegerField(default=0, verbose_name='修正補填')),
+                ('corrected_minus', models.BigIntegerField(default=0, verbose_name='修正除去')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='onboro.book', verbose_name='書籍')),
+            ],
+            options={
+                'verbose_name': '書籍別日次売上',
+                'verbose_name_plural': '書籍別日次売上',
+                'constraints': [models.UniqueConstraint(fields=('date', 'book'), name='unique_daily_book_sales')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyCategorySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('units', models.BigIntegerField(default=0, verbose_name='販売数')),
+                ('coins_used', models.BigIntegerField(default=0, verbose_name='使用コイン')),
+                ('coins_charged', models.BigIntegerField(default=0, verbose_name='チャージコイン')),
+                ('corrected_plus', models.BigIntegerField(default=0, verbose_name='修正補填')),
+                ('corrected_minus', models.BigIntegerField(default=0, verbose_name='修正除去')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='onboro.category', verbose_name='カテゴリ')),
+            ],
+            options={
+                'verbose_name': 'カテゴリ別日次売上',
+                'verbose_name_plural': 'カテゴリ別日次売上',
+                'constraints': [models.UniqueConstraint(fields=('date', 'category'), name='unique_daily_category_sales')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0014_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTransactionRecord',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('datetime', models.DateTimeField(verbose_name='日時')),
+                ('kind', models.CharField(choices=[('CHARGE', 'チャージ'), ('USE', '使用'), ('CHANGE_PLUS', '修正補填'), ('CHANGE_MINUS', '修正除去')], max_length=20, verbose_name='取引種別')),
+                ('amount', models.PositiveIntegerField(verbose_name='金額')),
+                ('month', models.DateField(verbose_name='月')),
+                ('book', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='onboro.book', verbose_name='書籍')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '取引記録(アーカイブ)',
+                'verbose_name_plural': '取引記録(アーカイブ)',
+                'indexes': [models.Index(fields=['user', 'datetime'], name='archived_txn_user_datetime_idx'), models.Index(fields=['month'], name='archived_txn_month_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0015_archivedtransactionrecord'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title'], name='book_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['datetime'], name='txn_datetime_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0016_ledger_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50, verbose_name='種類')),
+                ('status', models.CharField(choices=[('QUEUED', '待機中'), ('RUNNING', '実行中'), ('SUCCEEDED', '完了'), ('FAILED', '失敗')], default='QUEUED', max_length=20, verbose_name='状態')),
+                ('payload', models.JSONField(blank=True, default=dict, verbose_name='パラメータ')),
+                ('file', models.FileField(blank=True, upload_to='jobs/', verbose_name='ファイル')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='処理した行数')),
+                ('succeeded', models.PositiveIntegerField(default=0, verbose_name='成功した行数')),
+                ('error_count', models.PositiveIntegerField(default=0, verbose_name='エラーの行数')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='エラー')),
+                ('message', models.TextField(blank=True, verbose_name='メッセージ')),
+                ('worker', models.CharField(blank=True, max_length=100, verbose_name='ワーカー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='終了日時')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='登録者')),
+            ],
+            options={
+                'verbose_name': 'ジョブ',
+                'verbose_name_plural': 'ジョブ',
+                'ordering': ['-pk'],
+                'indexes': [models.Index(fields=['status', 'id'], name='job_status_idx')],
+            },
+        ),
+    ]
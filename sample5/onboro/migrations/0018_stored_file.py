@@ -0,0 +1,44 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:56
+
+import onboro.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0017_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='image',
+            field=models.ImageField(default='default_image_path.jpg', storage=onboro.storage.uploads, upload_to='images/', verbose_name='画像'),
+        ),
+        migrations.AlterField(
+            model_name='imageupload',
+            name='image',
+            field=models.ImageField(storage=onboro.storage.uploads, upload_to='images/'),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='icon',
+            field=models.ImageField(blank=True, null=True, storage=onboro.storage.uploads, upload_to='icons/'),
+        ),
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='ファイル名')),
+                ('size', models.PositiveBigIntegerField(verbose_name='サイズ')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='参照数')),
+                ('stored_at', models.DateTimeField(verbose_name='保存日時')),
+            ],
+            options={
+                'verbose_name': '保存ファイル',
+                'verbose_name_plural': '保存ファイル',
+                'indexes': [models.Index(fields=['ref_count', 'stored_at'], name='stored_file_orphan_idx')],
+            },
+        ),
+    ]
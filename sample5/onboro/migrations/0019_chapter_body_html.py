@@ -0,0 +1,33 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0018_stored_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日時'),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='body_hash',
+            field=models.CharField(default='', editable=False, max_length=64, verbose_name='本文のハッシュ'),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='body_html',
+            field=models.TextField(default='', editable=False, verbose_name='本文(HTML)'),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日時'),
+        ),
+    ]
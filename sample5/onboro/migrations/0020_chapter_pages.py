@@ -0,0 +1,101 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:05
+
+import hashlib
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+from django.utils.html import linebreaks
+from django.utils.text import normalize_newlines
+
+# このマイグレーションを作ったときの onboro.chapters の処理をそのまま写したもの。
+# 後で onboro.chapters を変えても、このマイグレーションの結果は変わらない
+
+PAGE_SIZE = 20000
+
+BATCH_SIZE = 20
+
+_PARAGRAPH_BREAK = re.compile(r'\n{2,}')
+
+
+def _pieces(paragraph, page_size):
+    while len(paragraph) > page_size:
+        cut = paragraph.rfind('\n', 0, page_size)
+        if cut <= 0:
+            cut = page_size
+        yield paragraph[:cut]
+        paragraph = paragraph[cut:].lstrip('\n')
+    yield paragraph
+
+
+def _split(body, page_size=PAGE_SIZE):
+    segment, length = [], 0
+    for paragraph in _PARAGRAPH_BREAK.split(normalize_newlines(body or '')):
+        for piece in _pieces(paragraph, page_size):
+            if segment and length + len(piece) > page_size:
+                yield '\n\n'.join(segment)
+                segment, length = [], 0
+            segment.append(piece)
+            length += len(piece) + 2
+    yield '\n\n'.join(segment)
+
+
+def backfill_pages(apps, schema_editor):
+    # 既存の章を段落の切れ目でページに分ける
+    Chapter = apps.get_model('onboro', 'Chapter')
+    ChapterPage = apps.get_model('onboro', 'ChapterPage')
+    last_pk = 0
+    while True:
+        batch = list(Chapter.objects.filter(pk__gt=last_pk, page_count=0).order_by('pk').only('body')[:BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic():
+            for chapter in batch:
+                pages = [linebreaks(segment, autoescape=True) for segment in _split(chapter.body)]
+                digest = hashlib.sha256()
+                for html in pages:
+                    digest.update(html.encode())
+                chapter.body_hash = digest.hexdigest()
+                chapter.page_count = len(pages)
+                ChapterPage.objects.filter(chapter_id=chapter.pk).delete()
+                ChapterPage.objects.bulk_create([
+                    ChapterPage(chapter_id=chapter.pk, number=number, html=html)
+                    for number, html in enumerate(pages, start=1)
+                ])
+            # updated_at は変えない（既存の章を読者のキャッシュから追い出さないように）
+            Chapter.objects.bulk_update(batch, ['body_hash', 'page_count'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0019_chapter_body_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='page_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='ページ数'),
+        ),
+        migrations.CreateModel(
+            name='ChapterPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(verbose_name='ページ番号')),
+                ('html', models.TextField(verbose_name='本文(HTML)')),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='onboro.chapter', verbose_name='章')),
+            ],
+            options={
+                'verbose_name': '章のページ',
+                'verbose_name_plural': '章のページ',
+                'constraints': [models.UniqueConstraint(fields=('chapter', 'number'), name='unique_chapter_page')],
+            },
+        ),
+        migrations.RunPython(backfill_pages, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='chapter',
+            name='body_html',
+        ),
+    ]
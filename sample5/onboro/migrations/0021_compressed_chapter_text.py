@@ -0,0 +1,99 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:07
+
+import onboro.fields
+from django.db import migrations, models
+
+# 1回に読む行数（章は数MBあることがあるので少なめ）
+CHAPTER_BATCH_SIZE = 20
+PAGE_BATCH_SIZE = 200
+
+# (モデル, 文章の列, 圧縮した文章を入れる新しい列, 1回に読む行数)
+COLUMNS = [
+    ('Chapter', 'body', 'body_compressed', CHAPTER_BATCH_SIZE),
+    ('ChapterPage', 'html', 'html_compressed', PAGE_BATCH_SIZE),
+]
+
+
+def _copy(model, source, target, batch_size, convert):
+    manager = model._default_manager
+    last_pk = 0
+    while True:
+        rows = list(manager.filter(pk__gt=last_pk).order_by('pk').values_list('pk', source)[:batch_size])
+        if not rows:
+            break
+        manager.bulk_update([model(pk=pk, **{target: convert(value)}) for pk, value in rows], [target])
+        last_pk = rows[-1][0]
+
+
+def compress_chapter_text(apps, schema_editor):
+    # 列の型を(USING body::bytea などで)変えると、PostgreSQLでは文章がそのままのバイト列になったり
+    # バックスラッシュで失敗したりするので、新しい列に少しずつ圧縮して書き込み、元の列と入れ替える
+    for model_name, column, compressed, batch_size in COLUMNS:
+        _copy(apps.get_model('onboro', model_name), column, compressed, batch_size, lambda text: text)
+
+
+def decompress_chapter_text(apps, schema_editor):
+    for model_name, column, compressed, batch_size in COLUMNS:
+        _copy(apps.get_model('onboro', model_name), compressed, column, batch_size, str)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0020_chapter_pages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='body_compressed',
+            field=onboro.fields.CompressedTextField(null=True, verbose_name='本文'),
+        ),
+        migrations.AddField(
+            model_name='chapterpage',
+            name='html_compressed',
+            field=onboro.fields.CompressedTextField(null=True, verbose_name='本文(HTML)'),
+        ),
+        migrations.RunPython(compress_chapter_text, decompress_chapter_text),
+        # 戻すときに元の列を空の文字列で作り直せるよう、消す前に既定値を付けておく（DBの列は変えない）
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='chapter',
+                name='body',
+                field=models.TextField(default='', verbose_name='本文'),
+            ),
+            migrations.AlterField(
+                model_name='chapterpage',
+                name='html',
+                field=models.TextField(default='', verbose_name='本文(HTML)'),
+            ),
+        ]),
+        migrations.RemoveField(
+            model_name='chapter',
+            name='body',
+        ),
+        migrations.RemoveField(
+            model_name='chapterpage',
+            name='html',
+        ),
+        migrations.RenameField(
+            model_name='chapter',
+            old_name='body_compressed',
+            new_name='body',
+        ),
+        migrations.RenameField(
+            model_name='chapterpage',
+            old_name='html_compressed',
+            new_name='html',
+        ),
+        migrations.AlterField(
+            model_name='chapter',
+            name='body',
+            field=onboro.fields.CompressedTextField(verbose_name='本文'),
+        ),
+        migrations.AlterField(
+            model_name='chapterpage',
+            name='html',
+            field=onboro.fields.CompressedTextField(verbose_name='本文(HTML)'),
+        ),
+    ]
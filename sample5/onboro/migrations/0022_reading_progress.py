@@ -0,0 +1,32 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0021_compressed_chapter_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.PositiveIntegerField(default=1, verbose_name='ページ')),
+                ('position', models.FloatField(default=0, verbose_name='位置')),
+                ('updated_at', models.DateTimeField(verbose_name='更新日時')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='onboro.book', verbose_name='書籍')),
+                ('chapter', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='onboro.chapter', verbose_name='章')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '読書の進み具合',
+                'verbose_name_plural': '読書の進み具合',
+                'constraints': [models.UniqueConstraint(fields=('user', 'book'), name='unique_reading_progress_user_book')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onboro', '0023_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedtransactionrecord',
+            index=models.Index(fields=['user', 'datetime', 'id'], name='archived_txn_user_dt_id_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='archivedtransactionrecord',
+            name='archived_txn_user_datetime_idx',
+        ),
+    ]
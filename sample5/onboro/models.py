@@ -3,6 +3,10 @@ from django.contrib.auth.models import AbstractUser
 import logging
 from django.db import transaction
 
+from . import chapters
+from .fields import CompressedTextField
+from .storage import uploads
+
 logger = logging.getLogger(__name__)
 
 
@@ -40,7 +44,7 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     custom_setting = models.CharField(max_length=20, default='normal')  # 文字の大きさ
     background_color = models.CharField(max_length=10, choices=[('white', '白'), ('black', '黒')], default='white')  # 背景色
-    icon = models.ImageField(upload_to='icons/', blank=True, null=True)  # アイコン
+    icon = models.ImageField(upload_to='icons/', storage=uploads, blank=True, null=True)  # アイコン
 
     def __str__(self):
         return self.user.username
@@ -59,7 +63,7 @@ class Category(models.Model):
         return self.name
 
 class ImageUpload(models.Model):
-    image = models.ImageField(upload_to='images/')
+    image = models.ImageField(upload_to='images/', storage=uploads)
     description = models.CharField(max_length=255, blank=True)
 
     def __str__(self):
@@ -69,12 +73,19 @@ class Book(models.Model):
     category = models.ForeignKey(Category, on_delete=models.PROTECT, verbose_name='カテゴリ')
     title = models.CharField(max_length=80, verbose_name='タイトル')
     # 画像をアップロードする機能実装
-    image = models.ImageField(upload_to='images/', default='default_image_path.jpg', verbose_name='画像')  # デフォルトの画像パスを指定
+    image = models.ImageField(upload_to='images/', storage=uploads, default='default_image_path.jpg', verbose_name='画像')  # デフォルトの画像パスを指定
     abstract = models.TextField(verbose_name='概要')
     price = models.PositiveIntegerField(verbose_name='価格')
     published = models.BooleanField('公開')
+    # 書籍の詳細ページの Last-Modified に使う
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
 
     class Meta:
+        indexes = [
+            # 管理画面のタイトルの先頭一致検索
+            models.Index(fields=['title'], name='book_title_idx'),
+        ]
+
         verbose_name = '書籍'
         verbose_name_plural = '書籍'
 
@@ -85,7 +96,12 @@ class Chapter(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name='書籍')
     number = models.PositiveIntegerField(verbose_name='章番号')
     title = models.CharField(max_length=80, verbose_name='章名')
-    body = models.TextField(verbose_name='本文')
+    # 圧縮して保存し、読んだときに展開する(fields.py)
+    body = CompressedTextField(verbose_name='本文')
+    # 保存するときに本文をページ(ChapterPage)に分けたHTMLのハッシュとページ数（chapters.py）
+    body_hash = models.CharField(max_length=64, default='', editable=False, verbose_name='本文のハッシュ')
+    page_count = models.PositiveIntegerField(default=0, editable=False, verbose_name='ページ数')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
 
     class Meta:
         ordering = ['number']
@@ -96,19 +112,49 @@ class Chapter(models.Model):
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        pages = None
+        if update_fields is None or 'body' in update_fields:
+            pages = chapters.render(self)
+        if update_fields is not None:
+            # 一部の列だけ保存するときも、更新日時と(本文が変わるなら)ページは一緒に保存する
+            update_fields = {*update_fields, 'updated_at'}
+            if pages is not None:
+                update_fields |= {'body_hash', 'page_count'}
+            kwargs['update_fields'] = update_fields
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if pages is not None:
+                chapters.save_pages(self, pages)
+
+    @staticmethod
+    def format_title(number, title):
+        return f'第{number}章{title}'
+
     def title_with_number(self):
-        return f'第{self.number}章{self.title}'
+        return self.format_title(self.number, self.title)
+
 
-    def next_chapter(self):
-        return self.book.chapter_set.filter(number=self.number+1).first()
+class ChapterPage(models.Model):
+    """章の本文を段落の切れ目で分けた1ページ分の表示用HTML（Chapter.save で作り直す）"""
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name='pages', verbose_name='章')
+    number = models.PositiveIntegerField(verbose_name='ページ番号')
+    html = CompressedTextField(verbose_name='本文(HTML)')
 
-    def prev_chapter(self):
-        return self.book.chapter_set.filter(number=self.number-1).first()
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chapter', 'number'], name='unique_chapter_page'),
+        ]
+
+        verbose_name = '章のページ'
+        verbose_name_plural = '章のページ'
 
 
 class TransactionRecord(models.Model):
-    user = models.ForeignKey(User, on_delete=models.PROTECT, verbose_name='ユーザー')
-    book = models.ForeignKey(Book, null=True, blank=True, on_delete=models.PROTECT, verbose_name='書籍')
+    # user・bookの単独のインデックスは、先頭が同じ複合インデックス(Meta.indexes)で代用する
+    user = models.ForeignKey(User, on_delete=models.PROTECT, db_index=False, verbose_name='ユーザー')
+    book = models.ForeignKey(Book, null=True, blank=True, on_delete=models.PROTECT, db_index=False, verbose_name='書籍')
     datetime = models.DateTimeField(verbose_name='日時')
 
     class Kind(models.TextChoices):
@@ -121,6 +167,20 @@ class TransactionRecord(models.Model):
     amount = models.PositiveIntegerField(verbose_name='金額')
 
     class Meta:
+        # よく使う絞り込み・並び順に合わせた複合インデックス
+        indexes = [
+            # ユーザーごとの取引履歴(新しい順)・残高の集計
+            models.Index(fields=['user', 'datetime'], name='txn_user_datetime_idx'),
+            # ユーザーがその書籍を購入したか
+            models.Index(fields=['user', 'book', 'kind'], name='txn_user_book_kind_idx'),
+            # 書籍ごとの売上
+            models.Index(fields=['book', 'kind'], name='txn_book_kind_idx'),
+            # 種別ごとの期間集計・管理画面の絞り込み
+            models.Index(fields=['kind', 'datetime'], name='txn_kind_datetime_idx'),
+            # 管理画面の一覧(新しい順)・日付での絞り込み
+            models.Index(fields=['datetime'], name='txn_datetime_idx'),
+        ]
+
         verbose_name = '取引記録'
         verbose_name_plural = '取引記録'
 
@@ -128,36 +188,224 @@ class TransactionRecord(models.Model):
         raise Exception("この取引記録は削除できません。")
 
     def save(self, *args, **kwargs):
+        # 残高の増減はledgerにまとめてあり、記録の保存と同じトランザクションで1回だけ反映する
+        from . import ledger
+
         with transaction.atomic():
             is_new = self.pk is None  # 新規作成かどうかを判定
-            original_kind = None
+            ledger.apply_record(self)
+            super().save(*args, **kwargs)  # 通常の保存処理
 
-            if not is_new:
-                original = TransactionRecord.objects.get(pk=self.pk)
-                original_kind = original.kind
+            # 書籍の購入(使用)であれば閲覧権限を付与する（管理画面から追加した場合も同じ）
+            if is_new and self.kind == self.Kind.USE and self.book_id:
+                Ownership.objects.get_or_create(
+                    user=self.user, book_id=self.book_id, defaults={'datetime': self.datetime}
+                )
 
-            super().save(*args, **kwargs)  # 通常の保存処理
 
-            if is_new:
-                if self.kind == self.Kind.CHARGE:
-                    self.user.coin += self.amount
-                elif self.kind == self.Kind.USE:
-                    self.user.coin -= self.amount
-                elif self.kind == self.Kind.CHANGE_PLUS:
-                    self.user.coin += self.amount
-                elif self.kind == self.Kind.CHANGE_MINUS:
-                    self.user.coin -= self.amount
-            else:
-                if original_kind == self.Kind.CHARGE:
-                    self.user.coin -= original.amount
-                elif original_kind == self.Kind.USE:
-                    self.user.coin += original.amount
-                elif original_kind == self.Kind.CHANGE_PLUS:
-                    self.user.coin -= original.amount
-                elif original_kind == self.Kind.CHANGE_MINUS:
-                    self.user.coin += original.amount
-
-            self.user.save()  # 最後にユーザーのデータを保存
+# 締めた月の取引記録のアーカイブ
+# 取引記録は削除できないので増え続けるが、古い月の行はここへ移して取引記録のテーブルを小さく保つ。
+# IDは元の取引記録のものをそのまま使うので、カーソルやチェックポイントのIDと比べられる。
+# 移すのは archive_transactions コマンド、読むときは archive.user_records() で両方を合わせて読む。
+class ArchivedTransactionRecord(models.Model):
+    id = models.BigIntegerField(primary_key=True, verbose_name='ID')
+    user = models.ForeignKey(User, on_delete=models.PROTECT, db_index=False, verbose_name='ユーザー')
+    book = models.ForeignKey(Book, null=True, blank=True, on_delete=models.PROTECT, verbose_name='書籍')
+    datetime = models.DateTimeField(verbose_name='日時')
+    kind = models.CharField(max_length=20, choices=TransactionRecord.Kind.choices, verbose_name='取引種別')
+    amount = models.PositiveIntegerField(verbose_name='金額')
+    # 取引の月(1日)。月単位で移した範囲を確認するのに使う
+    month = models.DateField(verbose_name='月')
+
+    class Meta:
+        indexes = [
+            # 履歴は (日時, ID) の降順で読む。IDはSQLiteのrowidではないので、並べ替えずに済むよう索引に含める
+            models.Index(fields=['user', 'datetime', 'id'], name='archived_txn_user_dt_id_idx'),
+            models.Index(fields=['month'], name='archived_txn_month_idx'),
+        ]
+
+        verbose_name = '取引記録(アーカイブ)'
+        verbose_name_plural = '取引記録(アーカイブ)'
+
+    def delete(self, *args, **kwargs):
+        raise Exception("この取引記録は削除できません。")
+
+
+# 購入済みの書籍（閲覧権限）
+# TransactionRecordを毎回たどらずに、(user, book)の一意インデックス1回で権限を確認するためのテーブル
+class Ownership(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='ユーザー')
+    book = models.ForeignKey(Book, on_delete=models.PROTECT, verbose_name='書籍')
+    datetime = models.DateTimeField(verbose_name='購入日時')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='unique_ownership_user_book'),
+        ]
+
+        verbose_name = '購入済み書籍'
+        verbose_name_plural = '購入済み書籍'
+
+    def __str__(self):
+        return f'{self.user} - {self.book}'
+
+    @classmethod
+    def owns(cls, user, book_id):
+        return cls.objects.filter(user=user, book_id=book_id).exists()
+
+
+# 書籍ごとの読書の進み具合（章のページからのビーコンをためてまとめて書き込む。progress.py）
+class ReadingProgress(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='ユーザー')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name='書籍')
+    chapter = models.ForeignKey(Chapter, on_delete=models.SET_NULL, null=True, verbose_name='章')
+    # 全文(?page=all)で読んでいたときは 0
+    page = models.PositiveIntegerField(default=1, verbose_name='ページ')
+    # ページの中のスクロール位置（0〜1）
+    position = models.FloatField(default=0, verbose_name='位置')
+    updated_at = models.DateTimeField(verbose_name='更新日時')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='unique_reading_progress_user_book'),
+        ]
+
+        verbose_name = '読書の進み具合'
+        verbose_name_plural = '読書の進み具合'
+
+    def __str__(self):
+        return f'{self.user} - {self.book}'
+
+# 残高のチェックポイント
+# last_record_idまでの取引記録を合計した残高を持っておき、照合ではそれ以降の記録だけを合計する
+class BalanceCheckpoint(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, verbose_name='ユーザー')
+    balance = models.BigIntegerField(verbose_name='残高')
+    last_record_id = models.BigIntegerField(verbose_name='最終取引記録ID')
+    datetime = models.DateTimeField(verbose_name='作成日時')
+
+    class Meta:
+        verbose_name = '残高チェックポイント'
+        verbose_name_plural = '残高チェックポイント'
+
+    def __str__(self):
+        return f'{self.user}: {self.balance} (#{self.last_record_id})'
+
+# 売上の日次集計
+# 取引記録を毎回GROUP BYしなくて済むよう、取引記録の保存と同じトランザクションで差分を足し込んでいく
+# （集計の更新はrollups.py、作り直しは rebuild_sales_rollups コマンド）
+class SalesRollup(models.Model):
+    date = models.DateField(verbose_name='日付')
+    units = models.BigIntegerField(default=0, verbose_name='販売数')
+    coins_used = models.BigIntegerField(default=0, verbose_name='使用コイン')
+    coins_charged = models.BigIntegerField(default=0, verbose_name='チャージコイン')
+    corrected_plus = models.BigIntegerField(default=0, verbose_name='修正補填')
+    corrected_minus = models.BigIntegerField(default=0, verbose_name='修正除去')
+
+    class Meta:
+        abstract = True
+
+# 日ごとの全体の合計（チャージは書籍に紐づかないので、ここで集計する）
+class DailySales(SalesRollup):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date'], name='unique_daily_sales_date'),
+        ]
+
+        verbose_name = '日次売上'
+        verbose_name_plural = '日次売上'
+
+    def __str__(self):
+        return str(self.date)
+
+class DailyBookSales(SalesRollup):
+    book = models.ForeignKey(Book, on_delete=models.PROTECT, verbose_name='書籍')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'book'], name='unique_daily_book_sales'),
+        ]
+
+        verbose_name = '書籍別日次売上'
+        verbose_name_plural = '書籍別日次売上'
+
+    def __str__(self):
+        return f'{self.date} {self.book}'
+
+# 書籍のカテゴリは購入時点のものを使う（作り直した場合は今のカテゴリになる）
+class DailyCategorySales(SalesRollup):
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, verbose_name='カテゴリ')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category'], name='unique_daily_category_sales'),
+        ]
+
+        verbose_name = 'カテゴリ別日次売上'
+        verbose_name_plural = 'カテゴリ別日次売上'
+
+    def __str__(self):
+        return f'{self.date} {self.category}'
+
+# DBに積んでおき、run_jobs コマンドのワーカーが順に実行する重い処理（CSVのインポートなど）
+# リクエストの中で処理しないので、大きなファイルでもワーカーのタイムアウトにかからない
+class Job(models.Model):
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', '待機中'
+        RUNNING = 'RUNNING', '実行中'
+        SUCCEEDED = 'SUCCEEDED', '完了'
+        FAILED = 'FAILED', '失敗'
+
+    kind = models.CharField(max_length=50, verbose_name='種類')
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.QUEUED, verbose_name='状態')
+    payload = models.JSONField(default=dict, blank=True, verbose_name='パラメータ')
+    file = models.FileField(upload_to='jobs/', blank=True, verbose_name='ファイル')
+    processed = models.PositiveIntegerField(default=0, verbose_name='処理した行数')
+    succeeded = models.PositiveIntegerField(default=0, verbose_name='成功した行数')
+    error_count = models.PositiveIntegerField(default=0, verbose_name='エラーの行数')
+    # [行番号, メッセージ] のリスト（多すぎる場合は先頭だけ）
+    errors = models.JSONField(default=list, blank=True, verbose_name='エラー')
+    message = models.TextField(blank=True, verbose_name='メッセージ')
+    worker = models.CharField(max_length=100, blank=True, verbose_name='ワーカー')
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, verbose_name='登録者')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='登録日時')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='開始日時')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='終了日時')
+    # 実行中に一定の間隔で更新する。更新が止まったジョブはワーカーが止まったものとして失敗にする(jobs.py)
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='最終応答日時')
+
+    class Meta:
+        ordering = ['-pk']
+        indexes = [
+            # 待機中のジョブを古い順に取り出す
+            models.Index(fields=['status', 'id'], name='job_status_idx'),
+        ]
+
+        verbose_name = 'ジョブ'
+        verbose_name_plural = 'ジョブ'
+
+    def __str__(self):
+        return f'#{self.pk} {self.kind} ({self.get_status_display()})'
+
+# アップロードされたファイル（中身のハッシュの名前で1つだけ保存したもの）
+# ref_countはそのファイルを指しているフィールドの数。0のまましばらく経ったものを gc_media コマンドで消す（storage.py）
+class StoredFile(models.Model):
+    name = models.CharField(max_length=255, unique=True, verbose_name='ファイル名')
+    size = models.PositiveBigIntegerField(verbose_name='サイズ')
+    ref_count = models.PositiveIntegerField(default=0, verbose_name='参照数')
+    stored_at = models.DateTimeField(verbose_name='保存日時')
+
+    class Meta:
+        indexes = [
+            # 参照のないファイルを古い順に探す
+            models.Index(fields=['ref_count', 'stored_at'], name='stored_file_orphan_idx'),
+        ]
+
+        verbose_name = '保存ファイル'
+        verbose_name_plural = '保存ファイル'
+
+    def __str__(self):
+        return self.name
 
 # class TransactionRecord(models.Model):
 #     user = models.ForeignKey(User, on_delete=models.PROTECT, verbose_name='ユーザー')
@@ -0,0 +1,244 @@
+"""キーセット(カーソル)方式のページング
+
+OFFSETを使わず「前のページの最後の行のキー」より後ろを取得するので、
+何ページ目であっても1ページ目と同じコストで取得できる。
+"""
+import base64
+import binascii
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# 絞り込んだ一覧の件数を正確に数える上限（これを超えたら見積もりにする）
+EXACT_COUNT_LIMIT = 10000
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.next_query = None
+        self.previous_query = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def link_queries(self, request, param='cursor'):
+        """前後のページへのリンク用クエリ文字列を作る（他の検索条件はそのまま引き継ぐ）"""
+        self.next_query = _replace_query(request, param, self.next_cursor)
+        self.previous_query = _replace_query(request, param, self.previous_cursor)
+        return self
+
+
+def _replace_query(request, param, cursor):
+    if cursor is None:
+        return None
+    query = request.GET.copy()
+    query[param] = cursor
+    return query.urlencode()
+
+
+def page_size_from(request, param='size'):
+    # 指定がなければ既定値、大きすぎる値は上限で切り詰める
+    try:
+        size = int(request.GET.get(param, DEFAULT_PAGE_SIZE))
+    except ValueError:
+        size = DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(key, direction):
+    data = json.dumps({'k': key, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソルを(キー, 方向)に戻す。壊れたカーソルは先頭ページ扱いにする"""
+    if not cursor:
+        return None, 'n'
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        key, direction = data['k'], data['d']
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        return None, 'n'
+    if direction not in ('n', 'p'):
+        return None, 'n'
+    return key, direction
+
+
+def _key_of(obj, fields):
+    values = []
+    for field in fields:
+        value = getattr(obj, field.lstrip('-'))
+        # datetimeなどはISO形式の文字列にしてカーソルに入れる
+        values.append(value if isinstance(value, (int, str)) else str(value))
+    return values
+
+
+def _after(fields, key, reverse=False):
+    """並び順で key より後ろ(reverse=Trueなら前)の行を表す条件を作る"""
+    condition = Q()
+    for i in reversed(range(len(fields))):
+        name = fields[i].lstrip('-')
+        descending = fields[i].startswith('-') != reverse
+        step = Q(**{f'{name}__{"lt" if descending else "gt"}': key[i]})
+        if i < len(fields) - 1:
+            step |= Q(**{name: key[i]}) & condition
+        condition = step
+    return condition
+
+
+def _reversed_ordering(fields):
+    return [f[1:] if f.startswith('-') else f'-{f}' for f in fields]
+
+
+def _sort(rows, fields):
+    # 後ろのキーから順に安定ソートすると、全体が ordering の順に並ぶ
+    for field in reversed(fields):
+        rows.sort(key=lambda row: getattr(row, field.lstrip('-')), reverse=field.startswith('-'))
+    return rows
+
+
+def paginate(queryset, ordering, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """querysetを ordering (一意になるよう最後は主キーにする) でキーセットページングする"""
+    return paginate_many([queryset], ordering, cursor, page_size)
+
+
+def paginate_many(querysets, ordering, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """同じキーを持つ複数のqueryset(取引記録とそのアーカイブなど)を、1つの並びとしてページングする
+
+    それぞれから1ページ分+1件を取得してPythonで並べ替えるので、クエリはqueryset 1つにつき1回。
+    """
+    ordering = list(ordering)
+    key, direction = decode_cursor(cursor)
+    if key is not None and (not isinstance(key, list) or len(key) != len(ordering)):
+        key, direction = None, 'n'
+
+    fetch_ordering = _reversed_ordering(ordering) if direction == 'p' else ordering
+    rows = []
+    for queryset in querysets:
+        qs = queryset.order_by(*fetch_ordering)
+        if key is not None:
+            qs = qs.filter(_after(ordering, key, reverse=direction == 'p'))
+        # 1件多く取得して次(前)のページがあるかを判定する
+        rows += qs[:page_size + 1]
+    if len(querysets) > 1:
+        rows = _sort(rows, fetch_ordering)[:page_size + 1]
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == 'p':
+        rows.reverse()
+
+    page = KeysetPage(rows)
+    if rows:
+        first, last = _key_of(rows[0], ordering), _key_of(rows[-1], ordering)
+        if direction == 'p':
+            page.previous_cursor = encode_cursor(first, 'p') if has_more else None
+            page.next_cursor = encode_cursor(last, 'n')
+        else:
+            page.next_cursor = encode_cursor(last, 'n') if has_more else None
+            page.previous_cursor = encode_cursor(first, 'p') if key is not None else None
+    return page
+
+
+def paginate_ids(ids, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """並び順の決まったIDのリスト(検索結果など)をページングする
+
+    返すページの object_list はIDのリストなので、呼び出し側でモデルに置き換える。
+    """
+    key, direction = decode_cursor(cursor)
+    start = 0
+    if key is not None:
+        positions = {pk: i for i, pk in enumerate(ids)}
+        pivot = positions.get(key[0]) if isinstance(key, list) and key else None
+        if pivot is None:
+            key, direction = None, 'n'
+        elif direction == 'p':
+            start = max(0, pivot - page_size)
+        else:
+            start = pivot + 1
+
+    page_ids = ids[start:start + page_size]
+    page = KeysetPage(page_ids)
+    if page_ids:
+        if start + page_size < len(ids):
+            page.next_cursor = encode_cursor([page_ids[-1]], 'n')
+        if start > 0:
+            page.previous_cursor = encode_cursor([page_ids[0]], 'p')
+    return page
+
+
+def estimated_count(queryset):
+    """querysetの件数の見積もり（見積もれなければNone）
+
+    絞り込みがなければ、PostgreSQLは統計情報(pg_class.reltuples)、
+    それ以外は主キーの最小値と最大値の差から見積もる（取引記録は削除しないので大きくはずれない）。
+    絞り込みがあれば、PostgreSQLは実行計画の見積もり行数を使う。
+    """
+    connection = connections[queryset.db]
+    model = queryset.model
+    if not queryset.query.where:
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                               [model._meta.db_table])
+                row = cursor.fetchone()
+            # 一度もANALYZEされていないテーブルは -1 になる
+            return row[0] if row and row[0] >= 0 else None
+        # MIN・MAXを1つのクエリにするとSQLiteは主キーを端から読めないので、別々に取得する
+        low = queryset.order_by('pk').values_list('pk', flat=True).first()
+        if low is None:
+            return 0
+        high = queryset.order_by('-pk').values_list('pk', flat=True).first()
+        return high - low + 1
+
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """件数を見積もりで済ませるPaginator（管理画面の大きな一覧用）
+
+    COUNT(*)で全件を数えずに済むよう、見積もれるときは見積もった件数を使う。
+    見積もれないときは EXACT_COUNT_LIMIT 件までだけを数える。
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        estimate = estimated_count(queryset)
+        if estimate is not None and estimate > EXACT_COUNT_LIMIT:
+            return estimate
+        # 少なければ正確に数えても速い。多すぎる場合は上限までのページだけを出す
+        return queryset.order_by()[:EXACT_COUNT_LIMIT].count()
@@ -0,0 +1,20 @@
+"""パスワードのハッシュ化（CSVからのユーザー作成で、プロセスプールの子プロセスから使う）
+
+子プロセスは spawn で起動し、init_worker() でDjangoを準備してから使う。
+このモジュールはモデルをimportしないので、Djangoの準備の前に子プロセスで読み込める。
+"""
+import django
+from django.contrib.auth.hashers import make_password
+
+
+def init_worker():
+    """プロセスプールの子プロセスの初期化"""
+    django.setup()
+    # 子プロセスではDBを使わない。接続を持っていれば使う前に閉じる
+    from django.db import connections
+    connections.close_all()
+
+
+def hash_password(password):
+    # 空のパスワードはログインできないパスワードにする
+    return make_password(password or None)
@@ -0,0 +1,171 @@
+"""書籍ごとの読書の進み具合（最後に読んだ章・ページ・スクロール位置）
+
+章のページはスクロールやページ送りのたびにビーコン(views.reading_progress)で位置を送ってくる。
+そのたびに行を書くと章のページと同じだけ書き込みが増えるので、プロセスのメモリにためておき(ProgressBuffer)、
+
+- 最初にためてから FLUSH_INTERVAL 秒たったとき（タイマーのスレッド）
+- ためた件数が MAX_PENDING 件になったとき
+- プロセスが終わるとき
+
+に、まとめて upsert (INSERT ... ON CONFLICT DO UPDATE) で書き込む。同じ(ユーザー, 書籍)の位置は
+最後に送られたものだけを残すので、何度スクロールしても書き込みは1行になる。
+
+プロセスが強制終了されたときは、まだ書き込んでいない数秒分の位置がなくなる（読書の位置なので許容する）。
+"""
+import atexit
+import logging
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 10
+
+MAX_PENDING = 1000
+
+# まだ書き込んでいない位置。ReadingProgress と同じ名前の属性を持つので、本棚ではどちらも同じように表示できる
+Pending = namedtuple('Pending', ['chapter_id', 'chapter_number', 'page', 'position', 'updated_at'])
+
+
+class ProgressBuffer:
+    def __init__(self, interval=None, max_pending=None):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+
+    def _interval(self):
+        if self.interval is not None:
+            return self.interval
+        return getattr(settings, 'READING_PROGRESS_FLUSH_INTERVAL', FLUSH_INTERVAL)
+
+    def _max_pending(self):
+        if self.max_pending is not None:
+            return self.max_pending
+        return getattr(settings, 'READING_PROGRESS_MAX_PENDING', MAX_PENDING)
+
+    def add(self, user_id, book_id, chapter_id, chapter_number, page, position):
+        """位置をためる（同じユーザー・書籍の前の位置は上書きする）"""
+        with self._lock:
+            self._pending[user_id, book_id] = Pending(chapter_id, chapter_number, page, position, timezone.now())
+            full = len(self._pending) >= self._max_pending()
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self._interval(), self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def pending(self, user_id, book_ids):
+        """まだ書き込んでいないユーザーの位置 {書籍ID: Pending}"""
+        with self._lock:
+            return {book_id: self._pending[user_id, book_id] for book_id in book_ids if (user_id, book_id) in self._pending}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return pending
+
+    def flush(self):
+        """ためた位置を書き込み、書き込んだ件数を返す"""
+        pending = self._take()
+        if not pending:
+            return 0
+        try:
+            return write(pending)
+        except Exception:
+            logger.exception('読書の進み具合を書き込めませんでした（%d件）', len(pending))
+            # 書き込めなかった位置は、その後に送られた新しい位置がなければ戻して次に書き込む
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending.setdefault(key, value)
+            return 0
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            # タイマーのスレッドのDB接続は使い回さないので閉じる
+            connection.close()
+
+
+def write(pending):
+    """{(ユーザーID, 書籍ID): Pending} をまとめて upsert する
+
+    プロセスごとにためて別々に書き込むので、書き込む順番と位置が送られた順番は一致しない。
+    すでにある行より新しい位置(updated_at)のときだけ上書きする（古い位置で戻さない）。
+    bulk_create(update_conflicts=True) では条件を付けられないので、SQLを書く(SQLite・PostgreSQL共通)。
+    """
+    from .models import Book, Chapter, ReadingProgress, User
+
+    # 書き込むまでの間に消されたユーザー・書籍・章の位置は書かない
+    user_ids = set(User.objects.filter(pk__in={user_id for user_id, _ in pending}).values_list('pk', flat=True))
+    book_ids = set(Book.objects.filter(pk__in={book_id for _, book_id in pending}).values_list('pk', flat=True))
+    chapter_ids = set(Chapter.objects.filter(
+        pk__in={value.chapter_id for value in pending.values()}
+    ).values_list('pk', flat=True))
+    rows = [
+        (user_id, book_id, value.chapter_id if value.chapter_id in chapter_ids else None,
+         value.page, value.position, value.updated_at)
+        for (user_id, book_id), value in pending.items()
+        if user_id in user_ids and book_id in book_ids
+    ]
+    if not rows:
+        return 0
+
+    meta = ReadingProgress._meta
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+    columns = [meta.get_field(name).column for name in ('user', 'book', 'chapter', 'page', 'position', 'updated_at')]
+    updates = ', '.join(f'{quote(column)} = excluded.{quote(column)}' for column in columns[2:])
+    updated_at = quote(meta.get_field('updated_at').column)
+    sql = (
+        f'INSERT INTO {table} ({", ".join(map(quote, columns))}) VALUES (%s, %s, %s, %s, %s, %s) '
+        f'ON CONFLICT ({quote(columns[0])}, {quote(columns[1])}) DO UPDATE SET {updates} '
+        f'WHERE excluded.{updated_at} > {table}.{updated_at}'
+    )
+    field = meta.get_field('updated_at')
+    params = [row[:5] + (field.get_db_prep_value(row[5], connection),) for row in rows]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+    return len(rows)
+
+
+buffer = ProgressBuffer()
+atexit.register(buffer.flush)
+
+
+def record(user, book_id, chapter, page, position):
+    """章のページから送られた位置をためる（chapter は目次の TocEntry）"""
+    buffer.add(user.pk, book_id, chapter.pk, chapter.number, page, position)
+
+
+def for_books(user, book_ids):
+    """ユーザーの書籍ごとの進み具合 {書籍ID: ReadingProgress または Pending} （クエリ1回）"""
+    from django.db.models import F
+
+    from .models import ReadingProgress
+
+    book_ids = list(book_ids)
+    if not book_ids:
+        return {}
+    saved = (ReadingProgress.objects.filter(user=user, book_id__in=book_ids, chapter__isnull=False)
+             .annotate(chapter_number=F('chapter__number'))
+             .only('book', 'chapter', 'page', 'position', 'updated_at'))
+    progress = {entry.book_id: entry for entry in saved}
+    # このプロセスにたまっている位置が書き込み済みのものより新しければ、そちらを出す
+    for book_id, pending in buffer.pending(user.pk, book_ids).items():
+        if book_id not in progress or progress[book_id].updated_at < pending.updated_at:
+            progress[book_id] = pending
+    return progress
@@ -0,0 +1,221 @@
+"""書籍の表紙画像の縮小版(レンディション)
+
+アップロードされたままの画像を一覧で30pxに縮めて表示すると、1ページで数MBを読み込むことになる。
+そこで幅 SIZES(px) ごとに JPEG と WebP の縮小版を作っておき、テンプレートでは srcset で
+表示する幅と高解像度(2x)の画面に合うものをブラウザに選ばせる。
+
+縮小版は元画像のファイル名から決まる renditions/<元画像のパス(拡張子なし)>/<幅>.<拡張子> に
+既定のストレージで置く。元画像の名前は中身のハッシュ(storage.py)なので、画像を差し替えると名前が変わり、
+古い縮小版を返すことはない。同じ画像の書籍どうしは縮小版も共有する。
+
+- 管理画面・画像アップロード画面で画像が変わったら generate() でプロセスプールを使ってまとめて作る
+- テンプレートで縮小版がまだなければ(既存の画像など)、その場で作ってから返す。
+  作ったかどうかはキャッシュに覚えておき、毎回ストレージを確認しない
+"""
+import io
+import logging
+import multiprocessing
+import os
+import posixpath
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# 作る幅(px)。一覧の30px・詳細の300pxと、それぞれの2倍
+SIZES = (30, 60, 300, 600)
+
+# 形式: (Pillowの形式名, 拡張子, 保存オプション)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+# 元画像が読めなかったことを覚えておく秒数（その間は元画像をそのまま表示する）
+MISSING_TIMEOUT = 300
+
+
+def rendition_name(name, width, fmt):
+    """元画像のファイル名から、縮小版のファイル名を決める"""
+    stem, _ = posixpath.splitext(name)
+    return f'renditions/{stem}/{width}.{FORMATS[fmt][1]}'
+
+
+def open_image(data):
+    """画像のバイト列を開き、向きを直してRGBかRGBAにする"""
+    with Image.open(io.BytesIO(data)) as original:
+        # スマートフォンの写真などは、EXIFの向きを反映してから縮める
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        image.load()
+        return image
+
+
+def encode(image):
+    """画像を FORMATS の形式ごとのバイト列にする"""
+    encoded = {}
+    for fmt, (format_name, _, options) in FORMATS.items():
+        target = image
+        if format_name == 'JPEG' and target.mode == 'RGBA':
+            # JPEGは透過できないので白背景にする
+            target = Image.new('RGB', image.size, 'white')
+            target.paste(image, mask=image.getchannel('A'))
+        buffer = io.BytesIO()
+        target.save(buffer, format_name, **options)
+        encoded[fmt] = buffer.getvalue()
+    return encoded
+
+
+def _render(data, widths):
+    """元画像のバイト列から、幅ごと・形式ごとの縮小版のバイト列を作る（プロセスプールで実行する）
+
+    Djangoの設定やDBには触らないので、どの起動方法(fork/spawn)のプロセスでも動く。
+    """
+    image = open_image(data)
+    rendered = {}
+    for width in widths:
+        # 元画像より大きくはしない
+        height = max(1, round(image.height * min(width, image.width) / image.width))
+        resized = image.resize((min(width, image.width), height), Image.Resampling.LANCZOS)
+        for fmt, encoded in encode(resized).items():
+            rendered[width, fmt] = encoded
+    return rendered
+
+
+def get_cache():
+    from django.conf import settings
+    from django.core.cache import caches
+    from django.core.cache.backends.base import InvalidCacheBackendError
+
+    try:
+        return caches[getattr(settings, 'RENDITION_CACHE_ALIAS', 'renditions')]
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def _cache_key(name):
+    return f'onboro:renditions:{name}'
+
+
+def _store(name, rendered):
+    from django.core.files.storage import default_storage
+
+    for (width, fmt), data in rendered.items():
+        path = rendition_name(name, width, fmt)
+        # 同じ名前のファイルがあると別名で保存されるので、先に消して置き換える
+        default_storage.delete(path)
+        default_storage.save(path, io.BytesIO(data))
+    get_cache().set(_cache_key(name), True, timeout=None)
+
+
+def generate(names, workers=None, source=None):
+    """元画像(ファイル名のリスト)の縮小版をすべて作り直す。作れた画像のファイル名のリストを返す
+
+    画像のデコードと縮小はCPU処理なので、workersが2以上ならプロセスプールで画像ごとに並列に作る。
+    元画像はすべてメモリに読むので、大量の画像はいくつかずつに分けて渡すこと。
+    """
+    from .storage import uploads
+
+    source = source or uploads()
+    sources = {}
+    for name in dict.fromkeys(name for name in names if name):
+        try:
+            with source.open(name, 'rb') as file:
+                sources[name] = file.read()
+        except OSError:
+            logger.warning('rendition source %s could not be read', name)
+    if not sources:
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    if workers <= 1:
+        results = map(_render_or_none, sources.values())
+        return _store_all(sources, results)
+    # PillowとこのモジュールしかつかわないのでDjangoの初期化はいらない
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        return _store_all(sources, pool.map(_render_or_none, sources.values()))
+
+
+def _store_all(sources, results):
+    done = []
+    for name, rendered in zip(sources, results):
+        if rendered is None:
+            logger.warning('renditions for %s could not be generated', name)
+            continue
+        _store(name, rendered)
+        done.append(name)
+    return done
+
+
+def _render_or_none(data):
+    """壊れた画像などで縮小版を作れなければNoneを返す"""
+    try:
+        return _render(data, SIZES)
+    except Exception:
+        return None
+
+
+def is_generated(name):
+    """縮小版を作ったことがキャッシュに記録されていればTrue"""
+    return bool(get_cache().get(_cache_key(name)))
+
+
+def ensure(name, source=None):
+    """縮小版があればTrueを返す。なければこのプロセスで作り、作れなければFalseを返す"""
+    from django.core.files.storage import default_storage
+
+    from .storage import uploads
+
+    if not name:
+        return False
+    cache = get_cache()
+    state = cache.get(_cache_key(name))
+    if state is not None:
+        return state
+
+    if all(default_storage.exists(rendition_name(name, width, fmt)) for width in SIZES for fmt in FORMATS):
+        cache.set(_cache_key(name), True, timeout=None)
+        return True
+    try:
+        with (source or uploads()).open(name, 'rb') as file:
+            data = file.read()
+    except OSError:
+        # 元画像がない(既定の画像のまま等)ときは、しばらく作り直そうとしない
+        cache.set(_cache_key(name), False, timeout=MISSING_TIMEOUT)
+        return False
+    rendered = _render_or_none(data)
+    if rendered is None:
+        logger.warning('renditions for %s could not be generated', name)
+        cache.set(_cache_key(name), False, timeout=MISSING_TIMEOUT)
+        return False
+    _store(name, rendered)
+    return True
+
+
+def url(name, width, fmt):
+    from django.core.files.storage import default_storage
+
+    return default_storage.url(rendition_name(name, width, fmt))
+
+
+def srcset(name, width, fmt):
+    """表示幅 width の画像の srcset (等倍と2倍) を返す"""
+    candidates = [size for size in SIZES if size >= width][:2]
+    return ', '.join(f'{url(name, size, fmt)} {size / width:g}x' for size in candidates)
+
+
+def delete(name):
+    """元画像を消したときに、その縮小版(アバターなど、同じディレクトリに置いたものも)を消す"""
+    from django.core.files.storage import default_storage
+
+    directory = posixpath.dirname(rendition_name(name, SIZES[0], 'jpeg'))
+    try:
+        _, files = default_storage.listdir(directory)
+    except OSError:
+        files = []
+    for file in files:
+        default_storage.delete(f'{directory}/{file}')
+    get_cache().delete(_cache_key(name))
@@ -0,0 +1,189 @@
+"""売上の日次集計(ロールアップ)
+
+取引記録を保存するたびに、その日の全体・書籍別・カテゴリ別の集計行へ差分を足し込む。
+ledger.apply_record() から呼ばれるので、取引記録の保存と同じトランザクションで更新され、
+どちらか片方だけが残ることはない。
+
+集計画面(sales_dashboard)はこのテーブルだけを読むので、1年分でも数百行の合計で済む。
+集計がずれたときは rebuild_sales_rollups コマンドで取引記録から作り直せる。
+"""
+import datetime as dt
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate, TruncMonth
+from django.utils import timezone
+
+COUNTERS = ['units', 'coins_used', 'coins_charged', 'corrected_plus', 'corrected_minus']
+
+# 作り直すときに一度に書き込む行数
+REBUILD_BATCH_SIZE = 1000
+
+
+def _deltas(kind, amount, sign=1):
+    """取引1件で増える集計値"""
+    from .models import TransactionRecord
+
+    Kind = TransactionRecord.Kind
+    if kind == Kind.USE:
+        return {'units': sign, 'coins_used': sign * amount}
+    if kind == Kind.CHARGE:
+        return {'coins_charged': sign * amount}
+    if kind == Kind.CHANGE_PLUS:
+        return {'corrected_plus': sign * amount}
+    if kind == Kind.CHANGE_MINUS:
+        return {'corrected_minus': sign * amount}
+    return {}
+
+
+def _category_id(record):
+    from .models import Book, TransactionRecord
+
+    if TransactionRecord.book.is_cached(record) and record.book is not None:
+        return record.book.category_id
+    return Book.objects.filter(pk=record.book_id).values_list('category_id', flat=True).first()
+
+
+def _targets(record):
+    """取引記録が足し込まれる集計行 (モデル, キー) の並び"""
+    from .models import DailySales, DailyBookSales, DailyCategorySales
+
+    date = timezone.localdate(record.datetime)
+    yield DailySales, (('date', date),)
+    if record.book_id:
+        yield DailyBookSales, (('date', date), ('book_id', record.book_id))
+        category_id = _category_id(record)
+        if category_id:
+            yield DailyCategorySales, (('date', date), ('category_id', category_id))
+
+
+def _collect(changes, record, sign):
+    for target in _targets(record):
+        changes.setdefault(target, Counter()).update(_deltas(record.kind, record.amount, sign))
+
+
+def _add(model, keys, deltas):
+    deltas = {name: value for name, value in deltas.items() if value}
+    if not deltas:
+        return
+    keys = dict(keys)
+    updates = {name: F(name) + value for name, value in deltas.items()}
+    if model.objects.filter(**keys).update(**updates):
+        return
+    # その日の行がまだなければ作る。同時に作られていたら一意制約で失敗するので、もう一度足し込む
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **deltas)
+    except IntegrityError:
+        model.objects.filter(**keys).update(**updates)
+
+
+def _write(changes):
+    # 行の順番を揃えて、同時に更新してもデッドロックしにくくする
+    for (model, keys), deltas in sorted(changes.items(), key=lambda item: (item[0][0].__name__, item[0][1])):
+        _add(model, keys, deltas)
+
+
+def apply(original, record):
+    """取引記録の保存に合わせて集計を更新する（編集なら元の記録の分を取り消してから足す）"""
+    changes = {}
+    if original is not None:
+        _collect(changes, original, -1)
+    _collect(changes, record, 1)
+    _write(changes)
+
+
+def apply_bulk(records):
+    """まとめて作った取引記録の分を、集計行ごとに1回の更新で足し込む"""
+    changes = {}
+    for record in records:
+        _collect(changes, record, 1)
+    _write(changes)
+
+
+def _day_start(date):
+    return timezone.make_aware(dt.datetime.combine(date, dt.time.min))
+
+
+def _sums():
+    from .models import TransactionRecord
+
+    Kind = TransactionRecord.Kind
+    return {
+        'units': Count('pk', filter=Q(kind=Kind.USE)),
+        'coins_used': Coalesce(Sum('amount', filter=Q(kind=Kind.USE)), 0),
+        'coins_charged': Coalesce(Sum('amount', filter=Q(kind=Kind.CHARGE)), 0),
+        'corrected_plus': Coalesce(Sum('amount', filter=Q(kind=Kind.CHANGE_PLUS)), 0),
+        'corrected_minus': Coalesce(Sum('amount', filter=Q(kind=Kind.CHANGE_MINUS)), 0),
+    }
+
+
+def rebuild(start=None, end=None):
+    """取引記録から集計を作り直す。start・end(どちらも含む)を指定すればその期間だけ作り直す
+
+    アーカイブへ移した取引記録も合わせて集計する。
+    作り直した行数を {モデル名: 行数} で返す。
+    """
+    from .models import ArchivedTransactionRecord, DailySales, DailyBookSales, DailyCategorySales, TransactionRecord
+
+    sources = [TransactionRecord, ArchivedTransactionRecord]
+
+    record_filter, rollup_filter = Q(), Q()
+    if start:
+        record_filter &= Q(datetime__gte=_day_start(start))
+        rollup_filter &= Q(date__gte=start)
+    if end:
+        record_filter &= Q(datetime__lt=_day_start(end + dt.timedelta(days=1)))
+        rollup_filter &= Q(date__lte=end)
+
+    groups = [
+        (DailySales, Q(), ['date'], {}),
+        (DailyBookSales, Q(book__isnull=False), ['date', 'book_id'], {}),
+        (DailyCategorySales, Q(book__isnull=False), ['date', 'book__category_id'],
+         {'book__category_id': 'category_id'}),
+    ]
+    counts = {}
+    with transaction.atomic():
+        for model, group_filter, fields, renames in groups:
+            # 同じ日が両方のテーブルにあることもあるので、キーごとに足し合わせてから書き込む
+            totals = {}
+            for source in sources:
+                rows = (source.objects.filter(record_filter & group_filter)
+                        .annotate(date=TruncDate('datetime'))
+                        .values(*fields).annotate(**_sums()).order_by())
+                for row in rows.iterator(chunk_size=REBUILD_BATCH_SIZE):
+                    key = tuple((renames.get(name, name), row[name]) for name in fields)
+                    totals.setdefault(key, Counter()).update({name: row[name] for name in COUNTERS})
+
+            model.objects.filter(rollup_filter).delete()
+            model.objects.bulk_create(
+                (model(**dict(key), **values) for key, values in totals.items()),
+                batch_size=REBUILD_BATCH_SIZE,
+            )
+            counts[model.__name__] = len(totals)
+    return counts
+
+
+def _totals():
+    # 集計値はモデルのフィールドと同じ名前を付けられないので「_total」を付ける
+    return {f'{name}_total': Coalesce(Sum(name), 0) for name in COUNTERS}
+
+
+def report(start, end, top_books=20):
+    """期間(start〜end、どちらも含む)の売上をまとめる。集計テーブルだけを読む"""
+    from .models import DailySales, DailyBookSales, DailyCategorySales
+
+    period = Q(date__gte=start, date__lte=end)
+    return {
+        'totals': DailySales.objects.filter(period).aggregate(**_totals()),
+        'months': (DailySales.objects.filter(period)
+                   .annotate(month=TruncMonth('date')).values('month')
+                   .annotate(**_totals()).order_by('month')),
+        'categories': (DailyCategorySales.objects.filter(period)
+                       .values('category_id', 'category__name')
+                       .annotate(**_totals()).order_by('-coins_used_total', 'category_id')),
+        'books': (DailyBookSales.objects.filter(period)
+                  .values('book_id', 'book__title')
+                  .annotate(**_totals()).order_by('-coins_used_total', 'book_id')[:top_books]),
+    }
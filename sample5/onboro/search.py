@@ -0,0 +1,221 @@
+"""書籍の全文検索
+
+タイトル・概要・章本文をバイグラム(2文字ずつ)に分割して転置インデックスに登録する。
+形態素解析器なしで日本語の部分一致検索ができ、LIKE '%…%' の全件走査を避けられる。
+SQLiteではFTS5、PostgreSQLではtsvector + GINインデックスを使い、
+どちらも使えない場合は従来のLIKE検索にフォールバックする（章本文は圧縮して保存しているので、
+LIKE検索ではタイトルと概要だけを探す）。
+"""
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEX_TABLE = 'onboro_book_fts'
+
+# 検索結果の最大件数（ヒット件数が多くても応答時間が一定になるよう上限を設ける）
+DEFAULT_RESULT_LIMIT = 1000
+
+# タイトル > 概要 > 本文 の順に重みを付ける
+TITLE_WEIGHT = 10.0
+ABSTRACT_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+# 記号・空白・アンダースコアを区切りとみなし、文字の連続(ラン)を取り出す
+_RUN_PATTERN = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    # 全角英数字・半角カナなどを揃え、英字は小文字にする
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _runs(text):
+    return _RUN_PATTERN.findall(normalize(text))
+
+
+def tokenize(text):
+    """インデックス登録用にバイグラムへ分割する"""
+    terms = []
+    for run in _runs(text):
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        # 末尾の1文字も登録しておくと、1文字検索を前方一致で拾える
+        terms.append(run[-1])
+    return ' '.join(terms)
+
+
+def query_terms(word):
+    """検索語を(バイグラムの並び, 1文字)のリストに分割する
+
+    2文字以上のランは隣接するバイグラムのフレーズとして、
+    1文字のランは前方一致として検索する。
+    """
+    phrases = []
+    for run in _runs(word):
+        if len(run) == 1:
+            phrases.append(([], run))
+        else:
+            phrases.append(([run[i:i + 2] for i in range(len(run) - 1)], None))
+    return phrases
+
+
+def result_limit():
+    return getattr(settings, 'SEARCH_RESULT_LIMIT', DEFAULT_RESULT_LIMIT)
+
+
+# ---- インデックスのテーブル（マイグレーション0010で作る） ----
+
+def is_available(using=None):
+    using = using or connection
+    if using.vendor not in ('sqlite', 'postgresql'):
+        return False
+    # テーブルの有無は接続ごとに一度だけ調べる
+    if not hasattr(using, '_onboro_fts_available'):
+        with using.cursor() as cursor:
+            tables = using.introspection.table_names(cursor)
+        using._onboro_fts_available = INDEX_TABLE in tables
+    return using._onboro_fts_available
+
+
+# ---- インデックスの更新 ----
+
+def write_documents(cursor, vendor, documents):
+    """(book_id, title, abstract, body) の並びをインデックスに書き込む"""
+    for book_id, title, abstract, body in documents:
+        cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE {_id_column(vendor)} = %s', [book_id])
+        if vendor == 'sqlite':
+            cursor.execute(
+                f'INSERT INTO {INDEX_TABLE} (rowid, title, abstract, body) VALUES (%s, %s, %s, %s)',
+                [book_id, tokenize(title), tokenize(abstract), tokenize(body)],
+            )
+        else:
+            cursor.execute(
+                f"INSERT INTO {INDEX_TABLE} (book_id, document) VALUES (%s, "
+                f"setweight(to_tsvector('simple', %s), 'A') || "
+                f"setweight(to_tsvector('simple', %s), 'B') || "
+                f"setweight(to_tsvector('simple', %s), 'C'))",
+                [book_id, tokenize(title), tokenize(abstract), tokenize(body)],
+            )
+
+
+def _id_column(vendor):
+    return 'rowid' if vendor == 'sqlite' else 'book_id'
+
+
+def index_book(book_id):
+    """書籍1冊分のインデックスを作り直す（存在しなければ削除する）"""
+    if not is_available():
+        return
+    from .models import Book, Chapter
+
+    book = Book.objects.filter(pk=book_id).values('title', 'abstract').first()
+    with connection.cursor() as cursor:
+        if book is None:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE {_id_column(connection.vendor)} = %s', [book_id])
+            return
+        bodies = Chapter.objects.filter(book_id=book_id).order_by('number').values_list('body', flat=True)
+        write_documents(cursor, connection.vendor, [
+            (book_id, book['title'], book['abstract'], '\n'.join(map(str, bodies))),
+        ])
+
+
+def schedule_index_book(book_id):
+    # 保存処理のトランザクションが確定してからインデックスを更新する
+    transaction.on_commit(lambda: index_book(book_id))
+
+
+def rebuild_index(book_model, chapter_model, using=None, batch_size=500):
+    """全書籍のインデックスを作り直す"""
+    using = using or connection
+    with using.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {INDEX_TABLE}')
+        books = book_model.objects.using(using.alias).order_by('pk').values_list('pk', 'title', 'abstract')
+        batch = []
+        for book in books.iterator(chunk_size=batch_size):
+            batch.append(book)
+            if len(batch) >= batch_size:
+                _write_batch(cursor, using, chapter_model, batch)
+                batch = []
+        if batch:
+            _write_batch(cursor, using, chapter_model, batch)
+
+
+def _write_batch(cursor, using, chapter_model, books):
+    bodies = {}
+    chapters = (chapter_model.objects.using(using.alias)
+                .filter(book_id__in=[pk for pk, _, _ in books])
+                .order_by('book_id', 'number')
+                .values_list('book_id', 'body'))
+    for book_id, body in chapters:
+        # 章本文は圧縮したまま読まれるので、ここで展開する(fields.py)
+        bodies.setdefault(book_id, []).append(str(body))
+    write_documents(cursor, using.vendor, [
+        (pk, title, abstract, '\n'.join(bodies.get(pk, []))) for pk, title, abstract in books
+    ])
+
+
+# ---- 検索 ----
+
+def search_book_ids(word, category=None, limit=None):
+    """公開中の書籍を検索し、関連度の高い順に書籍IDのリストを返す"""
+    limit = limit or result_limit()
+    phrases = query_terms(word)
+    if not phrases:
+        return []
+    if not is_available():
+        return _search_like(word, category, limit)
+
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        match = ' AND '.join(_fts5_phrase(bigrams, char) for bigrams, char in phrases)
+        sql = (f'SELECT f.rowid FROM {INDEX_TABLE} f '
+               f'INNER JOIN onboro_book b ON b.id = f.rowid '
+               f'WHERE {INDEX_TABLE} MATCH %s AND b.published')
+        params = [match]
+        order = f'bm25({INDEX_TABLE}, {TITLE_WEIGHT}, {ABSTRACT_WEIGHT}, {BODY_WEIGHT}), f.rowid'
+    else:
+        tsquery = ' && '.join(
+            "phraseto_tsquery('simple', %s)" if bigrams else "to_tsquery('simple', %s)"
+            for bigrams, _ in phrases
+        )
+        sql = (f'SELECT f.book_id FROM {INDEX_TABLE} f '
+               f'INNER JOIN onboro_book b ON b.id = f.book_id '
+               f'CROSS JOIN (SELECT {tsquery} AS query) q '
+               f'WHERE f.document @@ q.query AND b.published')
+        params = [' '.join(bigrams) if bigrams else f"'{char}':*" for bigrams, char in phrases]
+        # ts_rankの重みは{D, C, B, A}の順で0〜1の範囲に収める
+        weights = '{0, %s, %s, 1}' % (BODY_WEIGHT / TITLE_WEIGHT, ABSTRACT_WEIGHT / TITLE_WEIGHT)
+        order = f"ts_rank('{weights}', f.document, q.query) DESC, f.book_id"
+
+    if category:
+        sql += ' AND b.category_id = %s'
+        params.append(category)
+    sql += f' ORDER BY {order} LIMIT %s'
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _fts5_phrase(bigrams, char):
+    if bigrams:
+        return '"%s"' % ' '.join(bigrams)
+    return '"%s"*' % char
+
+
+def _search_like(word, category, limit):
+    from .models import Book
+
+    books = Book.objects.filter(published=True)
+    if category:
+        books = books.filter(category__pk=category)
+    # 章本文は圧縮して保存しているのでLIKEでは探せない(fields.py)
+    books = books.filter(Q(title__contains=word) | Q(abstract__contains=word))
+    return list(books.order_by('pk').values_list('pk', flat=True)[:limit])
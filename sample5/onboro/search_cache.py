@@ -0,0 +1,70 @@
+"""書籍検索結果のキャッシュ
+
+(カテゴリ, 検索ワード) ごとに、ヒットした書籍IDの並びをキャッシュする。
+キーにはカタログのバージョン番号を含め、書籍・章・カテゴリが変更されたら
+バージョンを上げることで古い検索結果を一切返さないようにする。
+古いバージョンのエントリはTTLとキャッシュの上限(LocMemCacheはLRU)で自然に消える。
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import transaction
+
+from . import search
+
+VERSION_KEY = 'onboro:search:catalog_version'
+
+
+def get_cache():
+    try:
+        return caches[getattr(settings, 'SEARCH_CACHE_ALIAS', 'search')]
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def catalog_version(cache=None):
+    cache = cache or get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # 初回やエビクション後は、これまでのどの番号よりも大きい現在時刻(ns)から始める
+        # （1からやり直すと、まだ残っている古い v1 の結果を返してしまう）。
+        # add なので他プロセスと競合しても上書きしない
+        version = time.time_ns()
+        cache.add(VERSION_KEY, version, timeout=None)
+        version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # キーがなければ新しく作る
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate():
+    # 変更が確定してから(検索インデックスの更新より後に)バージョンを上げる
+    transaction.on_commit(bump_catalog_version)
+
+
+def cache_key(word, category, version):
+    # 検索ワードは正規化してからハッシュにし、キーに使えない文字を避ける
+    normalized = ' '.join(search.normalize(word).split())
+    digest = hashlib.sha1(f'{category or ""}\0{normalized}'.encode()).hexdigest()
+    return f'onboro:search:v{version}:{digest}'
+
+
+def search_book_ids(word, category=None):
+    """search.search_book_ids と同じ結果を、キャッシュがあればDBに問い合わせずに返す"""
+    cache = get_cache()
+    key = cache_key(word, category, catalog_version(cache))
+    book_ids = cache.get(key)
+    if book_ids is None:
+        book_ids = search.search_book_ids(word, category=category)
+        cache.set(key, book_ids, timeout=getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300))
+    return book_ids
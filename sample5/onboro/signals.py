@@ -1,7 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, post_delete
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from .models import UserProfile
+from .models import UserProfile, Category, ImageUpload, Book, Chapter, TransactionRecord, Ownership
+from . import avatars, entitlements, search, search_cache, storage, suggest, toc
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -10,4 +11,82 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.userprofile.save()
\ No newline at end of file
+    instance.userprofile.save()
+
+# 書籍・章が変更されたら、その書籍の検索インデックスだけを更新し、検索結果のキャッシュを無効にする
+# （公開/非公開の切り替えもBookの保存なのでここで拾える）
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def update_book_search_index(sender, instance, **kwargs):
+    search.schedule_index_book(instance.pk)
+    search_cache.invalidate()
+    suggest.schedule_update(instance.pk)
+
+@receiver(post_save, sender=Chapter)
+@receiver(post_delete, sender=Chapter)
+def update_chapter_search_index(sender, instance, **kwargs):
+    search.schedule_index_book(instance.book_id)
+    search_cache.invalidate()
+    toc.invalidate(instance.book_id)
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_search_cache(sender, instance, **kwargs):
+    search_cache.invalidate()
+
+# 購入や管理画面での取引記録の編集があったら、そのユーザーの閲覧権限キャッシュを無効にする
+@receiver(post_save, sender=Ownership)
+@receiver(post_delete, sender=Ownership)
+@receiver(post_save, sender=TransactionRecord)
+def invalidate_entitlements(sender, instance, **kwargs):
+    entitlements.invalidate(instance.user_id)
+
+# アイコン・文字の大きさ・背景色が変わったら、ナビゲーションバー用のキャッシュを消す
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_user_chrome(sender, instance, **kwargs):
+    avatars.invalidate(instance.user_id)
+
+# アップロードしたファイルの参照数(StoredFile.ref_count)を、ファイルのフィールドの変更に合わせて増減する
+# 読み込んだ時点のファイル名を覚えておき、保存したときに変わっていれば新しいファイルを+1、前のファイルを-1する
+FILE_FIELDS = {
+    UserProfile: ['icon'],
+    ImageUpload: ['image'],
+    Book: ['image'],
+}
+
+def _file_name(value):
+    return getattr(value, 'name', value) or None
+
+@receiver(post_init, sender=UserProfile)
+@receiver(post_init, sender=ImageUpload)
+@receiver(post_init, sender=Book)
+def remember_stored_files(sender, instance, **kwargs):
+    # only()などで読まなかったフィールドは覚えない（元の値がわからないので、保存しても数を変えない）
+    instance._stored_files = {
+        name: _file_name(instance.__dict__[name]) for name in FILE_FIELDS[sender] if name in instance.__dict__
+    }
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_save, sender=ImageUpload)
+@receiver(post_save, sender=Book)
+def count_stored_file_references(sender, instance, created, update_fields=None, **kwargs):
+    for name in FILE_FIELDS[sender]:
+        if update_fields is not None and name not in update_fields:
+            continue
+        if not created and name not in instance._stored_files:
+            continue
+        old = None if created else instance._stored_files[name]
+        new = _file_name(getattr(instance, name))
+        if new != old:
+            storage.add_reference(new)
+            storage.remove_reference(old)
+            instance._stored_files[name] = new
+
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_delete, sender=ImageUpload)
+@receiver(post_delete, sender=Book)
+def release_stored_files(sender, instance, **kwargs):
+    for name in FILE_FIELDS[sender]:
+        if name in instance._stored_files:
+            storage.remove_reference(instance._stored_files[name])
@@ -0,0 +1,213 @@
+"""アップロードされた画像を中身のハッシュで保存するストレージ
+
+同じ画像を何度アップロードしても、ファイルは cas/<ハッシュ先頭2文字>/<次の2文字>/<SHA-256><拡張子> に1つだけ置く。
+ファイル名が中身で決まるので、URLの指す中身は変わらず、ブラウザやCDNにずっとキャッシュさせてよい。
+
+- 保存するときは、アップロードをチャンクごとに一時ファイルへ書きながらハッシュを計算し、
+  最後に一時ファイルをハッシュの名前へ移す（メモリに全体を読まない）。同じ中身がすでにあれば一時ファイルを捨てる
+- ファイルごとに StoredFile の行を作り、そのファイルを指しているフィールドの数(ref_count)を数える。
+  数は signals.py でモデルの保存・削除のたびに増減する
+- 他から参照されているかもしれないので、delete() ではファイルを消さない。
+  参照のなくなったファイルは gc_media コマンドで消す
+
+静的ファイル用のストレージ(StaticFilesStorage)もここに置く。
+"""
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import transaction
+from django.db.models import F, FileField
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+# 拡張子として名前に残す文字（それ以外の拡張子は付けない）
+_EXTENSION = re.compile(r'\.[a-z0-9]{1,10}')
+
+PREFIX = 'cas/'
+
+
+def uploads():
+    """アップロード用のストレージ（settings.STORAGES の 'uploads'）。FileFieldの storage に渡す"""
+    return storages['uploads']
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # 名前は保存するときに中身から決めるので、ここでは別名にしない
+        return name
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        directory = self.path(PREFIX + 'tmp')
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temporary:
+            try:
+                size = 0
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temporary.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                temporary.close()
+                os.unlink(temporary.name)
+                raise
+
+        stored = self.hashed_name(digest.hexdigest(), name)
+        path = self.path(stored)
+        # 行の登録とファイルの配置を1つのトランザクションにして、gc_media が同じファイルを消すのと交互にならないようにする
+        with transaction.atomic():
+            register(stored, size)
+            if os.path.exists(path):
+                # 同じ中身のファイルがすでにある
+                os.unlink(temporary.name)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temporary.name, self.file_permissions_mode)
+                # 同じ中身を同時に保存しても、置き換えは原子的で中身も同じなので問題ない
+                os.replace(temporary.name, path)
+        return stored
+
+    @staticmethod
+    def hashed_name(hexdigest, name):
+        extension = posixpath.splitext(name)[1].lower()
+        if not _EXTENSION.fullmatch(extension):
+            extension = ''
+        return f'{PREFIX}{hexdigest[:2]}/{hexdigest[2:4]}/{hexdigest}{extension}'
+
+    def delete(self, name):
+        # 同じファイルを他の行が指していることがあるので、消すのは gc_media に任せる
+        pass
+
+    def purge(self, name):
+        """ファイルを実際に消す（gc_media から、参照がないことを確かめてから呼ぶ）"""
+        super().delete(name)
+
+
+def is_content_addressed(name):
+    return bool(name) and name.startswith(PREFIX)
+
+
+def register(name, size):
+    """保存したファイルの行を作る。すでにあれば保存日時を更新して、しばらく gc_media の対象から外す"""
+    from .models import StoredFile
+
+    now = timezone.now()
+    if not StoredFile.objects.filter(name=name).update(stored_at=now):
+        StoredFile.objects.get_or_create(name=name, defaults={'size': size, 'stored_at': now})
+
+
+def add_reference(name):
+    from .models import StoredFile
+
+    if is_content_addressed(name):
+        StoredFile.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+
+def remove_reference(name):
+    from .models import StoredFile
+
+    if is_content_addressed(name):
+        StoredFile.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+
+
+def tracked_fields():
+    """このストレージを使っているファイルのフィールドを (モデル, フィールド) で返す"""
+    from django.apps import apps
+
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorage):
+                yield model, field
+
+
+def referenced_names(names=None):
+    """各フィールドから参照されている回数を {ファイル名: 回数} で数える。namesを渡すとそのファイルだけ数える"""
+    from django.db.models import Count
+
+    counts = {}
+    for model, field in tracked_fields():
+        if names is None:
+            queryset = model._default_manager.filter(**{f'{field.name}__startswith': PREFIX})
+        else:
+            queryset = model._default_manager.filter(**{f'{field.name}__in': names})
+        rows = queryset.order_by().values_list(field.name).annotate(references=Count('pk'))
+        for name, references in rows:
+            counts[name] = counts.get(name, 0) + references
+    return counts
+
+
+def recount():
+    """ref_count をモデルの実際の参照数に合わせる（シグナルを通らない update() などのずれを直す）。直した行数を返す"""
+    from .models import StoredFile
+
+    counts = referenced_names()
+    fixed = 0
+    for stored in StoredFile.objects.only('name', 'ref_count').iterator():
+        references = counts.get(stored.name, 0)
+        if stored.ref_count != references:
+            StoredFile.objects.filter(pk=stored.pk).update(ref_count=references)
+            fixed += 1
+    return fixed
+
+
+def collect_garbage(older_than, batch_size=500):
+    """参照のないファイルのうち、最後に保存されたのが older_than より前のものを消す。消したファイル数とバイト数を返す
+
+    保存したばかりのファイルは、まだモデルの保存(参照の追加)が終わっていないだけかもしれないので残す。
+    """
+    from . import renditions
+    from .models import StoredFile
+
+    storage = uploads()
+    deleted = size = 0
+    candidates = StoredFile.objects.filter(ref_count=0, stored_at__lt=older_than).order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(candidates.filter(pk__gt=last_pk).only('name', 'size')[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        # 数え直して、まだ参照されているものは ref_count を直して残す
+        still_referenced = referenced_names([stored.name for stored in batch])
+        for stored in batch:
+            if stored.name in still_referenced:
+                StoredFile.objects.filter(pk=stored.pk).update(ref_count=still_referenced[stored.name])
+                continue
+            # 行を消せたプロセスだけがファイルを消す。その間に同じ中身が保存されたら(保存日時が新しくなるので)消さない
+            with transaction.atomic():
+                orphan = StoredFile.objects.filter(pk=stored.pk, ref_count=0, stored_at__lt=older_than)
+                if not orphan.delete()[0]:
+                    continue
+                storage.purge(stored.name)
+            renditions.delete(stored.name)
+            deleted += 1
+            size += stored.size
+    return deleted, size
+
+
+def adopt(name, source):
+    """ハッシュの名前でない(以前の)ファイルをこのストレージに入れ、新しい名前を返す。元のファイルはそのまま残す"""
+    storage = uploads()
+    with source.open(name, 'rb') as file:
+        return storage.save(name, file)
+
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """collectstatic で中身のハッシュの名前と gzip・brotli版を作る（settings.STORAGES の 'staticfiles'）
+
+    同梱しているBootstrapの最後の sourceMappingURL のコメントは、配布していない .map ファイルを指している。
+    名前を置き換えようとすると見つからずに collectstatic が失敗するので、このコメントだけは置き換えない
+    （同梱しているファイルは配布元のまま変えない）。ブラウザの開発者ツールで .map が404になるだけで、表示には影響しない。
+    """
+    patterns = tuple(
+        (extension, tuple(pattern for pattern in extension_patterns if 'sourceMappingURL' not in pattern[0]))
+        for extension, extension_patterns in CompressedManifestStaticFilesStorage.patterns
+    )
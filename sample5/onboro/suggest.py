@@ -0,0 +1,176 @@
+"""検索ワードの入力補完(サジェスト)
+
+公開中の書籍タイトルを正規化したキーでソートした配列としてプロセス内に持ち、
+二分探索で前方一致する候補を返す。キーストロークごとにDBへ問い合わせない。
+
+正規化では全角/半角を揃え(NFKC)、英字を小文字にし、カタカナをひらがなに寄せるので
+「ぱいそん」でも「パイソン」でも同じ候補が出る。
+"""
+import bisect
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.db import transaction
+
+from . import search_cache
+from .search import normalize
+
+VERSION_KEY = 'onboro:suggest:version'
+
+DEFAULT_LIMIT = 10
+
+# 他のワーカープロセスでの書籍変更を確認する間隔(秒)
+VERSION_CHECK_INTERVAL = 1.0
+
+# カタカナ(ァ〜ヶ)をひらがなに変換する表
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord('ァ'), ord('ヶ') + 1)}
+
+
+def suggest_key(text):
+    return normalize(text).translate(_KATAKANA_TO_HIRAGANA)
+
+
+class PrefixIndex:
+    """正規化したタイトルのソート済み配列と、同じ並びの書籍IDの配列"""
+
+    def __init__(self):
+        self._keys = []
+        self._ids = array('q')
+        self._titles = {}
+
+    def __len__(self):
+        return len(self._titles)
+
+    def build(self, rows):
+        """(book_id, title) の並びから作り直す"""
+        entries = sorted((suggest_key(title), book_id, title) for book_id, title in rows)
+        self._keys = [key for key, _, _ in entries]
+        self._ids = array('q', (book_id for _, book_id, _ in entries))
+        self._titles = {book_id: title for _, book_id, title in entries}
+
+    def add(self, book_id, title):
+        self.remove(book_id)
+        key = suggest_key(title)
+        i = bisect.bisect_left(self._keys, key)
+        # 同じキーの中では書籍ID順に並べる
+        while i < len(self._keys) and self._keys[i] == key and self._ids[i] < book_id:
+            i += 1
+        self._keys.insert(i, key)
+        self._ids.insert(i, book_id)
+        self._titles[book_id] = title
+
+    def remove(self, book_id):
+        title = self._titles.pop(book_id, None)
+        if title is None:
+            return
+        key = suggest_key(title)
+        i = bisect.bisect_left(self._keys, key)
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._ids[i] == book_id:
+                del self._keys[i]
+                del self._ids[i]
+                return
+            i += 1
+
+    def lookup(self, prefix, limit=DEFAULT_LIMIT):
+        key = suggest_key(prefix)
+        if not key:
+            return []
+        results = []
+        i = bisect.bisect_left(self._keys, key)
+        while i < len(self._keys) and len(results) < limit and self._keys[i].startswith(key):
+            book_id = self._ids[i]
+            results.append((book_id, self._titles[book_id]))
+            i += 1
+        return results
+
+
+class _Suggester:
+    """プロセスごとに1つだけ持つサジェスト用インデックス"""
+
+    def __init__(self):
+        self.index = None
+        self.version = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        from .models import Book
+
+        index = PrefixIndex()
+        index.build(Book.objects.filter(published=True).values_list('pk', 'title').iterator(chunk_size=5000))
+        return index
+
+    def get_index(self):
+        now = time.monotonic()
+        interval = getattr(settings, 'SUGGEST_VERSION_CHECK_INTERVAL', VERSION_CHECK_INTERVAL)
+        if self.index is not None and now - self.checked_at < interval:
+            return self.index
+
+        with self.lock:
+            version = _current_version()
+            # 他のプロセスで書籍が変更されていれば作り直す
+            if self.index is None or version != self.version:
+                self.index = self._load()
+                self.version = version
+            self.checked_at = now
+        return self.index
+
+    def apply(self, book_id):
+        """書籍1冊分の変更を差分で反映する"""
+        from .models import Book
+
+        book = Book.objects.filter(pk=book_id).values('title', 'published').first()
+        _bump_version()
+        with self.lock:
+            if self.index is None:
+                return
+            # 作り直すまでの間もこのプロセスでは変更後の候補を出す。
+            # self.version は変えないので、次の確認でバージョンが進んでいれば作り直す
+            # (incr はキャッシュによっては不可分でなく、同時に上げた他のプロセスと同じ番号になることがあるので、
+            # 番号から「自分の変更だけ」とは判断できない)
+            if book and book['published']:
+                self.index.add(book_id, book['title'])
+            else:
+                self.index.remove(book_id)
+
+
+_suggester = _Suggester()
+
+
+def _new_version():
+    # キャッシュから消えたバージョンを1から始め直すと、すでにv1のインデックスを持っているプロセスが
+    # 作り直さなくなる。これまでに使ったどの番号よりも大きい現在時刻(ns)から始める
+    return time.time_ns()
+
+
+def _current_version():
+    cache = search_cache.get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = _new_version()
+        cache.add(VERSION_KEY, version, timeout=None)
+        version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def _bump_version():
+    """バージョンを上げ、上げた後のバージョンを返す"""
+    cache = search_cache.get_cache()
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        version = _new_version()
+        cache.add(VERSION_KEY, version, timeout=None)
+        return cache.get(VERSION_KEY, version)
+
+
+def schedule_update(book_id):
+    transaction.on_commit(lambda: _suggester.apply(book_id))
+
+
+def suggest(prefix, limit=DEFAULT_LIMIT):
+    """前方一致する (書籍ID, タイトル) のリストを返す"""
+    return _suggester.get_index().lookup(prefix, limit)
@@ -0,0 +1,79 @@
+"""管理画面用のテンプレートタグ
+
+取引記録の一覧の日付階層(date_hierarchy)は、Django標準だと
+SELECT DISTINCT 年(月・日) FROM 取引記録 で全行を読むので、行数が多いと数秒かかる。
+ここでは選択肢の年・月・日を売上の日次集計(DailySales)から作り、
+取引記録のテーブルは日時のインデックスで最初と最後の日時を引くだけにする。
+"""
+import datetime as dt
+
+from django import template
+from django.contrib.admin.templatetags.admin_list import date_hierarchy
+from django.contrib.admin.templatetags.base import InclusionAdminNode
+from django.utils import timezone
+
+register = template.Library()
+
+
+class _RollupDates:
+    """date_hierarchy() が使う aggregate()・datetimes() だけを、集計テーブルで答える"""
+
+    def __init__(self, queryset, field_name):
+        self._queryset = queryset
+        self._field_name = field_name
+        self._bounds = None
+
+    def aggregate(self, **aggregates):
+        # date_hierarchy() からは first=Min(日時), last=Max(日時) で呼ばれる
+        if self._bounds is None:
+            # MIN・MAXを別々に引くと、どちらもインデックスの端を読むだけで済む
+            values = self._queryset.order_by().values_list(self._field_name, flat=True)
+            self._bounds = {
+                'first': values.order_by(self._field_name).first(),
+                'last': values.order_by(f'-{self._field_name}').first(),
+            }
+        return self._bounds
+
+    def datetimes(self, field_name, kind, *args, **kwargs):
+        from onboro.models import DailySales
+
+        bounds = self.aggregate()
+        if bounds['first'] is None:
+            return []
+        # 絞り込み(種別・検索)は反映しないので、その条件では取引のない日が出ることもある
+        days = DailySales.objects.filter(
+            date__gte=timezone.localdate(bounds['first']),
+            date__lte=timezone.localdate(bounds['last']),
+        ).values_list('date', flat=True)
+        if kind == 'year':
+            starts = {day.replace(month=1, day=1) for day in days}
+        elif kind == 'month':
+            starts = {day.replace(day=1) for day in days}
+        else:
+            starts = set(days)
+        return [timezone.make_aware(dt.datetime.combine(day, dt.time.min)) for day in sorted(starts)]
+
+
+class _ChangeList:
+    """querysetだけを _RollupDates に差し替えたChangeList"""
+
+    def __init__(self, cl):
+        self._cl = cl
+        self.queryset = _RollupDates(cl.queryset, cl.date_hierarchy)
+
+    def __getattr__(self, name):
+        return getattr(self._cl, name)
+
+
+def rollup_date_hierarchy(cl):
+    return date_hierarchy(_ChangeList(cl))
+
+
+@register.tag(name='rollup_date_hierarchy')
+def rollup_date_hierarchy_tag(parser, token):
+    return InclusionAdminNode(
+        parser, token,
+        func=rollup_date_hierarchy,
+        template_name='date_hierarchy.html',
+        takes_context=False,
+    )
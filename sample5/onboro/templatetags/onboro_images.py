@@ -0,0 +1,33 @@
+"""書籍の表紙画像を表示するテンプレートタグ
+
+{% cover_image book 30 %} で、幅30pxの表紙を縮小版(onboro.renditions)から表示する。
+WebPに対応したブラウザにはWebPを、それ以外にはJPEGを、画面の解像度に合わせて等倍か2倍で読ませる。
+"""
+from django import template
+from django.utils.html import format_html
+
+from onboro import renditions
+
+register = template.Library()
+
+
+@register.simple_tag
+def cover_image(book, width):
+    name = book.image.name
+    if not renditions.ensure(name, book.image.storage):
+        # 縮小版を作れない(元画像がない等)ときは、これまでどおり元画像を縮めて表示する
+        return format_html(
+            '<img src="{}" alt="{}" style="width: {}px; height: auto;">',
+            book.image.url if name else '', book.title, width,
+        )
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}">'
+        '<img src="{}" srcset="{}" alt="{}" style="width: {}px; height: auto;">'
+        '</picture>',
+        renditions.srcset(name, width, 'webp'),
+        renditions.url(name, width, 'jpeg'),
+        renditions.srcset(name, width, 'jpeg'),
+        book.title,
+        width,
+    )
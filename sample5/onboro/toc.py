@@ -0,0 +1,102 @@
+"""書籍ごとの目次（章番号・章名と前後の章。本文は持たない）
+
+書籍の詳細ページの章一覧と、章のページの「前の章・次の章」はこの目次から作る。
+目次は章の本文を読まない .only() のクエリ1回で作り、書籍ごとにキャッシュする。
+章が保存・削除されたら、その書籍の目次を消す(signals.py)。
+
+章番号は1から連続しているとは限らない（章を消したり、10・20…と付けたり）ので、
+前後の章は「番号が±1の章」ではなく「番号の並びで隣の章」にする。
+"""
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import transaction
+
+
+class TocEntry:
+    def __init__(self, pk, number, title, updated_at):
+        self.pk = pk
+        self.number = number
+        self.title = title
+        self.updated_at = updated_at
+
+    def title_with_number(self):
+        from .models import Chapter
+
+        return Chapter.format_title(self.number, self.title)
+
+
+class TableOfContents:
+    def __init__(self, book_id, entries):
+        self.book_id = book_id
+        # 章番号の順
+        self.entries = tuple(entries)
+        self._numbers = [entry.number for entry in self.entries]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def etag_parts(self):
+        """目次の表示に使う値（ページのETag用）"""
+        return [(entry.pk, entry.number, entry.title) for entry in self.entries]
+
+    @property
+    def updated_at(self):
+        """いちばん新しい章の更新日時（章がなければNone）"""
+        return max((entry.updated_at for entry in self.entries), default=None)
+
+    def get(self, number):
+        index = bisect_left(self._numbers, number)
+        if index < len(self.entries) and self._numbers[index] == number:
+            return self.entries[index]
+        return None
+
+    def neighbours(self, number):
+        """章番号 number の前の章と次の章を (前, 次) で返す（なければNone）"""
+        before = bisect_left(self._numbers, number)
+        after = bisect_right(self._numbers, number)
+        previous = self.entries[before - 1] if before > 0 else None
+        following = self.entries[after] if after < len(self.entries) else None
+        return previous, following
+
+
+def get_cache():
+    try:
+        return caches[getattr(settings, 'TOC_CACHE_ALIAS', 'toc')]
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def _cache_key(book_id):
+    return f'onboro:toc:{book_id}'
+
+
+def build(book_id):
+    """目次をDBから作る（章の本文は読まない）"""
+    from .models import Chapter
+
+    chapters = Chapter.objects.filter(book_id=book_id).order_by('number', 'pk').only('number', 'title', 'updated_at')
+    return TableOfContents(book_id, [
+        TocEntry(chapter.pk, chapter.number, chapter.title, chapter.updated_at) for chapter in chapters
+    ])
+
+
+def for_book(book_id):
+    """書籍の目次（キャッシュにあればDBは使わない）"""
+    cache = get_cache()
+    key = _cache_key(book_id)
+    contents = cache.get(key)
+    if contents is None:
+        contents = build(book_id)
+        cache.set(key, contents, timeout=getattr(settings, 'TOC_CACHE_TIMEOUT', 3600))
+    return contents
+
+
+def invalidate(book_id):
+    # 章の変更が確定してから消す
+    transaction.on_commit(lambda: get_cache().delete(_cache_key(book_id)))
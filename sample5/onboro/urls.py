@@ -1,11 +1,10 @@
 from django.urls import path
 from setuptools.extern import names
 from django.conf import settings
-from django.conf.urls.static import static
 from .views import edit_transaction
 from .views import my_page_settings
 
-from . import views
+from . import media, views
 
 app_name = 'onboro'
 urlpatterns = [
@@ -17,10 +16,15 @@ urlpatterns = [
     path('users/<int:pk>', views.UserDetailView.as_view(), name='user_detail'),
     path('my_page/settings/', views.my_page_settings, name='my_page_settings'),
     path('users/import', views.user_import, name='user_import'),
+    path('users/charge', views.coin_bulk_charge, name='coin_bulk_charge'),
+    path('sales', views.sales_dashboard, name='sales_dashboard'),
+    path('jobs/<int:pk>', views.job_status, name='job_status'),
 
     path('search', views.BookSearchView.as_view(), name='book_search'),
+    path('search/suggest', views.book_suggest, name='book_suggest'),
     path('books/<int:pk>', views.BookDetailView.as_view(), name='book_detail'),
     path('books/<int:book_id>/chapters/<int:number>', views.BookChapterView.as_view(), name='book_chapter'),
+    path('books/<int:book_id>/progress', views.reading_progress, name='reading_progress'),
 
     path('users/<int:pk>/transactions/charge', views.transaction_charge, name='transaction_charge'),
     path('users/<int:pk>/transactions/use', views.transaction_use, name='transaction_use'),
@@ -29,4 +33,7 @@ urlpatterns = [
 
 # 画像のアップロード用URL追加
     path('books/<int:pk>/upload_image/', views.BookImageUploadView.as_view(), name='upload_image'),  # 書籍の画像アップロード
-]+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) # その他のURLパターン
+
+    # アップロードされたファイル（DEBUGでなくても配信する。前段にWebサーバーがあれば送信はそちらに任せる）
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', media.serve, name='media'),
+]
@@ -9,9 +9,14 @@ from django.contrib.auth import mixins as auth_mixins
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib import messages
 from django.db import transaction, IntegrityError
-from django.db.models import Q
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from django.http import HttpResponseForbidden
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse,
+    StreamingHttpResponse,
+)
+from django.template.loader import render_to_string
 from django.contrib.auth.mixins import LoginRequiredMixin
 from .forms import BookImageUploadForm  # アップロード用のフォームをインポート
 from .forms import TransactionRecordForm  # 取引記録フォームを作成する必要があります
@@ -21,11 +26,14 @@ from .forms import CustomSettingForm, IconUploadForm
 
 import csv
 import codecs
+import datetime
+import math
 
 from unicodedata import category
 
-from .models import User, Book, TransactionRecord
-from .forms import UserImportForm, BookSearchForm, CoinChargeForm, CoinUseForm
+from .models import User, Book, Chapter, TransactionRecord, Job
+from .forms import UserImportForm, BulkChargeForm, BookSearchForm, CoinChargeForm, CoinUseForm, SalesReportForm
+from . import archive, avatars, chapters, conditional, entitlements, jobs, ledger, pagination, progress, renditions, rollups, search_cache, suggest, toc
 
 import logging
 
@@ -40,9 +48,50 @@ class BookSearchMixin:
         return context
 
 
+def transaction_history(request, user, param='history_cursor'):
+    """取引記録の一覧(新しい順のページ)と種別ごとの合計を返す（アーカイブへ移した月も含む）"""
+    records = [queryset.select_related('book') for queryset in archive.user_records(user)]
+    page = pagination.paginate_many(
+        records, ['-datetime', '-pk'],
+        cursor=request.GET.get(param),
+        page_size=pagination.page_size_from(request),
+    ).link_queries(request, param)
+
+    # 種別ごとの合計はテーブルごとに1回の集計クエリでまとめて求める
+    Kind = TransactionRecord.Kind
+    summary = archive.sum_aggregates(
+        records,
+        charged=Coalesce(Sum('amount', filter=Q(kind=Kind.CHARGE)), 0),
+        used=Coalesce(Sum('amount', filter=Q(kind=Kind.USE)), 0),
+        corrected_plus=Coalesce(Sum('amount', filter=Q(kind=Kind.CHANGE_PLUS)), 0),
+        corrected_minus=Coalesce(Sum('amount', filter=Q(kind=Kind.CHANGE_MINUS)), 0),
+    )
+    return {'transaction_history': page, 'transaction_summary': summary}
+
+
 class HomeView(BookSearchMixin, generic.TemplateView):
     template_name = 'onboro/home.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        user = self.request.user
+        if user.is_authenticated:
+            # 本棚は購入した書籍をID順にカーソルでページングする。並び順と続きの条件は購入済み書籍の
+            # (user, book) の一意インデックスで処理できるよう、書籍側ではなく購入済み書籍側の書籍IDで書く
+            books = (Book.objects.filter(ownership__user=user)
+                     .annotate(owned_book_id=F('ownership__book_id')).select_related('category'))
+            context['bookshelf'] = pagination.paginate(
+                books, ['owned_book_id'],
+                cursor=self.request.GET.get('shelf_cursor'),
+                page_size=pagination.page_size_from(self.request),
+            ).link_queries(self.request, 'shelf_cursor')
+            # 「続きから読む」の位置は本棚のページの書籍の分をまとめて1回のクエリで読む
+            reading = progress.for_books(user, [book.pk for book in context['bookshelf']])
+            for book in context['bookshelf']:
+                book.reading_progress = reading.get(book.pk)
+            context.update(transaction_history(self.request, user))
+        return context
+
 
 class LoginView(auth_views.LoginView):
     template_name = 'onboro/login.html'
@@ -69,6 +118,8 @@ class UserIndexView(StaffRequiredMixin, generic.ListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['import_form'] = UserImportForm()
+        context['bulk_charge_form'] = BulkChargeForm()
+        context['jobs'] = Job.objects.select_related('created_by')[:10]
         return context
 
 
@@ -82,8 +133,16 @@ class UserDetailView(StaffRequiredMixin, generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['charge_form'] = CoinChargeForm(initial={'user': self.kwargs['pk']})
+        context.update(transaction_history(self.request, self.object))
         return context
 
+def save_profile_form(form):
+    # 保存するとナビゲーションバー用のキャッシュは消える(signals.py)。アイコンが変わったら縮小版をここで作る
+    profile = form.save()
+    if 'icon' in form.changed_data:
+        avatars.generate(profile.icon.name)
+    return profile
+
 @login_required
 def my_page_settings(request):
     user_profile = request.user.userprofile  # ユーザーのプロファイル情報を取得
@@ -93,12 +152,12 @@ def my_page_settings(request):
         icon_form = IconUploadForm(request.POST, request.FILES, instance=user_profile)
 
         if 'update_settings' in request.POST and form.is_valid():
-            form.save()
+            save_profile_form(form)
             messages.success(request, 'カスタム設定を更新しました。')
             return redirect('onboro:my_page_settings')  # リダイレクトするURLを指定
 
         elif 'upload_icon' in request.POST and icon_form.is_valid():
-            icon_form.save()
+            save_profile_form(icon_form)
             messages.success(request, 'アイコンをアップロードしました。')
             return redirect('onboro:my_page_settings')  # リダイレクトするURLを指定
 
@@ -120,28 +179,54 @@ def user_import(request):
         # 「ファイル内容」以外はPOSTに格納されるので両方を指定する
         form = UserImportForm(request.POST, request.FILES)
         if form.is_valid():
-            # validation実行後はclean_dateに内容が設定される
-            file = form.cleaned_data['file']
-            # fileはバイナリオープンされるのでcsvで読み込むにはdecodeが必要
-            reader = csv.DictReader(codecs.iterdecode(file, 'utf-8'))
+            # 大きなファイルはリクエストの中では終わらないので、ジョブとして登録してワーカー(run_jobs)に任せる
+            job = jobs.enqueue('user_import', file=form.cleaned_data['file'], user=request.user)
+            messages.success(request, f'インポートをジョブ#{job.pk}として登録しました。進み具合は下の一覧で確認できます。')
 
-            try:
-                # トランザクションとして実行（一つでもエラーになる場合は全部の追加を取りやめる）
-                # with文を使い、その内部に「処理」を書く
-                with transaction.atomic():
-                    for row in reader:
-                        # is_activeはint経由でboolに変換
-                        row['is_active'] = bool(int(row['is_active']))
-                        # Userはパスワードについて特別処理が必要なため、専用のcreate_userメソッドが用意されている
-                        # usernameは一意である必要があるため、同じusernameがあるとIntegrityError（例外）が発生する
-                        User.objects.create_user(**row)
-                    messages.success(request, 'インポートに成功しました。')
-            except IntegrityError:
-                messages.error(request, 'インポートが行えませんでした。ユーザー名が重複している可能性があります。')
+    return redirect('onboro:user_index')
+
+
+# CSVでまとめてコインをチャージする（キャンペーンなどで数万人に配るとき用）
+@user_passes_test(staff_required)
+def coin_bulk_charge(request):
+    if request.method == 'POST':
+        form = BulkChargeForm(request.POST, request.FILES)
+        if form.is_valid():
+            job = jobs.enqueue(
+                'coin_bulk_charge',
+                payload={
+                    'chunk_size': form.cleaned_data['chunk_size'],
+                    'all_or_nothing': form.cleaned_data['all_or_nothing'],
+                },
+                file=form.cleaned_data['file'],
+                user=request.user,
+            )
+            messages.success(request, f'一括チャージをジョブ#{job.pk}として登録しました。進み具合は下の一覧で確認できます。')
 
     return redirect('onboro:user_index')
 
 
+@user_passes_test(staff_required)
+def job_status(request, pk):
+    """ジョブの進み具合(処理した行数・エラー)を返す（画面から定期的に問い合わせる）"""
+    job = get_object_or_404(Job, pk=pk)
+    return JsonResponse(jobs.status(job))
+
+
+@user_passes_test(staff_required)
+def sales_dashboard(request):
+    """売上の集計画面（日次集計テーブルだけを読むので、1年分でもすぐに表示できる）"""
+    form = SalesReportForm(request.GET or None)
+    end = timezone.localdate()
+    start = end - datetime.timedelta(days=364)
+    if form.is_valid():
+        start = form.cleaned_data['start'] or start
+        end = form.cleaned_data['end'] or end
+    context = {'form': form, 'start': start, 'end': end}
+    context.update(rollups.report(start, end))
+    return render(request, 'onboro/sales_dashboard.html', context)
+
+
 class BookSearchView(BookSearchMixin, generic.ListView):
     template_name = 'onboro/book_search.html'
     context_object_name = 'books'
@@ -150,39 +235,103 @@ class BookSearchView(BookSearchMixin, generic.ListView):
         # BookSerchFormは使わず、直接取得する方がわかりやすい
         category = self.request.GET['category']
         word = self.request.GET['word']
+        cursor = self.request.GET.get('cursor')
+        page_size = pagination.page_size_from(self.request)
+
+        # 検索ワードが指定されていれば全文検索インデックスを使う
+        # タイトル・概要・章本文のどこかに書いてあればヒットし、関連度の高い順に並ぶ
+        if word:
+            book_ids = search_cache.search_book_ids(word, category=category)
+            self.page = pagination.paginate_ids(book_ids, cursor, page_size)
+            # 表示するページの分だけカテゴリと一緒に取得する
+            books = Book.objects.select_related('category').in_bulk(self.page.object_list)
+            self.page.object_list = [books[pk] for pk in self.page.object_list if pk in books]
+            return self.page.object_list
 
         # 公開しているもののみ対象とする
-        books = Book.objects.filter(published=True)
+        books = Book.objects.filter(published=True).select_related('category')
         # カテゴリが認定されていれば条件に加える
         if category:
             books = books.filter(category__pk=category)
-        # 検索ワードが指定されていれば条件に加える
-        # タイトルと概要は「どちらかに書いてあれば(or)」でカテゴリとはANDになる
-        if word:
-            q1 = Q(title__contains=word)
-            q2 = Q(abstract__contains=word)
-            books = books.filter(q1 | q2)
 
-        return books
+        self.page = pagination.paginate(books, ['pk'], cursor, page_size)
+        return self.page.object_list
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['page'] = self.page.link_queries(self.request)
+        return context
+
+
+# 検索フォームの入力補完用（キー入力ごとに呼ばれるのでDBは使わずメモリ上の索引から返す）
+def book_suggest(request):
+    word = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', suggest.DEFAULT_LIMIT)), 50)
+    except ValueError:
+        limit = suggest.DEFAULT_LIMIT
+    suggestions = [{'id': pk, 'title': title} for pk, title in suggest.suggest(word, limit)]
+    return JsonResponse({'suggestions': suggestions})
+
+
+# 章のページからのビーコン（読んでいる章・ページ・スクロール位置）
+# スクロールのたびに呼ばれるので、DBには書かずにためておき、まとめて書き込む(progress.py)
+def reading_progress(request, book_id):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    user = request.user
+    if not user.is_authenticated or not can_view_chapter(user, book_id):
+        return HttpResponseForbidden()
+    try:
+        number = int(request.POST['chapter'])
+        # 全文(?page=all)で読んでいるときは 0
+        page = max(int(request.POST.get('page', 1)), 0)
+        position = float(request.POST.get('position', 0))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    if not math.isfinite(position):
+        return HttpResponseBadRequest()
+    position = min(max(position, 0.0), 1.0)
+    # 章は目次(キャッシュ)で確かめる
+    chapter = toc.for_book(book_id).get(number)
+    if chapter is None:
+        return HttpResponseBadRequest()
+    progress.record(user, book_id, chapter, page, position)
+    return HttpResponse(status=204)
 
 
 # 検索結果画面でリンクを設定するので詳細ビューも定義します
 # テンプレートは第3項で作成します
 
 def can_view_chapter(user, book_id):
-    if user.is_authenticated:
-        if user.is_staff:
-            return True
-        if user.books.filter(pk=book_id).exists():
-            return True
-
-    return False
+    # スタッフは常に閲覧でき、それ以外は購入済み書籍のキャッシュで確認する
+    return entitlements.can_view(user, book_id)
 
 
 class BookDetailView(BookSearchMixin, generic.DetailView):
-    queryset = Book.objects.filter(published=True)
+    queryset = Book.objects.filter(published=True).select_related('category')
     template_name = 'onboro/book_detail.html'
 
+    def get(self, request, *args, **kwargs):
+        self.object = book = self.get_object()
+        user = request.user
+        # 章の一覧は本文を読まない目次(キャッシュ)から出す
+        self.toc = toc.for_book(book.pk)
+        self.owns = user.is_authenticated and entitlements.owns(user, book.pk)
+        self.can_view_chapter = can_view_chapter(user, book.pk)
+
+        # 書籍・目次・購入状況が前に返したページと同じなら304を返す
+        etag = conditional.etag(
+            request, book.pk, book.updated_at, book.category.name, self.toc.etag_parts(),
+            self.owns, self.can_view_chapter,
+        )
+        last_modified = max(filter(None, [book.updated_at, self.toc.updated_at]))
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is None:
+            response = self.render_to_response(self.get_context_data(object=book))
+            conditional.set_headers(response, etag, last_modified)
+        return response
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
@@ -190,25 +339,46 @@ class BookDetailView(BookSearchMixin, generic.DetailView):
         user = self.request.user
         book_pk = self.kwargs['pk']
         if user.is_authenticated:
-            if not user.books.filter(pk=book_pk).exists():
+            if not self.owns:
                 context['use_form'] = CoinUseForm(initial={
                     'user': user.pk,
                     'book': book_pk
                 })
 
-        context['can_view_chapter'] = can_view_chapter(user, book_pk)
+        context['can_view_chapter'] = self.can_view_chapter
+        context['toc'] = self.toc
 
         return context
 
 # 書籍画像アップロード用
-class BookImageUploadView(LoginRequiredMixin, generic.FormView):
-    def get(self, request, pk):
-        book = get_object_or_404(Book, pk=pk)
-        form = BookImageUploadForm()
-        return render(request, 'onboro/upload_image.html', {'form': form, 'book': book})
+# 書籍の画像を差し替えるのでスタッフだけが使える
+class BookImageUploadView(StaffRequiredMixin, generic.FormView):
+    template_name = 'onboro/upload_image.html'
+    form_class = BookImageUploadForm
+
+    def dispatch(self, request, *args, **kwargs):
+        self.book = get_object_or_404(Book, pk=self.kwargs['pk'])
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['book'] = self.book
+        return context
+
+    def form_valid(self, form):
+        self.book.image = form.cleaned_data['image']
+        self.book.save()
+        # 一覧・詳細で使う縮小版をここで作っておく
+        renditions.generate([self.book.image.name])
+        messages.success(self.request, '画像をアップロードしました。')
+        return redirect('onboro:book_detail', pk=self.book.pk)
 
 class BookChapterView(BookSearchMixin, generic.DetailView):
     template_name = 'onboro/book_chapter.html'
+    # ?page=all で章の全文を返す
+    ALL_PAGES = 'all'
+    # 全文を返すとき、テンプレートの本文の場所に入れておく目印
+    BODY_MARKER = '<!-- onboro:chapter-body -->'
 
     def get(self, request, *args, **kwargs):
         # 購入していない書籍の章に直にアクセスされたら403を返す
@@ -216,18 +386,58 @@ class BookChapterView(BookSearchMixin, generic.DetailView):
         if not can_view_chapter(self.request.user, book_id):
             return HttpResponseForbidden()
 
-        return super().get(request, args, kwargs)
+        self.object = chapter = self.get_object()
+        # ?page=N のページだけを表示する（?page=all なら全文）
+        page = request.GET.get('page', '1')
+        if page == self.ALL_PAGES:
+            self.page_number = None
+        else:
+            try:
+                self.page_number = int(page)
+            except ValueError:
+                raise Http404
+            if not 1 <= self.page_number <= max(chapter.page_count, 1):
+                raise Http404
+        # 前後の章は目次(キャッシュ)から求める。章番号が飛んでいても隣の章を出す
+        self.neighbours = toc.for_book(chapter.book_id).neighbours(chapter.number)
+
+        # 本文(のハッシュ)・章名・前後の章が前に返したページと同じなら304を返す
+        etag = conditional.etag(
+            request, chapter.pk, chapter.number, chapter.title, chapter.body_hash, chapter.book.title,
+            [(entry.number, entry.title) if entry else None for entry in self.neighbours],
+        )
+        last_modified = max(chapter.updated_at, chapter.book.updated_at)
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is None:
+            if self.page_number is None:
+                response = self.stream_response(chapter)
+            else:
+                response = self.render_to_response(self.get_context_data(object=chapter))
+            conditional.set_headers(response, etag, last_modified)
+        return response
+
+    def stream_response(self, chapter):
+        # 本文の前後だけをテンプレートで描き、本文は数ページずつ読みながら送る
+        page = render_to_string(self.template_name, self.get_context_data(object=chapter), self.request)
+        head, tail = page.split(self.BODY_MARKER, 1)
+
+        def content():
+            yield head
+            yield from chapters.stream(chapter.pk)
+            yield tail
+
+        return StreamingHttpResponse(content())
 
     # 指定bookの中の指定chapterなのでget_objectを定義する必要あり
     def get_object(self, queryset=None):
-        book_id = self.kwargs['book_id']
-        number = self.kwargs['number']
-        # 非公開のbookにはアクセスできないようにする
-        book = get_object_or_404(Book, pk=book_id, published=True)
-        # 存在しない章にアクセスされたとき対策としてこちらもget_or_404を使う
-        # get_or_404にはManagerを渡せる
-        chapter = get_object_or_404(book.chapter_set, number=number)
-        return chapter
+        # 章と書籍(表示に使う列だけ)を1回のクエリで読む。本文(ChapterPage)はページごとに読む
+        # 非公開のbookの章や存在しない章にアクセスされたら404にする
+        queryset = Chapter.objects.select_related('book').only(
+            'number', 'title', 'body_hash', 'page_count', 'updated_at', 'book__title', 'book__updated_at',
+        )
+        return get_object_or_404(
+            queryset, book_id=self.kwargs['book_id'], number=self.kwargs['number'], book__published=True,
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -235,6 +445,14 @@ class BookChapterView(BookSearchMixin, generic.DetailView):
         chapter = context['chapter']
         # chapterの親もcontextにあった方がいいので設定
         context['book'] = chapter.book
+        context['prev_chapter'], context['next_chapter'] = self.neighbours
+        context['page_number'] = self.page_number
+        if self.page_number is None:
+            context['page_html'] = self.BODY_MARKER
+        else:
+            context['page_html'] = chapters.page(chapter.pk, self.page_number) or ''
+            context['previous_page'] = self.page_number - 1 if self.page_number > 1 else None
+            context['next_page'] = self.page_number + 1 if self.page_number < chapter.page_count else None
         return context
 
 @user_passes_test(staff_required)
@@ -243,15 +461,8 @@ def transaction_charge(request, pk):
         form = CoinChargeForm(request.POST)
         if form.is_valid():
             record = form.save(commit=False)
-            # 予想外のことがない限り例外は発生しないのでtry-exceptはしない
-            with transaction.atomic():
-                user = record.user
-                user.coin += record.amount
-                user.save()
-
-                record.kind = TransactionRecord.Kind.CHARGE.value
-                record.datetime = timezone.now()
-                record.save()
+            # 残高の加算は取引記録の作成と同じトランザクションでledgerがまとめて行う
+            ledger.charge(record.user, record.amount)
 
     return redirect('onboro:user_detail', pk)
 
@@ -264,19 +475,14 @@ def transaction_use(request, pk):
             user = record.user
             book = record.book
 
-            if user.coin < book.price:
+            # 残高の確認と減算はledgerがUPDATE 1文で行うので、同時に購入されても残高はマイナスにならない
+            try:
+                ledger.purchase(user, book)
+            except ledger.AlreadyOwned:
+                # 二重送信などで購入済みの書籍をもう一度買わないようにする
+                pass
+            except ledger.InsufficientCoins:
                 messages.warning(request, 'コインが足りません。')
-                # コード重複にはなるがインデントが深くなるとわかりにくくなるのでここでreturn
-                return redirect('onboro:book_detail', book.pk)
-
-            with transaction.atomic():
-                user.coin -= book.price
-                user.save()
-
-                record.kind = TransactionRecord.Kind.USE.value
-                record.amount = book.price
-                record.datetime = timezone.now()
-                record.save()
 
             return redirect('onboro:book_detail', book.pk)
 
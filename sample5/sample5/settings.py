@@ -21,6 +21,29 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# アップロードされた画像は中身のハッシュの名前で1つだけ保存する（onboro/storage.py）
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'uploads': {
+        'BACKEND': 'onboro.storage.ContentAddressedStorage',
+    },
+    # collectstatic で、ファイル名に中身のハッシュを付け(bootstrap.min.3f2a….css)、gzip・brotli版も作る
+    'staticfiles': {
+        'BACKEND': 'onboro.storage.StaticFilesStorage',
+    },
+}
+
+# アップロードされたファイルの配信（onboro/media.py）
+# 前段のWebサーバーに送信を任せるときはヘッダー名を設定する
+#   nginx: 'X-Accel-Redirect'（MEDIA_ACCEL_REDIRECT_PREFIX を internal の location で MEDIA_ROOT に向ける）
+#   Apache(mod_xsendfile)・lighttpd: 'X-Sendfile'
+MEDIA_SENDFILE_HEADER = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+# 中身のハッシュの名前でないファイル(以前のアップロード)をキャッシュさせる秒数
+MEDIA_MAX_AGE = 3600
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.1/howto/deployment/checklist/
@@ -43,6 +66,8 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    # runserver でも静的ファイルを WhiteNoise で配信する（本番と同じヘッダーで確かめられる）
+    'whitenoise.runserver_nostatic',
     'django.contrib.staticfiles',
     'django.contrib.humanize',
     'widget_tweaks',
@@ -50,6 +75,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # 静的ファイルはDjangoのビューより前に返す（SecurityMiddlewareの直後に置く）
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -71,6 +98,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'onboro.context_processors.user_chrome',
             ],
         },
     },
@@ -86,10 +114,89 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # 複数のワーカーから同時に書き込んでもすぐに"database is locked"にならないよう、
+        # トランザクションの開始時に書き込みロックを取り、空くまで待つ
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# 検索結果や閲覧権限のキャッシュは複数のワーカープロセスで共有できるようファイルに置く
+# （外部サービスなしで1台のサーバーで動かすため）
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'search',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    'entitlements': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'entitlements',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # 書籍ごとの目次（章番号・章名）
+    'toc': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'toc',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # ナビゲーションバーに出すユーザーごとの表示設定（アイコン・文字の大きさ・背景色）
+    'profiles': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'profiles',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # 表紙画像の縮小版を作ったかどうか（画像のファイル名ごと）
+    'renditions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'renditions',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+SEARCH_CACHE_ALIAS = 'search'
+SEARCH_CACHE_TIMEOUT = 300
+
+ENTITLEMENT_CACHE_ALIAS = 'entitlements'
+ENTITLEMENT_CACHE_TIMEOUT = 3600
+
+RENDITION_CACHE_ALIAS = 'renditions'
+
+TOC_CACHE_ALIAS = 'toc'
+TOC_CACHE_TIMEOUT = 3600
+
+PROFILE_CACHE_ALIAS = 'profiles'
+PROFILE_CACHE_TIMEOUT = 3600
+
+# 読書の進み具合はプロセスのメモリにためて、この秒数ごと(またはこの件数たまったら)まとめて書き込む
+READING_PROGRESS_FLUSH_INTERVAL = 10
+READING_PROGRESS_MAX_PENDING = 1000
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -125,6 +232,10 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# ハッシュの付いた静的ファイルは WhiteNoise が1年・immutable でキャッシュさせる。付いていないものはこの秒数
+WHITENOISE_MAX_AGE = 0 if DEBUG else 3600
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field